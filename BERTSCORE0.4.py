@@ -1,16 +1,19 @@
 import csv
 import os
 import random
-from json import loads
-from ragas.metrics import faithfulness
 from ragas import evaluate
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
-from datasets import Dataset
+from openai_client import get_openai_client, share_with_ragas, connection_report
+from rate_limit import get_rate_limiter
+from telemetry import get_session_telemetry
+from run_store import get_run_store
+from cancellation import cancel_session_work, renew_session_token, watch_uploaded_file
+from metric_cache import get_metric_cache
+from pipeline import VariantPipeline
+from quiz_pipeline import question_response_format, stream_questions, render_question, select_context
 import pdfplumber
 import numpy as np
-from bert_score import score  # ← BERTScore 追加
 
 # ===== PDF → CSV変換 =====
 def pdf_to_csv(pdf_file, csv_file="Book1.csv"):
@@ -39,7 +42,24 @@ def load_explanations_from_csv(filename="Book1.csv"):
 # ===== OpenAI API キーの読み込み =====
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# HTTP 接続プールはプロセスで共有する（再実行のたびに接続を張り直さない）
+client = get_openai_client(api_key)
+
+# ===== 計測（処理時間・トークン数・コスト） =====
+telemetry = get_session_telemetry(st.session_state)
+telemetry.attach_sidebar()
+# 全セッション・全プロセスで共有する API のレート制限（429 はバックオフして再試行）
+client = get_rate_limiter().wrap(client, telemetry=telemetry)
+client = telemetry.instrument(client)
+evaluate = share_with_ragas(evaluate)
+evaluate = telemetry.instrument_evaluate(evaluate)
+
+# 同じ問題・正解・根拠の評価結果は永続キャッシュを使う
+metric_cache = get_metric_cache()
+evaluate = metric_cache.wrap_evaluate(evaluate)
+
+# 生成した問題はプロンプト・パラメータと一緒に保存する（replay.py で指標を計算し直せる）
+run_store = get_run_store()
 
 # ===== Streamlit UI =====
 st.title("兵庫学検定試験対策ツール（5問同時出題＋Faithfulness＋BERTScore付き）")
@@ -48,6 +68,7 @@ st.title("兵庫学検定試験対策ツール（5問同時出題＋Faithfulness
 uploaded_file = st.file_uploader("クイズに使うPDFファイルを選んでください", type=["pdf"])
 
 if uploaded_file is not None:
+    watch_uploaded_file(st.session_state, uploaded_file)
     pdf_path = "uploaded.pdf"
     with open(pdf_path, "wb") as f:
         f.write(uploaded_file.read())
@@ -66,51 +87,52 @@ if "explanations" in st.session_state and st.session_state.explanations:
         # ランダムで1文を選択
         QuestionNum = random.randint(0, len(explanations) - 1)
         SelectedQuestion = explanations[QuestionNum]
+        telemetry.new_question()
+        cancel_token = renew_session_token(st.session_state, telemetry)
 
         NUM_VARIANTS = 15
+        QUESTIONS_PER_CALL = 1  # 1回の呼び出しで作る問題数（QuestionSet スキーマ）
         generated_answers = []
 
-        for i in range(NUM_VARIANTS):
-            response = client.chat.completions.create(
-                model="gpt-4.1",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "あなたはクイズの出題者です。以下の文から四択問題を作成してください。"
-                            "本文内容に基づいた問題にしてください。"
-                            "出力はJSON形式で返してください。"
-                        )
-                    },
-                    {"role": "user", "content": SelectedQuestion},
-                ],
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "QuestionData",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "Question": {"type": "string"},
-                                "Choice1": {"type": "string"},
-                                "Choice2": {"type": "string"},
-                                "Choice3": {"type": "string"},
-                                "Choice4": {"type": "string"},
-                                "CorrectAnswer": {"type": "number"},
-                            },
-                            "required": ["Question", "Choice1", "Choice2", "Choice3", "Choice4", "CorrectAnswer"],
-                            "additionalProperties": False,
-                        },
-                        "strict": True,
-                    },
-                },
-                temperature=0.6
-            )
+        # 生成できた問題から順に表示する（一覧表示の前に消す）
+        progress_area = st.empty()
+        progress = progress_area.container()
+
+        # 生成できた問題から順に BERTScore と Faithfulness を裏で計算する
+        # （根拠は問題・正解に近い文だけに絞り、評価モデルの入力トークンを減らす）
+        evaluation_pipeline = VariantPipeline(
+            SelectedQuestion, client, metrics=["bertscore", "faithfulness"], embed=False,
+            telemetry=telemetry, evaluate_fn=evaluate, cancel=cancel_token,
+            contexts_fn=lambda q: select_context(client, q, SelectedQuestion, telemetry=telemetry),
+        )
 
-            output_text = response.choices[0].message.content
+        run = run_store.start_run(os.path.basename(__file__), SelectedQuestion, QuestionNum)
+        for i in range(0, NUM_VARIANTS, QUESTIONS_PER_CALL):
             try:
-                data = loads(output_text)
-                generated_answers.append(data)
+                for data in stream_questions(
+                    client,
+                    telemetry=telemetry,
+                    run=run,
+                    cancel=cancel_token,
+                    model="gpt-4.1",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": (
+                                "あなたはクイズの出題者です。以下の文から四択問題を作成してください。"
+                                "本文内容に基づいた問題にしてください。"
+                                "出力はJSON形式で返してください。"
+                            )
+                        },
+                        {"role": "user", "content": SelectedQuestion},
+                    ],
+                    response_format=question_response_format(min(QUESTIONS_PER_CALL, NUM_VARIANTS - i)),
+                    temperature=0.6,
+                ):
+                    generated_answers.append(data)
+                    evaluation_pipeline.submit(data)
+                    render_question(progress, len(generated_answers), data)
+                    telemetry.first_result()
             except Exception as e:
                 st.error(f"JSON読み込み失敗: {e}")
 
@@ -119,39 +141,19 @@ if "explanations" in st.session_state and st.session_state.explanations:
         st.session_state.selected_question = SelectedQuestion
         st.session_state.next_question = False
 
-        # ===== BERTScore（全問対象） =====
-        all_correct_answers = [
-            d[f"Choice{d['CorrectAnswer']}"]
-            for d in generated_answers
-        ]
-
-        refs = all_correct_answers  # 正解選択肢
-        cands = [st.session_state.selected_question] * len(all_correct_answers)  # 説明文
-
-        P, R, F1 = score(
-            cands,
-            refs,
-            lang="ja",
-            model_type="bert-base-multilingual-cased"
-        )
+        # ===== BERTScore（全問対象）と Faithfulness 評価 =====
+        progress.caption("BERTScore と Faithfulness の残りを計算しています…")
+        scores = evaluation_pipeline.close().scores
 
-        st.session_state.bert_scores = F1.tolist()
+        st.session_state.bert_scores = scores["bertscore"]
         st.session_state.avg_bert_score = float(np.mean(st.session_state.bert_scores))
+        progress.caption(f"平均BERTScore（F1）: {st.session_state.avg_bert_score:.4f}")
 
-        # ===== Faithfulness 評価 =====
-        faithfulness_scores = []
-        for q in st.session_state.generated_answers:
-            data = Dataset.from_dict({
-                "question": [q["Question"]],
-                "answer": [q[f"Choice{q['CorrectAnswer']}"]],
-                "contexts": [[st.session_state.selected_question]],
-            })
-
-            result = evaluate(data, metrics=[faithfulness])
-            faithfulness_scores.append(result["faithfulness"][0])
+        st.session_state.faithfulness_scores = scores["faithfulness"]
+        st.session_state.avg_faithfulness = np.mean(scores["faithfulness"])
+        progress.caption(f"平均Faithfulnessスコア: {st.session_state.avg_faithfulness:.4f}")
 
-        st.session_state.faithfulness_scores = faithfulness_scores
-        st.session_state.avg_faithfulness = np.mean(faithfulness_scores)
+        progress_area.empty()
 
     # ===== UI表示（生成された問題一覧） =====
     st.subheader("生成された全問題")
@@ -183,7 +185,8 @@ if "explanations" in st.session_state and st.session_state.explanations:
     st.write(f"平均BERTScore（F1）: {st.session_state.avg_bert_score:.4f}")
 
     # 次の問題へボタン
-    if st.button("次の問題へ"):
+    # 取り消しは on_click で行う（ボタンの処理より先に、スクリプト本体の再実行の前に呼ばれる）
+    if st.button("次の問題へ", on_click=cancel_session_work, args=(st.session_state, "next_question")):
         st.session_state.next_question = True
         st.session_state.pop("generated_answers", None)
         st.session_state.pop("bert_scores", None)
@@ -194,3 +197,6 @@ if "explanations" in st.session_state and st.session_state.explanations:
 
 else:
     st.info("まずはPDFファイルをアップロードしてください。")
+
+st.sidebar.caption(metric_cache.report())
+st.sidebar.caption(connection_report())
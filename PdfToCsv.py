@@ -6,8 +6,11 @@ from ragas.metrics import faithfulness, answer_relevancy
 from ragas import evaluate
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
-from datasets import Dataset
+from openai_client import get_openai_client, share_with_ragas, connection_report
+from rate_limit import get_rate_limiter
+from telemetry import get_session_telemetry
+from metric_cache import get_metric_cache
+from quiz_pipeline import select_context, score_table
 import pdfplumber
 
 # ===== PDF → CSV変換 =====
@@ -37,7 +40,21 @@ def load_explanations_from_csv(filename="Book1.csv"):
 # ===== OpenAI API キーの読み込み =====
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# HTTP 接続プールはプロセスで共有する（再実行のたびに接続を張り直さない）
+client = get_openai_client(api_key)
+
+# ===== 計測（処理時間・トークン数・コスト） =====
+telemetry = get_session_telemetry(st.session_state)
+telemetry.attach_sidebar()
+# 全セッション・全プロセスで共有する API のレート制限（429 はバックオフして再試行）
+client = get_rate_limiter().wrap(client, telemetry=telemetry)
+client = telemetry.instrument(client)
+evaluate = share_with_ragas(evaluate)
+evaluate = telemetry.instrument_evaluate(evaluate)
+
+# 同じ問題・正解・根拠の評価結果は永続キャッシュを使う
+metric_cache = get_metric_cache()
+evaluate = metric_cache.wrap_evaluate(evaluate)
 
 # ===== Streamlit UI =====
 st.title("兵庫学検定試験対策ツール")
@@ -64,6 +81,7 @@ if "explanations" in st.session_state and st.session_state.explanations:
     if "question_data" not in st.session_state or st.session_state.get("next_question", False):
         QuestionNum = random.randint(0, len(explanations) - 1)
         SelectedQuestion = explanations[QuestionNum]
+        telemetry.new_question()
 
         response = client.chat.completions.create(
             model="gpt-4.1",
@@ -138,20 +156,24 @@ if "explanations" in st.session_state and st.session_state.explanations:
         st.info(f"解説：{st.session_state.explanation}")
 
         # === Faithfulness / Answer relevancy 評価 ===
-        data = Dataset.from_dict({
-            "question": [st.session_state.question_data["Question"]],
-            "answer": [st.session_state.question_data[f"Choice{st.session_state.question_data['CorrectAnswer']}"]],
-            "contexts": [[st.session_state.explanation]],
-        })
-
-        result1 = evaluate(data, metrics=[faithfulness])
-        result2 = evaluate(data, metrics=[answer_relevancy])
+        # 問題・正解に近い文だけを根拠として渡す（評価モデルの入力トークンを減らす）
+        trimmed_context = select_context(
+            client, st.session_state.question_data, st.session_state.explanation, telemetry=telemetry
+        )
+        # Faithfulness と Answer relevancy を1回の evaluate でまとめて（並行に）評価
+        scores = score_table(
+            [st.session_state.question_data], [trimmed_context],
+            [faithfulness, answer_relevancy], evaluate_fn=evaluate,
+        )[0]
 
-        st.write("Faithfulnessスコア:", result1["faithfulness"][0])
-        st.write("Answer Relevancyスコア:", result2["answer_relevancy"][0])
+        st.write("Faithfulnessスコア:", scores["faithfulness"])
+        st.write("Answer Relevancyスコア:", scores["answer_relevancy"])
 
     if st.button("次の問題へ"):
         st.session_state.next_question = True
         st.rerun()
 else:
     st.info("まずはPDFファイルをアップロードしてください。")
+
+st.sidebar.caption(metric_cache.report())
+st.sidebar.caption(connection_report())
@@ -0,0 +1,424 @@
+"""温度スイープを OpenAI Batch API で実行するための JSONL 作成・投入・取り込みツール
+
+流れ:
+    python batch_sweep.py build-gen --csv Book1.csv --temperatures 0.0 0.8 --out gen.jsonl
+    python batch_sweep.py submit gen.jsonl            # → batch_id を表示
+    python batch_sweep.py ingest <batch_id>           # 生成結果を results DB に取り込み
+    python batch_sweep.py build-embed --out emb.jsonl # 生成済みの正解選択肢の埋め込みリクエスト
+    python batch_sweep.py submit emb.jsonl --endpoint /v1/embeddings
+    python batch_sweep.py ingest <batch_id>
+    python batch_sweep.py export --out sweep_results.csv
+
+--local DIR を付けると OpenAI の代わりにファイルベースの LocalBatchClient を使う。
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+import uuid
+from json import loads
+from types import SimpleNamespace
+
+import quiz_pipeline as qp
+from grid import add_grid_arguments, build_grid, load_grid_explanations, write_results
+
+RESULTS_DB = "sweep_results.db"
+
+
+# ===== custom_id =====
+def make_custom_id(kind, temperature, paragraph_index, num_variants, variant=None):
+    parts = [kind, str(temperature), str(paragraph_index), str(num_variants)]
+    if variant is not None:
+        parts.append(str(variant))
+    return ":".join(parts)
+
+
+def parse_custom_id(custom_id):
+    kind, temperature, paragraph_index, num_variants, *rest = custom_id.split(":")
+    return {
+        "kind": kind,
+        "temperature": float(temperature),
+        "paragraph_index": int(paragraph_index),
+        "num_variants": int(num_variants),
+        "variant": int(rest[0]) if rest else None,
+    }
+
+
+# ===== JSONL 作成 =====
+def generation_body(cell, k, v=0):
+    """sweep.py の生成リクエスト（qp.generate_question_set）と同じ本文。v 問目からの呼び出しの seed も同じ"""
+    body = {
+        "model": cell["model"],
+        "messages": qp.build_messages(cell["paragraph"]),
+        "response_format": qp.question_response_format(k),
+        "temperature": cell["temperature"],
+    }
+    seed = qp.variant_seed(cell.get("generation_seed"), v)
+    if seed is not None:
+        body["seed"] = seed
+    return body
+
+
+def generation_requests(cells, per_call=1):
+    """グリッドの各セル × 生成数ぶんの chat.completions リクエスト（1件で per_call 問ずつ）"""
+    for cell in cells:
+        for v in range(0, cell["num_variants"], per_call):
+            k = min(per_call, cell["num_variants"] - v)
+            yield {
+                "custom_id": make_custom_id(
+                    "gen", cell["temperature"], cell["paragraph_index"], cell["num_variants"], v
+                ),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": generation_body(cell, k, v),
+            }
+
+
+def embedding_requests(conn, model=qp.EMBEDDING_MODEL):
+    """取り込み済みの生成結果から、セルごとに1件の embeddings リクエスト"""
+    rows = conn.execute(
+        "SELECT temperature, paragraph_index, num_variants, question_json FROM generations "
+        "WHERE question_json IS NOT NULL ORDER BY temperature, paragraph_index, num_variants, variant"
+    ).fetchall()
+    cells = {}
+    for temperature, paragraph_index, num_variants, question_json in rows:
+        key = (temperature, paragraph_index, num_variants)
+        cells.setdefault(key, []).append(qp.correct_answer(loads(question_json)))
+    for (temperature, paragraph_index, num_variants), answers in cells.items():
+        yield {
+            "custom_id": make_custom_id("emb", temperature, paragraph_index, num_variants),
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {"model": model, "input": answers},
+        }
+
+
+def write_jsonl(requests, path):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+# ===== 結果ストア =====
+def open_results_db(path=RESULTS_DB):
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS generations (
+            custom_id TEXT PRIMARY KEY,
+            temperature REAL, paragraph_index INTEGER, num_variants INTEGER, variant INTEGER,
+            question_json TEXT, error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS embeddings (
+            custom_id TEXT PRIMARY KEY,
+            temperature REAL, paragraph_index INTEGER, num_variants INTEGER,
+            embeddings_json TEXT, avg_cosine_similarity REAL, error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS paragraphs (
+            paragraph_index INTEGER PRIMARY KEY, paragraph TEXT
+        );
+    """)
+    return conn
+
+
+def record_paragraphs(conn, cells):
+    """取り込み時の検証に使うので、生成リクエストを作った段落の本文を保存しておく"""
+    conn.executemany("INSERT OR REPLACE INTO paragraphs VALUES (?, ?)",
+                     {(cell["paragraph_index"], cell["paragraph"]) for cell in cells})
+    conn.commit()
+
+
+def load_paragraphs(conn):
+    return dict(conn.execute("SELECT paragraph_index, paragraph FROM paragraphs"))
+
+
+def ingest_output(conn, lines):
+    """Batch API の出力 JSONL を custom_id で突き合わせて結果ストアに保存
+
+    生成結果は同期のスイープと同じ検証（qp.screen_questions）にかけ、落ちた問題は
+    question_json を空にして error に理由を残す。
+    """
+    counts = {"gen": 0, "emb": 0, "error": 0, "json_repaired": 0, "json_failed": 0, "rejected": 0}
+    paragraphs = load_paragraphs(conn)
+    for line in lines:
+        if not line.strip():
+            continue
+        record = loads(line)
+        key = parse_custom_id(record["custom_id"])
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        error = record.get("error")
+        if error is None and response.get("status_code", 200) != 200:
+            error = body.get("error") or f"status {response.get('status_code')}"
+        if error is not None:
+            counts["error"] += 1
+
+        if key["kind"] == "gen":
+            results = [(None, error)]
+            if error is None:
+                content = body["choices"][0]["message"]["content"]
+                # Batch では再リクエストできないのでローカル修復まで
+                try:
+                    questions, repairs = qp.load_questions(content)
+                except ValueError as e:
+                    results = [(None, f"JSON読み込み失敗: {e}")]
+                    counts["json_failed"] += 1
+                else:
+                    if repairs:
+                        counts["json_repaired"] += 1
+                    results = screen_batch_questions(questions, paragraphs, key["paragraph_index"])
+                    counts["rejected"] += sum(question is None for question, _ in results)
+            # QuestionSet の場合は1件の応答に複数問が入っているので問題ごとに保存
+            for j, (question, question_error) in enumerate(results):
+                conn.execute(
+                    "INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (record["custom_id"] if j == 0 else f"{record['custom_id']}+{j}",
+                     key["temperature"], key["paragraph_index"], key["num_variants"],
+                     key["variant"] + j,
+                     None if question is None else json.dumps(question, ensure_ascii=False),
+                     None if question_error is None else str(question_error)),
+                )
+                counts["gen"] += 1
+        elif key["kind"] == "emb":
+            embeddings = None
+            avg = None
+            if error is None:
+                embeddings = [d["embedding"] for d in sorted(body["data"], key=lambda d: d["index"])]
+                avg = qp.avg_pairwise_similarity(embeddings)
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (record["custom_id"], key["temperature"], key["paragraph_index"],
+                 key["num_variants"], None if embeddings is None else json.dumps(embeddings),
+                 avg, None if error is None else str(error)),
+            )
+            counts["emb"] += 1
+    conn.commit()
+    return counts
+
+
+def screen_batch_questions(questions, paragraphs, paragraph_index):
+    """読み込めた問題を元の段落で検証し、[(問題 or None, エラー or None)]（通った問題が先）を返す"""
+    if paragraph_index not in paragraphs:
+        raise RuntimeError(f"段落 {paragraph_index} の本文が結果ストアにありません"
+                           "（build-gen を同じ --db で実行してください）")
+    accepted, rejected = qp.partition_questions(questions, paragraphs[paragraph_index])
+    return ([(question, None) for question in accepted]
+            + [(None, f"検証で除外: {', '.join(reason)}") for _, reason in rejected])
+
+
+def export_results(conn, out_path):
+    """sweep.py と同じ列構成の CSV に書き出す"""
+    rows = []
+    for temperature, paragraph_index, num_variants, num_generated, avg in conn.execute("""
+        SELECT g.temperature, g.paragraph_index, g.num_variants,
+               SUM(g.question_json IS NOT NULL), e.avg_cosine_similarity
+        FROM generations g
+        LEFT JOIN embeddings e
+          ON e.temperature = g.temperature
+         AND e.paragraph_index = g.paragraph_index
+         AND e.num_variants = g.num_variants
+        GROUP BY g.temperature, g.paragraph_index, g.num_variants
+    """):
+        rows.append({
+            "temperature": temperature,
+            "paragraph_index": paragraph_index,
+            "num_variants": num_variants,
+            "num_generated": num_generated,
+            "avg_cosine_similarity": avg,
+        })
+    write_results(rows, out_path)
+    return len(rows)
+
+
+# ===== ローカルの Batch エンドポイント代替 =====
+def fake_handler(url, body):
+    """ネットワークなしで Batch 出力を作るための決定的なダミー応答"""
+    if url == "/v1/embeddings":
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for i, text in enumerate(inputs):
+            seed = sum(ord(c) for c in text)
+            data.append({"object": "embedding", "index": i,
+                         "embedding": [((seed * (k + 1)) % 97) / 97 + 0.01 for k in range(8)]})
+        return {"object": "list", "data": data, "model": body["model"]}
+    paragraph = body["messages"][-1]["content"]
+    question = {
+        "Question": paragraph[:30] + "？",
+        # 取り込み時の検証（正解が本文に含まれるか）に通るよう、正解は本文から取る
+        "Choice1": paragraph[:20], "Choice2": "選択肢2", "Choice3": "選択肢3", "Choice4": "選択肢4",
+        "CorrectAnswer": 1,
+    }
+    return {
+        "object": "chat.completion",
+        "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant",
+                                 "content": json.dumps(question, ensure_ascii=False)}}],
+    }
+
+
+class LocalBatchClient:
+    """client.files / client.batches の必要部分だけを真似るファイルベースの代替
+
+    batches.create の時点で handler を使って全リクエストを処理し、
+    出力ファイルを directory 以下に書き出して completed にする。
+    """
+
+    def __init__(self, directory, handler=fake_handler):
+        self.directory = directory
+        self.handler = handler
+        os.makedirs(directory, exist_ok=True)
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _path(self, object_id):
+        return os.path.join(self.directory, object_id)
+
+    def _create_file(self, file, purpose="batch"):
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        with open(self._path(file_id), "wb") as f:
+            f.write(file.read())
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _file_content(self, file_id):
+        with open(self._path(file_id), "rb") as f:
+            data = f.read()
+        return SimpleNamespace(content=data, text=data.decode("utf-8"))
+
+    def _create_batch(self, input_file_id, endpoint, completion_window="24h", metadata=None):
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+        with open(self._path(input_file_id), encoding="utf-8") as src, \
+                open(self._path(output_file_id), "w", encoding="utf-8") as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                request = loads(line)
+                try:
+                    response = {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                "body": self.handler(request["url"], request["body"])}
+                    error = None
+                except Exception as e:
+                    response = None
+                    error = {"code": "local_error", "message": repr(e)}
+                dst.write(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                    "custom_id": request["custom_id"],
+                    "response": response,
+                    "error": error,
+                }, ensure_ascii=False) + "\n")
+        batch = {"id": batch_id, "status": "completed", "endpoint": endpoint,
+                 "input_file_id": input_file_id, "output_file_id": output_file_id,
+                 "completion_window": completion_window, "metadata": metadata}
+        with open(self._path(batch_id), "w", encoding="utf-8") as f:
+            json.dump(batch, f)
+        return SimpleNamespace(**batch)
+
+    def _retrieve_batch(self, batch_id):
+        with open(self._path(batch_id), encoding="utf-8") as f:
+            return SimpleNamespace(**json.load(f))
+
+
+def get_client(args):
+    if args.local:
+        if args.local_cassette:
+            from stub_server import StubBackend
+
+            backend = StubBackend(mode="replay", cassette=args.local_cassette)
+            return LocalBatchClient(args.local, handler=backend.batch_handler)
+        return LocalBatchClient(args.local)
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    load_dotenv()
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+
+# ===== 投入・取り込み =====
+def submit(client, jsonl_path, endpoint="/v1/chat/completions"):
+    with open(jsonl_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=endpoint,
+        completion_window="24h",
+    )
+    return batch.id
+
+
+def ingest(client, conn, batch_id, wait=False, poll_interval=60):
+    batch = client.batches.retrieve(batch_id)
+    while wait and batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"バッチ {batch_id} は未完了です（status={batch.status}）")
+    text = client.files.content(batch.output_file_id).text
+    return ingest_output(conn, text.splitlines())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch API で温度スイープを実行")
+    parser.add_argument("--local", metavar="DIR",
+                        help="OpenAI の代わりにファイルベースのローカル Batch エンドポイントを使う")
+    parser.add_argument("--local-cassette", metavar="JSON",
+                        help="--local 使用時に stub_server の cassette を再生して応答する")
+    parser.add_argument("--db", default=RESULTS_DB)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("build-gen", help="生成リクエストの JSONL を作成")
+    add_grid_arguments(p)
+    p.add_argument("--out", default="batch_generation.jsonl")
+
+    p = sub.add_parser("build-embed", help="取り込み済み生成結果の埋め込みリクエスト JSONL を作成")
+    p.add_argument("--model", default=qp.EMBEDDING_MODEL)
+    p.add_argument("--out", default="batch_embedding.jsonl")
+
+    p = sub.add_parser("submit", help="JSONL をアップロードしてバッチを作成")
+    p.add_argument("jsonl")
+    p.add_argument("--endpoint", default="/v1/chat/completions",
+                   choices=["/v1/chat/completions", "/v1/embeddings"])
+
+    p = sub.add_parser("ingest", help="バッチ出力を結果ストアに取り込み")
+    p.add_argument("batch_id")
+    p.add_argument("--wait", action="store_true", help="完了までポーリングする")
+    p.add_argument("--poll-interval", type=float, default=60)
+
+    p = sub.add_parser("export", help="結果ストアを CSV に書き出し")
+    p.add_argument("--out", default="sweep_results.csv")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == "build-gen":
+        cells = build_grid(load_grid_explanations(args), args)
+        with open_results_db(args.db) as conn:
+            record_paragraphs(conn, cells)
+        count = write_jsonl(generation_requests(cells, args.per_call), args.out)
+        print(f"{count} 件の生成リクエストを {args.out} に書き出しました")
+    elif args.command == "build-embed":
+        with open_results_db(args.db) as conn:
+            count = write_jsonl(embedding_requests(conn, args.model), args.out)
+        print(f"{count} 件の埋め込みリクエストを {args.out} に書き出しました")
+    elif args.command == "submit":
+        batch_id = submit(get_client(args), args.jsonl, args.endpoint)
+        print(batch_id)
+    elif args.command == "ingest":
+        with open_results_db(args.db) as conn:
+            counts = ingest(get_client(args), conn, args.batch_id, args.wait, args.poll_interval)
+        print(f"生成 {counts['gen']} 件・埋め込み {counts['emb']} 件を取り込みました"
+              f"（エラー {counts['error']} 件、JSON 修復 {counts['json_repaired']} 件・"
+              f"修復不能 {counts['json_failed']} 件・検証で除外 {counts['rejected']} 件）")
+    elif args.command == "export":
+        with open_results_db(args.db) as conn:
+            count = export_results(conn, args.out)
+        print(f"{count} セルの結果を {args.out} に保存しました")
+
+
+if __name__ == "__main__":
+    main()
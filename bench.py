@@ -0,0 +1,394 @@
+"""問題セット生成の段階別レイテンシ・ベンチマーク
+
+スタブ LLM（stub_server.py）を別スレッドで立ち上げ、coscoscos / BERTSCORE / vector_score
+と同じ処理の流れを非対話で繰り返し実行し、段階ごとの p50 / p95 / p99 を測る。
+
+例:
+    python bench.py --pdfs uploaded.pdf 兵庫学検定p131full.pdf --variants 5 15 --repeat 5
+    python bench.py --label v2 --compare bench_results/v1.json
+    python bench.py --label trimmed --trim-context --compare bench_results/v2.json
+    python bench.py --label pipelined --pipeline --compare bench_results/v2.json
+    python bench.py --label aimd --adaptive-concurrency --stub-capacity 8 --requests 400
+    python bench.py --label hedge --hedge --latency spike:0.3,4,0.03 --variants 15
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+import quiz_pipeline as qp
+import stub_server
+from concurrency import AdaptiveConcurrency, is_overload
+from hedge import HedgedCalls
+from pipeline import pipelined_variants
+from telemetry import Telemetry
+
+# 各アプリの処理の流れ（embed_batched: 埋め込みを1リクエストにまとめるか）
+PIPELINES = {
+    "coscoscos": {"stages": ["embeddings", "similarity", "faithfulness"], "embed_batched": False},
+    "BERTSCORE": {"stages": ["bertscore", "faithfulness"], "embed_batched": False},
+    "vector_score": {"stages": ["embeddings", "similarity", "faithfulness"], "embed_batched": True},
+}
+
+RESULTS_DIR = "bench_results"
+REGRESSION_THRESHOLD = 1.2
+
+
+@contextmanager
+def stage_timer(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.setdefault(stage, []).append(time.perf_counter() - start)
+
+
+# ===== 1回分の問題セット生成 =====
+async def run_question_set(aclient, pipeline, paragraph, num_variants, concurrency, skip, timings,
+                           per_call=1, telemetry=None, trim_client=None, pipelined=False):
+    profile = PIPELINES[pipeline]
+
+    if pipelined:
+        # 生成 → 埋め込み → 評価 を1つのパイプラインで流す（段階ごとの時間は重なるので合計だけ測る）
+        stages = [s for s in profile["stages"] if s not in skip]
+        with stage_timer(timings, "pipeline"):
+            result = await pipelined_variants(
+                aclient, paragraph, num_variants, 0.0, concurrency=concurrency, per_call=per_call,
+                telemetry=telemetry, metrics=[s for s in stages if s in ("faithfulness", "bertscore")],
+                embed="embeddings" in stages,
+            )
+            if "similarity" in stages:
+                result.avg_cosine_similarity()
+        for stage, busy in result.stage_busy.items():
+            timings.setdefault(f"busy:{stage}", []).append(busy)
+        return
+
+    with stage_timer(timings, "generation"):
+        questions = await qp.generate_variants(
+            aclient, paragraph, num_variants, 0.0, concurrency=concurrency, per_call=per_call
+        )
+    answers = [qp.correct_answer(q) for q in questions]
+
+    for stage in profile["stages"]:
+        if stage in skip:
+            continue
+        if stage == "embeddings":
+            with stage_timer(timings, stage):
+                if profile["embed_batched"]:
+                    embeddings = await qp.embed_texts(aclient, answers)
+                else:
+                    embeddings = [(await qp.embed_texts(aclient, [a]))[0] for a in answers]
+        elif stage == "similarity":
+            with stage_timer(timings, stage):
+                qp.avg_pairwise_similarity(embeddings)
+        elif stage == "faithfulness":
+            with stage_timer(timings, stage):
+                await asyncio.to_thread(qp.faithfulness_scores, questions, paragraph, telemetry,
+                                        trim_client)
+        elif stage == "bertscore":
+            with stage_timer(timings, stage):
+                await asyncio.to_thread(qp.bert_scores, answers, paragraph)
+
+
+def summarize(values):
+    values = np.asarray(values)
+    return {
+        "n": int(values.size),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+
+# ===== コーパスの準備 =====
+def load_corpus(pdf_path, csv_path, repeat, timings):
+    """PDF 抽出と CSV 読み込みを repeat 回測り、段落リストを返す"""
+    explanations = []
+    for _ in range(repeat):
+        with stage_timer(timings, "pdf_extraction"):
+            qp.pdf_to_csv(pdf_path, csv_path)
+        with stage_timer(timings, "csv_load"):
+            explanations = qp.load_explanations_from_csv(csv_path)
+    return explanations
+
+
+def _judge_prompt_tokens(telemetry):
+    """評価（RAGAS）段階の入力トークン数の合計"""
+    return sum(s["prompt_tokens"] for stage, s in telemetry.summary().items()
+               if stage.startswith("evaluation"))
+
+
+async def run_benchmark(args, base_url):
+    from openai import AsyncOpenAI, OpenAI
+
+    aclient = AsyncOpenAI(api_key="stub", base_url=base_url, max_retries=0)
+    # --trim-context: 評価の前に本文を問題に近い文だけに絞る（前後比較用）
+    trim_client = OpenAI(api_key="stub", base_url=base_url, max_retries=0) if args.trim_context else None
+    results = []
+    for pdf_path in args.pdfs:
+        corpus_timings = {}
+        csv_path = os.path.join(RESULTS_DIR, "bench_corpus.csv")
+        explanations = load_corpus(pdf_path, csv_path, args.repeat, corpus_timings)
+        if not explanations:
+            print(f"{pdf_path}: テキストを抽出できませんでした")
+            continue
+        for stage, values in corpus_timings.items():
+            results.append({"pipeline": "*", "pdf": pdf_path, "corpus_paragraphs": len(explanations),
+                            "num_variants": None, "stage": stage, **summarize(values)})
+
+        for pipeline in args.pipelines:
+            for num_variants in args.variants:
+                timings = {}
+                telemetry = Telemetry(log_path=None)
+                for i in range(args.repeat):
+                    paragraph = explanations[i % len(explanations)]
+                    with stage_timer(timings, "total"):
+                        await run_question_set(aclient, pipeline, paragraph, num_variants,
+                                               args.concurrency, args.skip, timings, args.per_call,
+                                               telemetry, trim_client, args.pipeline)
+                judge_tokens = _judge_prompt_tokens(telemetry) / args.repeat
+                for stage, values in timings.items():
+                    row = {"pipeline": pipeline, "pdf": pdf_path,
+                           "corpus_paragraphs": len(explanations),
+                           "num_variants": num_variants, "stage": stage,
+                           **summarize(values)}
+                    if stage == "faithfulness":
+                        row["judge_prompt_tokens"] = judge_tokens
+                    results.append(row)
+                print(f"{pipeline} {os.path.basename(pdf_path)} n={num_variants}: "
+                      f"total p50={summarize(timings['total'])['p50']:.3f}s"
+                      f" / 評価の入力トークン {judge_tokens:.0f} / セット")
+    return results
+
+
+# ===== 同時実行数の自動調整（AIMD） =====
+async def run_load(client, requests, workers, backoff=0.2):
+    """requests 件の生成リクエストを workers 本で流す。429 はやり直す。(経過秒, 429 の数) を返す"""
+    request = {"model": qp.GENERATION_MODEL, "messages": [{"role": "user", "content": "ping"}]}
+    remaining = requests
+    overloads = 0
+
+    async def worker():
+        nonlocal remaining, overloads
+        while remaining > 0:
+            remaining -= 1
+            try:
+                await client.chat.completions.create(**request)
+            except Exception as e:
+                if not is_overload(e):
+                    raise
+                overloads += 1
+                remaining += 1
+                await asyncio.sleep(backoff)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return time.perf_counter() - start, overloads
+
+
+async def run_concurrency_benchmark(args, base_url):
+    """同じ負荷を固定の同時実行数と AdaptiveConcurrency で流し、スループット・429・上限の推移を比べる"""
+    from openai import AsyncOpenAI
+
+    results = []
+    for fixed in sorted({args.concurrency, 2 * args.stub_capacity, 4 * args.stub_capacity}):
+        client = AsyncOpenAI(api_key="stub", base_url=base_url, max_retries=0)
+        elapsed, overloads = await run_load(client, args.requests, fixed)
+        results.append({"mode": f"fixed:{fixed}", "elapsed": elapsed, "throughput": args.requests / elapsed,
+                        "overloads": overloads, "final_limit": fixed})
+
+    control = AdaptiveConcurrency("generation", initial=args.concurrency)
+    client = control.wrap(AsyncOpenAI(api_key="stub", base_url=base_url, max_retries=0))
+    elapsed, overloads = await run_load(client, args.requests, control.max_limit)
+    results.append({"mode": "adaptive", "elapsed": elapsed, "throughput": args.requests / elapsed,
+                    "overloads": overloads, "final_limit": control.current, "history": control.history})
+
+    for r in results:
+        print(f"{r['mode']:<10} {r['throughput']:>7.1f} req/s  429 {r['overloads']:>4} 回  "
+              f"上限 {r['final_limit']}")
+    print("上限の推移: " + " → ".join(f"{h['limit']}@{h['t']:.1f}s" for h in control.history))
+    return results
+
+
+# ===== ヘッジ =====
+async def run_hedge_benchmark(args, base_url):
+    """num_variants 本の生成を並列に送る問題セットを --sets 回流し、セットの完了時間をヘッジあり・なしで比べる"""
+    from openai import AsyncOpenAI
+
+    request = {"model": qp.GENERATION_MODEL, "messages": [{"role": "user", "content": "ping"}]}
+    num_variants = max(args.variants)
+    results = []
+    for mode in ("plain", "hedged"):
+        client = AsyncOpenAI(api_key="stub", base_url=base_url, max_retries=0)
+        hedger = None
+        if mode == "hedged":
+            hedger = HedgedCalls(percentile=args.hedge_percentile, budget=args.hedge_budget)
+            client = hedger.wrap(client)
+        set_times = []
+        for _ in range(args.sets):
+            start = time.perf_counter()
+            await asyncio.gather(*(client.chat.completions.create(**request) for _ in range(num_variants)))
+            set_times.append(time.perf_counter() - start)
+        row = {"mode": mode, "num_variants": num_variants, **summarize(set_times)}
+        if hedger is not None:
+            row["extra_requests"] = hedger.stats["hedges"] / max(hedger.stats["calls"], 1)
+        results.append(row)
+        extra = f"  追加リクエスト {row['extra_requests']:.1%}" if hedger is not None else ""
+        print(f"{mode:<7} n={num_variants}: p50 {row['p50']:.3f}s  p95 {row['p95']:.3f}s  "
+              f"p99 {row['p99']:.3f}s{extra}")
+    return results
+
+
+# ===== 出力・比較 =====
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def _result_key(r):
+    return (r["pipeline"], os.path.basename(r["pdf"]), r["num_variants"], r["stage"])
+
+
+def print_table(results):
+    print(f"{'pipeline':<13}{'pdf':<28}{'paras':>6}{'n':>4}  {'stage':<15}{'p50(s)':>9}{'p95(s)':>9}")
+    for r in results:
+        print(f"{r['pipeline']:<13}{os.path.basename(r['pdf'])[:27]:<28}{r['corpus_paragraphs']:>6}"
+              f"{r['num_variants'] or '-':>4}  {r['stage']:<15}{r['p50']:>9.4f}{r['p95']:>9.4f}")
+
+
+def compare(results, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """前回の結果と p50 を比べ、threshold 倍以上遅くなった段階を返す"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {_result_key(r): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        before = baseline.get(_result_key(r))
+        if before and before["p50"] > 0 and r["p50"] / before["p50"] >= threshold:
+            regressions.append((r, before))
+    return regressions
+
+
+def print_judge_tokens(results, baseline_path):
+    """評価（Faithfulness）段階の入力トークン数と p50 を前回の結果と並べて表示"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {_result_key(r): r for r in json.load(f)["results"]}
+    for r in results:
+        before = baseline.get(_result_key(r))
+        if r["stage"] != "faithfulness" or not before:
+            continue
+        print(f"{r['pipeline']} n={r['num_variants']} faithfulness: "
+              f"入力トークン {before.get('judge_prompt_tokens', 0):.0f} → {r.get('judge_prompt_tokens', 0):.0f}, "
+              f"p50 {before['p50']:.4f}s → {r['p50']:.4f}s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="段階別レイテンシ・ベンチマーク（スタブ LLM 使用）")
+    parser.add_argument("--pdfs", nargs="+", default=["uploaded.pdf"],
+                        help="コーパスに使う PDF（大きさの違うものを複数指定）")
+    parser.add_argument("--pipelines", nargs="+", default=list(PIPELINES), choices=list(PIPELINES))
+    parser.add_argument("--variants", type=int, nargs="+", default=[5, 15])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="生成の同時実行数（1 = 現行アプリと同じ逐次実行）")
+    parser.add_argument("--per-call", type=int, default=1,
+                        help="1回の生成リクエストで作る問題数")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["faithfulness", "bertscore"],
+                        help="重い評価段階を省く")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="生成・埋め込み・評価をパイプラインでつないで測る（--compare で逐次実行と比較）")
+    parser.add_argument("--trim-context", action="store_true",
+                        help="Faithfulness の評価前に本文を問題に近い文だけに絞る")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                        help="問題セットの代わりに、固定の同時実行数と AIMD の自動調整の収束を比べる")
+    parser.add_argument("--requests", type=int, default=400, help="--adaptive-concurrency で流すリクエスト数")
+    parser.add_argument("--stub-capacity", type=int, default=8,
+                        help="--adaptive-concurrency でのスタブの同時処理数（その2倍を超えると 429）")
+    parser.add_argument("--hedge", action="store_true",
+                        help="問題セットの代わりに、並列生成の完了時間をヘッジあり・なしで比べる")
+    parser.add_argument("--sets", type=int, default=200, help="--hedge で流す問題セット数")
+    parser.add_argument("--hedge-percentile", type=float, default=95,
+                        help="直近のレイテンシのこのパーセンタイルを超えたら複製を送る")
+    parser.add_argument("--hedge-budget", type=float, default=0.1, help="複製の数の上限（元の呼び出しに対する割合）")
+    parser.add_argument("--metric-cache", action="store_true",
+                        help="評価結果キャッシュ（metric_cache.db）を使う")
+    parser.add_argument("--latency", default="lognormal:-1.2,0.4",
+                        help="スタブの遅延分布（stub_server.py --latency と同じ形式）")
+    parser.add_argument("--cassette", help="指定するとスタブを replay モードで使う")
+    parser.add_argument("--base-url", help="起動済みのスタブサーバーを使う場合の URL")
+    parser.add_argument("--label", default=datetime.now().strftime("%Y%m%d-%H%M%S"))
+    parser.add_argument("--compare", help="比較する過去の結果 JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        backend = stub_server.StubBackend(
+            latency=args.latency,
+            mode="replay" if args.cassette else "stub",
+            cassette=args.cassette,
+            capacity=args.stub_capacity if args.adaptive_concurrency else None,
+        )
+        server = stub_server.serve_in_thread(backend)
+        base_url = server.base_url
+    # RAGAS 内部の OpenAI クライアントもスタブに向ける
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_BASE"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    # 評価結果キャッシュが効くと2回目以降の評価時間が測れないので、既定では使わない
+    if not args.metric_cache:
+        os.environ["METRIC_CACHE"] = "off"
+
+    try:
+        if args.adaptive_concurrency:
+            results = asyncio.run(run_concurrency_benchmark(args, base_url))
+        elif args.hedge:
+            results = asyncio.run(run_hedge_benchmark(args, base_url))
+        else:
+            results = asyncio.run(run_benchmark(args, base_url))
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    standard = not (args.adaptive_concurrency or args.hedge)
+    if standard:
+        print_table(results)
+    out_path = os.path.join(RESULTS_DIR, f"{args.label}.json")
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "label": args.label,
+            "git_revision": _git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "config": vars(args),
+            "results": results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f"結果を {out_path} に保存しました")
+
+    if args.compare and standard:
+        regressions = compare(results, args.compare)
+        for r, before in regressions:
+            print(f"⚠ 退行: {r['pipeline']} n={r['num_variants']} {r['stage']} "
+                  f"p50 {before['p50']:.4f}s → {r['p50']:.4f}s")
+        print_judge_tokens(results, args.compare)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""セッションごとの作業の取り消し
+
+「次の問題へ」や新しい PDF のアップロードで Streamlit が再実行されると、前の問題セットのために
+動いていた生成・埋め込み・評価（裏のスレッドやプロセスプール）は結果を捨てられるだけで動き続ける。
+CancelToken を問題セットごとに1つ作って処理に渡しておき、問題セットが無効になったら cancel() する。
+
+- 裏のパイプライン（pipeline.VariantPipeline）: 段階のタスクを止める。API 待ちはその場で打ち切られ、
+  プロセスプールに積まれたまま始まっていない CPU 指標も取り消される
+- ストリーミング生成（quiz_pipeline.stream_questions）: ストリームを閉じる（残りの出力を受け取らない）
+- レート制限（rate_limit.py）: 予算の空き待ちをやめるので、待っている他のユーザーに予算が回る
+
+トークンはコンテキスト変数（current_token）にも置くので、asyncio.to_thread などで呼ばれた先でも
+引数で渡さずに確認できる。
+"""
+import contextvars
+import threading
+
+_CURRENT = contextvars.ContextVar("cancel_token", default=None)
+
+SESSION_KEY = "cancel_token"
+
+
+class Cancelled(Exception):
+    """取り消された問題セットの処理を打ち切るときに投げる"""
+
+
+class CancelToken:
+    def __init__(self, telemetry=None):
+        self.telemetry = telemetry
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        """取り消す（2回目以降は何もしない）。登録された後始末をすべて呼ぶ"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+        if self.telemetry is not None:
+            self.telemetry.record_event("cancel", reason=reason, callbacks=len(callbacks))
+
+    def on_cancel(self, callback):
+        """取り消されたときに呼ぶ後始末を登録（取り消し済みならすぐ呼ぶ）"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def check(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def wait(self, timeout):
+        """timeout 秒待つ（time.sleep の代わり）。途中で取り消されたら Cancelled"""
+        if self._event.wait(timeout):
+            raise Cancelled(self.reason)
+
+    def activate(self):
+        """このスレッド（コンテキスト）の current_token にする"""
+        _CURRENT.set(self)
+        return self
+
+
+def current_token():
+    """今のコンテキストのトークン（なければ None）"""
+    return _CURRENT.get()
+
+
+def renew_session_token(session_state, telemetry=None, reason="new_question_set"):
+    """前の問題セットのトークンを取り消し、新しい問題セット用のトークンを作って返す
+
+    再実行で捨てられた前の問題セットの生成・埋め込み・評価がまだ動いていれば、ここで止まる。
+    """
+    cancel_session_work(session_state, reason)
+    token = CancelToken(telemetry).activate()
+    session_state[SESSION_KEY] = token
+    return token
+
+
+def cancel_session_work(session_state, reason):
+    """このセッションで動いている問題セットの処理を取り消す
+
+    ボタンで取り消すときは on_click に渡す。if st.button(...) の中で呼ぶと、そこに届くのは
+    その回の生成・評価が終わった後なので、動いている処理は止まらない。
+    """
+    token = session_state.get(SESSION_KEY)
+    if token is not None:
+        token.cancel(reason)
+
+
+def watch_uploaded_file(session_state, uploaded_file):
+    """アップロードされた PDF が別のものに替わったら、前の PDF で動いている問題セットの処理を取り消す"""
+    if session_state.get("uploaded_file_id") != uploaded_file.file_id:
+        cancel_session_work(session_state, "new_pdf")
+        session_state["uploaded_file_id"] = uploaded_file.file_id
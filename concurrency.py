@@ -0,0 +1,214 @@
+"""API 呼び出しの同時実行数の自動調整（AIMD）
+
+固定の concurrency は、API が空いているときは控えめすぎ、混んでいるときは 429 を招く。
+AdaptiveConcurrency は呼び出しごとのレイテンシと結果を見て、同時に送る数の上限を動かす。
+
+- 直近 WINDOW 件の p95 レイテンシが基準（健全だったときの p95）の LATENCY_TOLERANCE 倍以内で、
+  エラー率が ERROR_THRESHOLD 以下なら、上限いっぱいまで使っているときに限り少しずつ増やす（加算）
+- 429・タイムアウトを受けたら上限を DECREASE 倍に減らす（乗算）。同時に返ってきた 429 で
+  何度も半分にならないよう、一度減らしたら直近の p50 レイテンシぶんは減らさない
+
+上限の変化は history に残し、telemetry があれば "concurrency" イベントとして記録する
+（サイドバー・telemetry.jsonl で推移を見られる）。
+
+    control = AdaptiveConcurrency("generation", initial=5, telemetry=telemetry)
+    aclient = control.wrap(AsyncOpenAI(...), "chat.completions.create")
+    evaluate = control.wrap_function(evaluate)   # 同期関数（評価など）にも使える
+"""
+import asyncio
+import inspect
+import math
+import threading
+import time
+from collections import deque
+
+MIN_LIMIT = 1
+MAX_LIMIT = 32
+WINDOW = 20
+LATENCY_TOLERANCE = 2.0
+ERROR_THRESHOLD = 0.05
+DECREASE = 0.5
+
+
+def is_overload(error):
+    """上限を下げるべき失敗（429・タイムアウト）か"""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    return isinstance(error, (TimeoutError, asyncio.TimeoutError)) or any(
+        name in ("RateLimitError", "APITimeoutError") for name in (c.__name__ for c in type(error).__mro__)
+    )
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(q / 100 * len(ordered))) - 1)]
+
+
+class AdaptiveConcurrency:
+    def __init__(self, name, initial=5, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT, window=WINDOW,
+                 latency_tolerance=LATENCY_TOLERANCE, error_threshold=ERROR_THRESHOLD,
+                 decrease=DECREASE, telemetry=None):
+        self.name = name
+        self.limit = float(max(min_limit, min(max_limit, initial)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.error_threshold = error_threshold
+        self.decrease = decrease
+        self.telemetry = telemetry
+        self.samples = deque(maxlen=window)
+        self.baseline = None
+        self.in_flight = 0
+        self.start = time.perf_counter()
+        self.last_decrease = -math.inf
+        self.history = [{"t": 0.0, "limit": self.current, "reason": "start"}]
+        self.condition = threading.Condition()
+        self._async_conditions = {}
+
+    @property
+    def current(self):
+        """今の同時実行数の上限（整数）"""
+        return int(self.limit)
+
+    # ===== 上限の調整 =====
+    def _window_stats(self):
+        latencies = [latency for latency, ok in self.samples if ok]
+        errors = sum(not ok for _, ok in self.samples)
+        p95 = percentile(latencies, 95) if latencies else None
+        p50 = percentile(latencies, 50) if latencies else None
+        return p50, p95, errors / len(self.samples) if self.samples else 0.0
+
+    def _set_limit(self, limit, reason, p95=None, error_rate=None):
+        before = self.current
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+        if self.current == before and reason == "increase":
+            return
+        entry = {"t": round(time.perf_counter() - self.start, 3), "limit": self.current, "reason": reason}
+        self.history.append(entry)
+        if self.telemetry is not None:
+            self.telemetry.record_event(
+                "concurrency", stage=self.name, limit=self.current, reason=reason, in_flight=self.in_flight,
+                p95=None if p95 is None else round(p95, 4),
+                error_rate=None if error_rate is None else round(error_rate, 3),
+            )
+
+    def on_success(self, latency, saturated):
+        with self.condition:
+            self.samples.append((latency, True))
+            p50, p95, error_rate = self._window_stats()
+            if len(self.samples) == self.samples.maxlen:
+                self.baseline = p95 if self.baseline is None else min(self.baseline, p95)
+            healthy = error_rate <= self.error_threshold and (
+                self.baseline is None or p95 <= self.baseline * self.latency_tolerance)
+            # 上限まで使っていないときに増やしても効果がわからないので増やさない
+            if healthy and saturated:
+                self._set_limit(self.limit + 1 / self.limit, "increase", p95, error_rate)
+            self.condition.notify_all()
+
+    def on_error(self, error):
+        with self.condition:
+            self.samples.append((None, False))
+            if is_overload(error):
+                p50, p95, error_rate = self._window_stats()
+                now = time.perf_counter()
+                if now - self.last_decrease >= (p50 or 0.0):
+                    self.last_decrease = now
+                    reason = "429" if getattr(error, "status_code", None) == 429 else "timeout"
+                    self._set_limit(self.limit * self.decrease, reason, p95, error_rate)
+            self.condition.notify_all()
+
+    # ===== 枠の確保 =====
+    def acquire(self):
+        """空きができるまで待って枠を1つ取る。上限まで使ったかどうかを返す"""
+        with self.condition:
+            while self.in_flight >= self.current:
+                self.condition.wait()
+            self.in_flight += 1
+            return self.in_flight >= self.current
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        condition = self._async_conditions.setdefault(loop, asyncio.Condition())
+        async with condition:
+            while self.in_flight >= self.current:
+                await condition.wait()
+            with self.condition:
+                self.in_flight += 1
+                return self.in_flight >= self.current
+
+    async def release_async(self):
+        self.release()
+        condition = self._async_conditions[asyncio.get_running_loop()]
+        async with condition:
+            condition.notify_all()
+
+    # ===== ラップ =====
+    def wrap_function(self, fn):
+        """関数（同期・非同期）の呼び出しを上限つきにし、結果で上限を調整する"""
+        if inspect.iscoroutinefunction(fn):
+            async def async_wrapper(*args, **kwargs):
+                saturated = await self.acquire_async()
+                start = time.perf_counter()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception as e:
+                    self.on_error(e)
+                    raise
+                finally:
+                    await self.release_async()
+                self.on_success(time.perf_counter() - start, saturated)
+                return result
+
+            return async_wrapper
+
+        def wrapper(*args, **kwargs):
+            saturated = self.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.on_error(e)
+                raise
+            finally:
+                self.release()
+            self.on_success(time.perf_counter() - start, saturated)
+            return result
+
+        return wrapper
+
+    def wrap(self, client, path="chat.completions.create"):
+        """client の path（chat.completions.create など）を上限つきにしたクライアントを返す"""
+        return _ControlledResource(client, self, path)
+
+    def report(self):
+        p50, p95, error_rate = self._window_stats()
+        latency = f"p95 {p95:.2f} 秒" if p95 is not None else "p95 -"
+        return (f"同時実行数（{self.name}）: {self.current}"
+                f"（{latency}・エラー率 {error_rate:.0%}・変更 {len(self.history) - 1} 回）")
+
+
+class _ControlledResource:
+    """OpenAI / AsyncOpenAI クライアントの代理。path の create だけを上限つきにする"""
+
+    def __init__(self, target, control, path, prefix=""):
+        self._target = target
+        self._control = control
+        self._path = path
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = f"{self._prefix}.{name}" if self._prefix else name
+        if path == self._path:
+            return self._control.wrap_function(attr)
+        if self._path.startswith(path + "."):
+            return _ControlledResource(attr, self._control, self._path, path)
+        if name == "with_options" and not self._prefix:
+            # 設定を変えたクライアントも同じ上限の下に置く（rate_limit.wrap が再試行を切るときなど）
+            return lambda **kwargs: _ControlledResource(attr(**kwargs), self._control, self._path)
+        return attr
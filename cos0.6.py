@@ -1,12 +1,19 @@
 import csv
 import os
 import random
-from json import loads
 from ragas.metrics import faithfulness, answer_relevancy
 from ragas import evaluate
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai_client import get_openai_client, share_with_ragas, connection_report
+from rate_limit import get_rate_limiter
+from telemetry import get_session_telemetry
+from run_store import get_run_store
+from cancellation import cancel_session_work, renew_session_token, watch_uploaded_file
+from metric_cache import get_metric_cache
+from pipeline import VariantPipeline
+from quiz_pipeline import question_response_format, stream_questions, render_question, AdaptiveVariantCount
+from quiz_pipeline import select_context
 from datasets import Dataset
 import pdfplumber
 import numpy as np
@@ -38,7 +45,24 @@ def load_explanations_from_csv(filename="Book1.csv"):
 # ===== OpenAI API キーの読み込み =====
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# HTTP 接続プールはプロセスで共有する（再実行のたびに接続を張り直さない）
+client = get_openai_client(api_key)
+
+# ===== 計測（処理時間・トークン数・コスト） =====
+telemetry = get_session_telemetry(st.session_state)
+telemetry.attach_sidebar()
+# 全セッション・全プロセスで共有する API のレート制限（429 はバックオフして再試行）
+client = get_rate_limiter().wrap(client, telemetry=telemetry)
+client = telemetry.instrument(client)
+evaluate = share_with_ragas(evaluate)
+evaluate = telemetry.instrument_evaluate(evaluate)
+
+# 同じ問題・正解・根拠の評価結果は永続キャッシュを使う
+metric_cache = get_metric_cache()
+evaluate = metric_cache.wrap_evaluate(evaluate)
+
+# 生成した問題はプロンプト・パラメータと一緒に保存する（replay.py で指標を計算し直せる）
+run_store = get_run_store()
 
 # ===== Streamlit UI =====
 st.title("兵庫学検定試験対策ツール（5問同時出題＋平均コサイン類似度付き）")
@@ -47,6 +71,7 @@ st.title("兵庫学検定試験対策ツール（5問同時出題＋平均コサ
 uploaded_file = st.file_uploader("クイズに使うPDFファイルを選んでください", type=["pdf"])
 
 if uploaded_file is not None:
+    watch_uploaded_file(st.session_state, uploaded_file)
     pdf_path = "uploaded.pdf"
     with open(pdf_path, "wb") as f:
         f.write(uploaded_file.read())
@@ -62,53 +87,62 @@ if "explanations" in st.session_state and st.session_state.explanations:
     if "generated_answers" not in st.session_state or st.session_state.get("next_question", False):
         QuestionNum = random.randint(0, len(explanations) - 1)
         SelectedQuestion = explanations[QuestionNum]
+        telemetry.new_question()
+        cancel_token = renew_session_token(st.session_state, telemetry)
 
         NUM_VARIANTS = 15
+        QUESTIONS_PER_CALL = 1  # 1回の呼び出しで作る問題数（QuestionSet スキーマ）
+        ADAPTIVE_VARIANTS = False  # True: 平均類似度の信頼区間が十分狭くなった時点で生成を打ち切る
         generated_answers = []
 
-        for i in range(NUM_VARIANTS):
-            response = client.chat.completions.create(
-                model="gpt-4.1",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "あなたはクイズの出題者です。以下の文から四択問題を作成してください。"
-                            "本文内容に基づいた問題にしてください。"
-                            "出力はJSON形式で返してください。"
-                        )
-                    },
-                    {"role": "user", "content": SelectedQuestion},
-                ],
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "QuestionData",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "Question": {"type": "string"},
-                                "Choice1": {"type": "string"},
-                                "Choice2": {"type": "string"},
-                                "Choice3": {"type": "string"},
-                                "Choice4": {"type": "string"},
-                                "CorrectAnswer": {"type": "number"},
-                            },
-                            "required": ["Question", "Choice1", "Choice2", "Choice3", "Choice4", "CorrectAnswer"],
-                            "additionalProperties": False,
-                        },
-                        "strict": True,
-                    },
-                },
-                temperature=0.6
-            )
+        # 生成できた問題から順に表示する（一覧表示の前に消す）
+        progress_area = st.empty()
+        progress = progress_area.container()
 
-            output_text = response.choices[0].message.content
+        # 適応モードでは生成1回ごとに埋め込みを取り、類似度の統計を更新する
+        adaptive = AdaptiveVariantCount(NUM_VARIANTS, QUESTIONS_PER_CALL) if ADAPTIVE_VARIANTS else None
+        # 固定数のときは、生成できた問題から順に裏で埋め込みを取る（数問ずつまとめて1リクエスト）
+        embedding_pipeline = (
+            VariantPipeline(SelectedQuestion, client, telemetry=telemetry, cancel=cancel_token) if adaptive is None else None
+        )
+
+        run = run_store.start_run(os.path.basename(__file__), SelectedQuestion, QuestionNum)
+        for i in range(0, NUM_VARIANTS, QUESTIONS_PER_CALL):
             try:
-                data = loads(output_text)
-                generated_answers.append(data)
+                for data in stream_questions(
+                    client,
+                    telemetry=telemetry,
+                    run=run,
+                    cancel=cancel_token,
+                    model="gpt-4.1",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": (
+                                "あなたはクイズの出題者です。以下の文から四択問題を作成してください。"
+                                "本文内容に基づいた問題にしてください。"
+                                "出力はJSON形式で返してください。"
+                            )
+                        },
+                        {"role": "user", "content": SelectedQuestion},
+                    ],
+                    response_format=question_response_format(min(QUESTIONS_PER_CALL, NUM_VARIANTS - i)),
+                    temperature=0.6,
+                ):
+                    generated_answers.append(data)
+                    if embedding_pipeline is not None:
+                        embedding_pipeline.submit(data)
+                    render_question(progress, len(generated_answers), data)
+                    telemetry.first_result()
             except Exception as e:
                 st.error(f"JSON読み込み失敗: {e}")
+            if adaptive is not None and adaptive.update(client, generated_answers):
+                break
+
+        if adaptive is not None:
+            telemetry.record_event("adaptive_variants", variants=adaptive.stats.n,
+                                   calls_saved=adaptive.calls_saved())
+            st.sidebar.caption(adaptive.report())
 
         st.session_state.generated_answers = generated_answers
         st.session_state.explanation = SelectedQuestion
@@ -116,17 +150,13 @@ if "explanations" in st.session_state and st.session_state.explanations:
         st.session_state.next_question = False
 
         # ===== コサイン類似度計算 =====
-        all_correct_answers = [
-            d[f"Choice{d['CorrectAnswer']}"] for d in generated_answers
-        ]
-
         def cosine_similarity(a, b):
             return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
-        embeddings = [
-            client.embeddings.create(input=ans, model="text-embedding-3-small").data[0].embedding
-            for ans in all_correct_answers
-        ]
+        if adaptive is not None:
+            embeddings = adaptive.embeddings
+        else:
+            embeddings = embedding_pipeline.close().embeddings
 
         n = len(embeddings)
         similarities = [
@@ -135,13 +165,18 @@ if "explanations" in st.session_state and st.session_state.explanations:
         ]
         avg_cosine_similarity = np.mean(similarities)
         st.session_state.avg_cosine_similarity = avg_cosine_similarity
+        progress.caption(f"平均コサイン類似度: {st.session_state.avg_cosine_similarity:.4f}")
+
+        progress_area.empty()
 
     # ===== RAGAS評価（最初の1問で代表評価） =====
     sample = st.session_state.generated_answers[0]
+    # 問題・正解に近い文だけを根拠として渡す（評価モデルの入力トークンを減らす）
+    trimmed_context = select_context(client, sample, st.session_state.selected_question, telemetry=telemetry)
     data = Dataset.from_dict({
         "question": [sample["Question"]],
         "answer": [sample[f"Choice{sample['CorrectAnswer']}"]],
-        "contexts": [[st.session_state.selected_question]],
+        "contexts": [[trimmed_context]],
     })
 
     # Faithfulness のみ評価
@@ -168,10 +203,14 @@ if "explanations" in st.session_state and st.session_state.explanations:
     #st.write(f"Answer Relevancyスコア: {st.session_state.answer_relevance}")
     st.write(f"平均コサイン類似度: {st.session_state.avg_cosine_similarity}")
 
-    if st.button("次の問題へ"):
+    # 取り消しは on_click で行う（ボタンの処理より先に、スクリプト本体の再実行の前に呼ばれる）
+    if st.button("次の問題へ", on_click=cancel_session_work, args=(st.session_state, "next_question")):
         st.session_state.next_question = True
         st.session_state.pop("generated_answers", None)
         st.session_state.pop("avg_cosine_similarity", None)
         st.rerun()
 else:
     st.info("まずはPDFファイルをアップロードしてください。")
+
+st.sidebar.caption(metric_cache.report())
+st.sidebar.caption(connection_report())
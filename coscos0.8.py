@@ -1,13 +1,19 @@
 import csv
 import os
 import random
-from json import loads
 from ragas.metrics import faithfulness, answer_relevancy
 from ragas import evaluate
 import streamlit as st
 from dotenv import load_dotenv
 from openai import OpenAI
-from datasets import Dataset
+from openai_client import get_openai_client, share_with_ragas, connection_report
+from rate_limit import get_rate_limiter
+from telemetry import get_session_telemetry
+from run_store import get_run_store
+from cancellation import cancel_session_work, renew_session_token, watch_uploaded_file
+from metric_cache import get_metric_cache
+from quiz_pipeline import question_response_format, stream_questions, render_question, select_context
+from quiz_pipeline import score_table
 import pdfplumber
 import numpy as np
 
@@ -39,7 +45,24 @@ def load_explanations_from_csv(filename="Book1.csv"):
 # ===== OpenAI API キーの読み込み =====
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# HTTP 接続プールはプロセスで共有する（再実行のたびに接続を張り直さない）
+client = get_openai_client(api_key)
+
+# ===== 計測（処理時間・トークン数・コスト） =====
+telemetry = get_session_telemetry(st.session_state)
+telemetry.attach_sidebar()
+# 全セッション・全プロセスで共有する API のレート制限（429 はバックオフして再試行）
+client = get_rate_limiter().wrap(client, telemetry=telemetry)
+client = telemetry.instrument(client)
+evaluate = share_with_ragas(evaluate)
+evaluate = telemetry.instrument_evaluate(evaluate)
+
+# 同じ問題・正解・根拠の評価結果は永続キャッシュを使う
+metric_cache = get_metric_cache()
+evaluate = metric_cache.wrap_evaluate(evaluate)
+
+# 生成した問題はプロンプト・パラメータと一緒に保存する（replay.py で指標を計算し直せる）
+run_store = get_run_store()
 
 
 # ===== 解説文の意味補正 =====
@@ -71,6 +94,7 @@ st.title("兵庫学検定試験対策ツール（意味補正＋5問同時出題
 uploaded_file = st.file_uploader("クイズに使うPDFファイルを選んでください", type=["pdf"])
 
 if uploaded_file is not None:
+    watch_uploaded_file(st.session_state, uploaded_file)
     pdf_path = "uploaded.pdf"
     with open(pdf_path, "wb") as f:
         f.write(uploaded_file.read())
@@ -88,10 +112,13 @@ if "explanations" in st.session_state and st.session_state.explanations:
         # 1つ選択
         QuestionNum = random.randint(0, len(explanations) - 1)
         SelectedQuestion = explanations[QuestionNum]
+        telemetry.new_question()
+        cancel_token = renew_session_token(st.session_state, telemetry)
 
         # ===== Step 1: 意味の通る解説文にリライト =====
         st.write("解説文を整えています")
-        CleanedExplanation = refine_explanation(SelectedQuestion, client)
+        with telemetry.stage("refinement"):
+            CleanedExplanation = refine_explanation(SelectedQuestion, client)
 
         # ===== Step 2: 5問同時生成 =====
         prompt = f"""
@@ -102,33 +129,32 @@ if "explanations" in st.session_state and st.session_state.explanations:
 --- 解説文 ---
 {CleanedExplanation}
 
-出力形式（JSON配列）:
-[
-  {{
-    "Question": "～",
-    "Choice1": "～",
-    "Choice2": "～",
-    "Choice3": "～",
-    "Choice4": "～",
-    "CorrectAnswer": 1,
-    "Explanation": "～"
-  }},
-  ...
-]
+出力は指定された JSON Schema（QuestionSet）に従ってください。
 """
 
-        response = client.chat.completions.create(
-            model="gpt-4.1",
-            messages=[
-                {"role": "system", "content": "あなたは正確で教育的なクイズ作成AIです。"},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.8,
-        )
+        # 1問閉じるごとに表示する（一覧表示の前に消す）
+        progress_area = st.empty()
+        progress = progress_area.container()
+        generated_answers = []
 
+        run = run_store.start_run(os.path.basename(__file__), CleanedExplanation, QuestionNum)
         try:
-            output_json = response.choices[0].message.content
-            generated_answers = loads(output_json)
+            for data in stream_questions(
+                client,
+                telemetry=telemetry,
+                run=run,
+                cancel=cancel_token,
+                model="gpt-4.1",
+                messages=[
+                    {"role": "system", "content": "あなたは正確で教育的なクイズ作成AIです。"},
+                    {"role": "user", "content": prompt},
+                ],
+                response_format=question_response_format(5, with_explanation=True),
+                temperature=0.8,
+            ):
+                generated_answers.append(data)
+                render_question(progress, len(generated_answers), data)
+                telemetry.first_result()
         except Exception as e:
             st.error(f"JSON解析エラー: {e}")
             st.stop()
@@ -155,20 +181,21 @@ if "explanations" in st.session_state and st.session_state.explanations:
         ]
         avg_cosine_similarity = np.mean(similarities)
         st.session_state.avg_cosine_similarity = avg_cosine_similarity
+        progress.caption(f"平均コサイン類似度: {avg_cosine_similarity:.4f}")
 
         # ===== RAGAS評価 =====
         sample = generated_answers[0]
-        data = Dataset.from_dict({
-            "question": [sample["Question"]],
-            "answer": [sample[f"Choice{sample['CorrectAnswer']}"]],
-            "contexts": [[CleanedExplanation]],
-        })
+        # 問題・正解に近い文だけを根拠として渡す（評価モデルの入力トークンを減らす）
+        trimmed_context = select_context(client, sample, CleanedExplanation, telemetry=telemetry)
+        # Faithfulness と Answer relevancy を1回の evaluate でまとめて（並行に）評価
+        scores = score_table(
+            [sample], [trimmed_context], [faithfulness, answer_relevancy], evaluate_fn=evaluate
+        )[0]
 
-        result1 = evaluate(data, metrics=[faithfulness])
-        result2 = evaluate(data, metrics=[answer_relevancy])
+        st.session_state.faithfulness = scores["faithfulness"]
+        st.session_state.answer_relevance = scores["answer_relevancy"]
 
-        st.session_state.faithfulness = result1["faithfulness"][0]
-        st.session_state.answer_relevance = result2["answer_relevancy"][0]
+        progress_area.empty()
 
     # ===== 出力 =====
     st.subheader("整えた解説文")
@@ -193,7 +220,8 @@ if "explanations" in st.session_state and st.session_state.explanations:
     st.write(f"Answer Relevancyスコア: {st.session_state.answer_relevance}")
     st.write(f"平均コサイン類似度（小さいほど多様性が高い）: {st.session_state.avg_cosine_similarity:.4f}")
 
-    if st.button("次の問題へ"):
+    # 取り消しは on_click で行う（ボタンの処理より先に、スクリプト本体の再実行の前に呼ばれる）
+    if st.button("次の問題へ", on_click=cancel_session_work, args=(st.session_state, "next_question")):
         st.session_state.next_question = True
         st.session_state.pop("generated_answers", None)
         st.session_state.pop("avg_cosine_similarity", None)
@@ -201,3 +229,6 @@ if "explanations" in st.session_state and st.session_state.explanations:
 
 else:
     st.info("まずはPDFファイルをアップロードしてください。")
+
+st.sidebar.caption(metric_cache.report())
+st.sidebar.caption(connection_report())
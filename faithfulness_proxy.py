@@ -0,0 +1,198 @@
+"""埋め込みから求める Faithfulness の代理スコア
+
+RAGAS の faithfulness は1問ごとに何回も LLM を呼ぶので、まず埋め込みだけで安く見積もる。
+特徴量は
+- 正解の選択肢と本文のコサイン類似度
+- 問題文と本文のコサイン類似度
+- 正解の選択肢と本文の各文のコサイン類似度の最大値
+の3つで、過去に RAGAS で評価した結果（faithfulness_calibration.db）にロジスティック回帰で合わせる。
+代理スコアが判断のつかない帯（既定 0.3〜0.7）に入った問題と、較正データが少ないうちは
+すべて RAGAS で評価し、その結果を較正データに追加する。
+
+帯の外で代理スコアだけで決めた問題も SPOT_CHECK_RATE（既定 10%）の割合で無作為に RAGAS で評価し、
+そのときの代理スコア（まだ較正に使っていない問題への予測）と RAGAS の判定の一致率を report に出す。
+較正データの上で一致率を計算すると、学習に使った問題で、しかも帯の中の問題だけを見ることになるため。
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+
+from quiz_pipeline import EMBEDDING_MODEL, cached_embeddings, split_sentences
+
+CALIBRATION_DB = os.getenv("FAITHFULNESS_CALIBRATION_DB", "faithfulness_calibration.db")
+
+FEATURES = ["answer_context", "question_context", "answer_best_sentence"]
+
+# 代理スコアで決められる問題のうち、一致率を測るために RAGAS でも評価する割合
+SPOT_CHECK_RATE = 0.1
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=float)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def fit_logistic(X, y, l2=1e-2, iterations=50):
+    """0〜1 の連続値 y に合わせるロジスティック回帰（ニュートン法）。戻り値は [切片, 係数...]"""
+    X = np.hstack([np.ones((len(X), 1)), np.asarray(X, dtype=float)])
+    y = np.asarray(y, dtype=float)
+    w = np.zeros(X.shape[1])
+    penalty = l2 * np.eye(X.shape[1])
+    penalty[0, 0] = 0.0
+    for _ in range(iterations):
+        p = _sigmoid(X @ w)
+        gradient = X.T @ (p - y) + penalty @ w
+        hessian = X.T @ (X * (p * (1 - p))[:, None]) + penalty
+        step = np.linalg.solve(hessian + 1e-9 * np.eye(len(w)), gradient)
+        w -= step
+        if np.abs(step).max() < 1e-6:
+            break
+    return w
+
+
+class FaithfulnessProxy:
+    def __init__(self, path=CALIBRATION_DB, band=(0.3, 0.7), min_samples=20, spot_check_rate=SPOT_CHECK_RATE):
+        self.path = path
+        self.band = band
+        self.min_samples = min_samples
+        self.spot_check_rate = spot_check_rate
+        self.weights = None
+        self.samples = 0
+        self.avoided = 0
+        self.escalated = 0
+        self.spot_checked = 0
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS calibration (
+                    answer_context REAL, question_context REAL, answer_best_sentence REAL,
+                    ragas_faithfulness REAL, created REAL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS spot_checks (
+                    predicted REAL, ragas_faithfulness REAL, created REAL
+                )
+            """)
+        self.calibrate()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _load(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(FEATURES)}, ragas_faithfulness FROM calibration "
+                "WHERE ragas_faithfulness IS NOT NULL"
+            ).fetchall()
+        data = np.asarray(rows, dtype=float).reshape(-1, len(FEATURES) + 1)
+        return data[:, :-1], data[:, -1]
+
+    # ===== 較正 =====
+    def calibrate(self):
+        """保存済みの RAGAS の結果に合わせ直す（件数が min_samples 未満なら未較正のまま）"""
+        X, y = self._load()
+        with self.lock:
+            self.samples = len(y)
+            self.weights = fit_logistic(X, y) if len(y) >= self.min_samples else None
+
+    def record(self, features, ragas_score, predicted=None):
+        """RAGAS で評価した1問を較正データに追加して合わせ直す
+
+        predicted（評価前に出した代理スコア）が帯の外なら抜き取り検査の結果なので、一致率の記録にも残す。
+        """
+        if ragas_score is None or np.isnan(ragas_score):
+            return
+        now = time.time()
+        with self._connect() as conn:
+            if predicted is not None and self._confident(predicted):
+                conn.execute("INSERT INTO spot_checks VALUES (?, ?, ?)",
+                             (float(predicted), float(ragas_score), now))
+            conn.execute(
+                "INSERT INTO calibration VALUES (?, ?, ?, ?, ?)",
+                (*map(float, features), float(ragas_score), now),
+            )
+        self.calibrate()
+
+    def agreement(self):
+        """抜き取り検査した問題で、0.5 を境にした代理スコアの判定が RAGAS と一致した割合と件数"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT predicted, ragas_faithfulness FROM spot_checks").fetchall()
+        if not rows:
+            return None, 0
+        checks = np.asarray(rows, dtype=float)
+        return float(((checks[:, 0] >= 0.5) == (checks[:, 1] >= 0.5)).mean()), len(rows)
+
+    # ===== 代理スコア =====
+    def features(self, client, questions, answer_embeddings, context, model=EMBEDDING_MODEL):
+        """問題ごとの特徴量（n × 3）。本文・各文・問題文の埋め込みはキャッシュになければ1リクエストでまとめて取る"""
+        if not questions:
+            return np.zeros((0, len(FEATURES)))
+        sentences = split_sentences(context)
+        texts = [context] + sentences + [q["Question"] for q in questions]
+        vectors = _normalize(cached_embeddings(client, texts, model))
+        context_vec = vectors[0]
+        sentence_vecs = vectors[1:1 + len(sentences)]
+        question_vecs = vectors[1 + len(sentences):]
+        answer_vecs = _normalize(answer_embeddings)
+        return np.column_stack([
+            answer_vecs @ context_vec,
+            question_vecs @ context_vec,
+            (answer_vecs @ sentence_vecs.T).max(axis=1),
+        ])
+
+    def _predict(self, features):
+        X = np.hstack([np.ones((len(features), 1)), np.asarray(features, dtype=float)])
+        return _sigmoid(X @ self.weights)
+
+    def predict(self, features):
+        """代理スコア（未較正なら nan）"""
+        if self.weights is None:
+            return np.full(len(features), np.nan)
+        return self._predict(features)
+
+    def _in_band(self, predicted):
+        low, high = self.band
+        return (predicted >= low) & (predicted <= high)
+
+    def _confident(self, predicted):
+        return not (np.isnan(predicted) or self._in_band(predicted))
+
+    def needs_ragas(self, predicted):
+        """RAGAS で評価すべきか（未較正・判断のつかない帯・抜き取り検査）。回避・実行の回数も数える
+
+        RAGAS で評価した問題は record(features, score, predicted) で記録する。
+        """
+        with self.lock:
+            if not self._confident(predicted):
+                self.escalated += 1
+                return True
+            if self.rng.random() < self.spot_check_rate:
+                self.spot_checked += 1
+                return True
+            self.avoided += 1
+            return False
+
+    def report(self):
+        agreement, checks = self.agreement()
+        agreement_text = "—" if agreement is None else f"{agreement:.0%}（抜き取り {checks} 件）"
+        return (f"Faithfulness 代理スコア: RAGAS {self.avoided} 回回避 / {self.escalated} 回実行"
+                f"・抜き取り {self.spot_checked} 回（較正 {self.samples} 件・一致率 {agreement_text}）")
+
+
+@lru_cache(maxsize=None)
+def get_faithfulness_proxy(path=CALIBRATION_DB):
+    """プロセス内で共有する代理スコア（Streamlit の再実行ごとに作り直さない）"""
+    return FaithfulnessProxy(path)
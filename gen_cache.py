@@ -0,0 +1,234 @@
+"""問題生成（chat.completions）の永続キャッシュ
+
+キーは (model, messages のハッシュ, response_format のハッシュ, temperature, seed)。
+- temperature=0 かつ seed 指定あり: 自動でキャッシュ
+- temperature>0: all_temperatures=True（または環境変数 GENERATION_CACHE=all）のときだけ使う。
+
+どの温度でも、同じリクエストの k 回目の呼び出しは k 番目の保存済み応答に対応させる。
+1回の生成（wrap したクライアント）の中の 15 問はそれぞれ別の API 呼び出しのままで
+（temperature=0 でも1つの応答を 15 回使い回さないので、類似度は実際の値になる）、
+15 問生成を再実行したときは前回の 15 問がそのまま再現される。
+
+キャッシュは SQLite（既定 generation_cache.db）に保存され、アプリを再起動しても残る。
+"""
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+
+GENERATION_CACHE_DB = os.getenv("GENERATION_CACHE_DB", "generation_cache.db")
+
+
+def _hash(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def cache_key(model, messages, response_format, temperature, seed, slot=0, n=1):
+    return _hash({
+        "model": model,
+        "messages": _hash(messages),
+        "schema": _hash(response_format),
+        "temperature": None if temperature is None else float(temperature),
+        "seed": seed,
+        "n": n,
+        "slot": slot,
+    })
+
+
+def _to_json(response):
+    if hasattr(response, "model_dump_json"):
+        return response.model_dump_json()
+    return json.dumps(response, ensure_ascii=False)
+
+
+def _from_json(text):
+    try:
+        from openai.types.chat import ChatCompletion
+    except ImportError:
+        return json.loads(text)
+    return ChatCompletion.model_validate_json(text)
+
+
+def _content(completion):
+    if isinstance(completion, dict):
+        return completion["choices"][0]["message"]["content"]
+    return completion.choices[0].message.content
+
+
+def _replay_chunks(completion):
+    """保存済みの応答を stream=True のチャンクと同じ形で返す"""
+    yield SimpleNamespace(
+        choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=_content(completion)),
+                                 finish_reason="stop")],
+        usage=None,
+    )
+
+
+class _CachedCompletions:
+    def __init__(self, completions, cache, is_async):
+        self._completions = completions
+        self._cache = cache
+        self._is_async = is_async
+        self._occurrences = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+    def _slot(self, base_key):
+        with self._lock:
+            slot = self._occurrences.get(base_key, 0)
+            self._occurrences[base_key] = slot + 1
+        return slot
+
+    def create(self, **kwargs):
+        if not self._cache.applies(kwargs) or (kwargs.get("stream") and self._is_async):
+            return self._completions.create(**kwargs)
+
+        temperature = kwargs.get("temperature", 1.0)
+        base_key = cache_key(kwargs.get("model"), kwargs.get("messages"), kwargs.get("response_format"),
+                             temperature, kwargs.get("seed"), n=kwargs.get("n", 1))
+        key = cache_key(kwargs.get("model"), kwargs.get("messages"), kwargs.get("response_format"),
+                        temperature, kwargs.get("seed"), self._slot(base_key),
+                        kwargs.get("n", 1))
+        cached = self._cache.get(key)
+        if kwargs.get("stream"):
+            if cached is not None:
+                return _replay_chunks(cached)
+            return self._record_stream(key, kwargs, self._completions.create(**kwargs))
+        if cached is not None:
+            if self._is_async:
+                async def _hit():
+                    return cached
+                return _hit()
+            return cached
+
+        result = self._completions.create(**kwargs)
+        if inspect.isawaitable(result):
+            async def _miss():
+                response = await result
+                self._cache.put(key, kwargs, response)
+                return response
+            return _miss()
+        self._cache.put(key, kwargs, result)
+        return result
+
+    def _record_stream(self, key, kwargs, stream):
+        """チャンクをそのまま流しつつ本文を集め、最後まで読めたら1件の応答として保存"""
+        parts = []
+        meta = {}
+        for chunk in stream:
+            meta = {"id": chunk.id, "created": chunk.created, "model": chunk.model}
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+            yield chunk
+        self._cache.put(key, kwargs, {
+            **meta,
+            "object": "chat.completion",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(parts)}}],
+        })
+
+
+class _CachedChat:
+    def __init__(self, chat, cache, is_async):
+        self._chat = chat
+        self.completions = _CachedCompletions(chat.completions, cache, is_async)
+
+    def __getattr__(self, name):
+        return getattr(self._chat, name)
+
+
+class _CachedClient:
+    def __init__(self, client, cache, is_async):
+        self._client = client
+        self.chat = _CachedChat(client.chat, cache, is_async)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class GenerationCache:
+    def __init__(self, path=GENERATION_CACHE_DB, all_temperatures=None):
+        if all_temperatures is None:
+            all_temperatures = os.getenv("GENERATION_CACHE") == "all"
+        self.path = path
+        self.all_temperatures = all_temperatures
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS generation_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT, temperature REAL, seed INTEGER,
+                    response_json TEXT, created REAL, hits INTEGER DEFAULT 0
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def applies(self, kwargs):
+        """このリクエストをキャッシュ対象にするか"""
+        if self.all_temperatures:
+            return True
+        return kwargs.get("temperature", 1.0) == 0 and kwargs.get("seed") is not None
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT response_json FROM generation_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE generation_cache SET hits = hits + 1 WHERE key = ?", (key,))
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return _from_json(row[0])
+
+    def put(self, key, kwargs, response):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO generation_cache "
+                "(key, model, temperature, seed, response_json, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kwargs.get("model"), kwargs.get("temperature"), kwargs.get("seed"),
+                 _to_json(response), time.time()),
+            )
+
+    def wrap(self, client, is_async=False):
+        """chat.completions.create をキャッシュ経由にしたクライアントを返す（AsyncOpenAI は is_async=True）"""
+        return _CachedClient(client, self, is_async)
+
+    # ===== ヒット率 =====
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        return f"生成キャッシュ: ヒット {self.hits} / {self.hits + self.misses} 件（{self.hit_rate():.0%}）"
+
+    def stored_stats(self):
+        """DB に保存された件数と累計ヒット数（再起動をまたいだ集計）"""
+        with self._connect() as conn:
+            entries, total_hits = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM generation_cache"
+            ).fetchone()
+        return {"entries": entries, "hits": total_hits}
+
+
+@lru_cache(maxsize=None)
+def get_generation_cache(path=GENERATION_CACHE_DB):
+    """プロセス内で共有するキャッシュ（Streamlit の再実行ごとに作り直さない）"""
+    return GenerationCache(path)
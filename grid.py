@@ -0,0 +1,131 @@
+"""温度 × 段落 × 生成数 のグリッドと結果 CSV（sweep.py / batch_sweep.py 共通）
+
+API クライアントやワーカープールに依存しないので、batch_sweep.py は sweep.py 一式を読み込まずに使える。
+"""
+import csv
+import itertools
+import random
+
+import quiz_pipeline as qp
+from metrics import available_metrics
+
+RESULT_FIELDS = [
+    "temperature", "paragraph_index", "num_variants", "num_generated", "run_id",
+    "avg_cosine_similarity", "num_evaluated", "avg_faithfulness", "avg_answer_relevancy",
+    "avg_bert_score", "avg_lexical_diversity",
+    "prompt_tokens", "completion_tokens", "cost_usd", "cache_hits", "metric_cache_hits",
+    "calls_saved", "final_concurrency", "hedges", "connection_reuse", "elapsed_sec", "error",
+]
+# 指標名と結果の列名が違うもの（それ以外は avg_<指標名>）
+METRIC_COLUMNS = {"cosine": "avg_cosine_similarity", "bertscore": "avg_bert_score"}
+
+# --generation-seed を指定しないとき、temperature=0 のセルにだけ送る seed（生成キャッシュを使うため）
+DEFAULT_GENERATION_SEED = 42
+
+
+def generation_seed(args, temperature):
+    """セルの生成 seed。指定がなければ temperature=0 のときだけ DEFAULT_GENERATION_SEED、負の値なら送らない
+
+    temperature>0 で常に同じ seed を送ると出力が似通い、測りたい多様性（類似度）が偏るため。
+    """
+    seed = getattr(args, "generation_seed", None)
+    if seed is None:
+        return DEFAULT_GENERATION_SEED if temperature == 0 else None
+    return seed if seed >= 0 else None
+
+
+def build_grid(explanations, args):
+    if args.paragraphs:
+        indices = args.paragraphs
+    else:
+        rng = random.Random(args.seed)
+        k = min(args.num_paragraphs, len(explanations))
+        indices = sorted(rng.sample(range(len(explanations)), k))
+
+    cells = []
+    for temperature, index, num_variants in itertools.product(
+        args.temperatures, indices, args.variants
+    ):
+        cells.append({
+            "temperature": temperature,
+            "paragraph_index": index,
+            "paragraph": explanations[index],
+            "num_variants": num_variants,
+            "model": args.model,
+            "concurrency": args.concurrency,
+            "metrics": args.metrics,
+            "cache": args.cache,
+            "metric_cache": getattr(args, "metric_cache", "on"),
+            "per_call": args.per_call,
+            # 呼び出しごとに qp.variant_seed でずらして送る
+            "generation_seed": generation_seed(args, temperature),
+            # 適応的な生成数（sweep.py のみ。batch_sweep.py では常に固定数）
+            "adaptive": getattr(args, "adaptive", False),
+            "batch_size": getattr(args, "batch_size", 3),
+            "min_variants": getattr(args, "min_variants", 5),
+            "ci_width": getattr(args, "ci_width", 0.1),
+            "dedupe_threshold": getattr(args, "dedupe_threshold", None),
+            # 生成 → 埋め込み → 評価 をパイプラインでつなぐ（適応モード・重複まとめでは使わない）
+            "pipeline": not getattr(args, "no_pipeline", True),
+            "adaptive_concurrency": getattr(args, "adaptive_concurrency", False),
+            "hedge_percentile": getattr(args, "hedge", None),
+            "hedge_budget": getattr(args, "hedge_budget", 0.1),
+        })
+    return cells
+
+
+def result_fields(rows=()):
+    """結果の列。register_metric で後から登録した指標の avg_<名前> 列と、行にだけある列も加える"""
+    fields = list(RESULT_FIELDS)
+    at = fields.index("prompt_tokens")
+    for metric in available_metrics():
+        column = METRIC_COLUMNS.get(metric, f"avg_{metric}")
+        if column not in fields:
+            fields.insert(at, column)
+            at += 1
+    for row in rows:
+        fields += [key for key in row if key not in fields]
+    return fields
+
+
+def write_results(rows, out_path):
+    rows = sorted(rows, key=lambda r: (r["temperature"], r["paragraph_index"], r["num_variants"]))
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=result_fields(rows))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def add_grid_arguments(parser):
+    """グリッド指定の引数（sweep.py / batch_sweep.py 共通）"""
+    parser.add_argument("--pdf", help="指定した場合は PDF を CSV に変換してから使う")
+    parser.add_argument("--split", choices=["paragraph", "page"], default="paragraph",
+                        help="PDF の分割単位（段落 or ページ）")
+    parser.add_argument("--csv", default="Book1.csv")
+    parser.add_argument("--temperatures", type=float, nargs="+",
+                        default=[0.0, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4])
+    parser.add_argument("--paragraphs", type=int, nargs="+",
+                        help="使用する段落番号（省略時はランダムに --num-paragraphs 件）")
+    parser.add_argument("--num-paragraphs", type=int, default=3)
+    parser.add_argument("--variants", type=int, nargs="+", default=[15])
+    parser.add_argument("--metrics", nargs="+", default=["cosine", "faithfulness"],
+                        choices=available_metrics())
+    parser.add_argument("--model", default=qp.GENERATION_MODEL)
+    parser.add_argument("--concurrency", type=int, default=5,
+                        help="セル内の同時生成リクエスト数")
+    parser.add_argument("--per-call", type=int, default=1,
+                        help="1回の生成リクエストで作る問題数（QuestionSet スキーマ）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--generation-seed", type=int, default=None,
+                        help="生成リクエストの seed。v 問目からの呼び出しには seed + v を送る"
+                             f"（既定: temperature=0 のセルだけ {DEFAULT_GENERATION_SEED} / 負の値なら指定しない）")
+    parser.add_argument("--cache", choices=["auto", "all", "off"], default="auto",
+                        help="生成キャッシュ（auto: temperature=0 かつ seed 指定ありのみ / all: 全温度）")
+    parser.add_argument("--metric-cache", choices=["on", "off"], default="on",
+                        help="評価結果キャッシュ（metric_cache.db）を使うか")
+
+
+def load_grid_explanations(args):
+    if args.pdf:
+        qp.pdf_to_csv(args.pdf, args.csv, split=args.split)
+    return qp.load_explanations_from_csv(args.csv)
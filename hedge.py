@@ -0,0 +1,142 @@
+"""生成リクエストのヘッジ（遅い呼び出しの複製）
+
+15 問を並列に生成しても、1回だけ遅い gpt-4.1 の呼び出しがあると問題セット全体がそれを待つ。
+HedgedCalls は、呼び出しが直近のレイテンシの PERCENTILE パーセンタイルを超えても返ってこないとき、
+同じリクエストをもう1本送り、先に返った方を使って残りをキャンセルする。
+
+- 直近 MIN_SAMPLES 件のレイテンシがたまるまではヘッジしない
+- 複製の数は元の呼び出しの BUDGET（既定 10%）までに抑える（余分なトークン消費の上限）
+- stream=True の呼び出しはヘッジしない（ヘッダーが届いた時点で返るので効果がない）
+- AsyncOpenAI 専用（負けた方のキャンセルに asyncio を使う）
+
+複製もレート制限（rate_limit.py）を通るよう、リミッターの外側に重ねる。
+
+使っているのは sweep.py --hedge と bench.py --hedge だけで、
+Streamlit アプリは対象外。アプリの生成は同期クライアントの stream=True 呼び出し
+（qp.stream_questions）1本で、最初の問題が届いた時点から表示が始まるため、ヘッジしても
+待ち時間は縮まらず、1回のクリックでトークンを二重に使うだけになる。
+
+    hedger = HedgedCalls(percentile=95, budget=0.1, telemetry=telemetry)
+    aclient = telemetry.instrument(hedger.wrap(get_rate_limiter().wrap(AsyncOpenAI(...))))
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+from concurrency import percentile
+
+PERCENTILE = 95
+BUDGET = 0.1
+MIN_SAMPLES = 10
+WINDOW = 100
+
+
+class HedgedCalls:
+    def __init__(self, percentile=PERCENTILE, budget=BUDGET, min_samples=MIN_SAMPLES, window=WINDOW,
+                 telemetry=None):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.telemetry = telemetry
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "hedges": 0, "hedge_wins": 0, "skipped": 0}
+
+    def hedge_delay(self):
+        """複製を送るまでの待ち時間（レイテンシがまだ十分たまっていなければ None）"""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return percentile(self.latencies, self.percentile)
+
+    def _observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def _take_budget(self):
+        with self.lock:
+            if self.stats["hedges"] + 1 > self.budget * self.stats["calls"]:
+                self.stats["skipped"] += 1
+                return False
+            self.stats["hedges"] += 1
+            return True
+
+    async def _timed(self, fn, args, kwargs):
+        start = time.perf_counter()
+        result = await fn(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    async def call(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) をヘッジつきで呼ぶ"""
+        if kwargs.get("stream"):
+            return await fn(*args, **kwargs)
+        with self.lock:
+            self.stats["calls"] += 1
+        delay = self.hedge_delay()
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(self._timed(fn, args, kwargs))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._take_budget():
+                result, latency = await primary
+                self._observe(latency)
+                return result
+
+            hedge = asyncio.ensure_future(self._timed(fn, args, kwargs))
+            tasks.add(hedge)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    result, latency = task.result()
+                    self._observe(latency)
+                    winner = "hedge" if task is hedge else "primary"
+                    if winner == "hedge":
+                        # 遅かった元の呼び出しも（少なくともここまでかかったとして）残し、基準が下がり続けないようにする
+                        self._observe(time.perf_counter() - start)
+                        with self.lock:
+                            self.stats["hedge_wins"] += 1
+                    if self.telemetry is not None:
+                        self.telemetry.record_event("hedge", model=kwargs.get("model"), winner=winner,
+                                                    delay=round(delay, 4), latency=round(latency, 4))
+                    return result
+            raise error
+        finally:
+            # 負けた方（呼び出し元がキャンセルされたときは両方）を止める
+            for task in tasks:
+                task.cancel()
+
+    def wrap(self, client, path="chat.completions.create"):
+        """AsyncOpenAI の path（既定は生成）をヘッジつきにしたクライアントを返す"""
+        return _HedgedResource(client, self, path)
+
+    def report(self):
+        s = self.stats
+        return (f"ヘッジ: {s['calls']} 件中 {s['hedges']} 件を複製（うち {s['hedge_wins']} 件が先着）"
+                f"・予算切れ {s['skipped']} 件")
+
+
+class _HedgedResource:
+    """AsyncOpenAI クライアントの代理。path の create だけをヘッジつきにする"""
+
+    def __init__(self, target, hedger, path, prefix=""):
+        self._target = target
+        self._hedger = hedger
+        self._path = path
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = f"{self._prefix}.{name}" if self._prefix else name
+        if path == self._path:
+            return lambda *args, **kwargs: self._hedger.call(attr, *args, **kwargs)
+        if self._path.startswith(path + "."):
+            return _HedgedResource(attr, self._hedger, self._path, path)
+        if name == "with_options" and not self._prefix:
+            return lambda **kwargs: _HedgedResource(attr(**kwargs), self._hedger, self._path)
+        return attr
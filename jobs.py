@@ -0,0 +1,422 @@
+"""問題セットの生成・評価を裏で実行するジョブキュー（SQLite で共有するワーカープール）
+
+Streamlit アプリでは 15 問の生成と評価がスクリプトのスレッドで実行されるので、終わるまで
+そのセッションでは何もできず、ブラウザを再読み込みすると途中の結果も失われる。
+ジョブとして SQLite（既定 jobs.db）に積んでおけば、別プロセスのワーカーが実行し、
+アプリは進み具合を読みに行くだけになる。
+
+- ジョブの状態・進み具合・結果は DB にあるので、ブラウザを再読み込みしても、
+  別のセッションからでもジョブ ID で結果を開ける（jobs_app.py は URL の ?job= に入れる）
+- ワーカーはアプリとスイープ（sweep.py --jobs）で共有する。対話のジョブ（priority が高い）を先に取る
+- ワーカーは実行中のジョブの heartbeat を更新し、STALE_SECONDS 更新がなければ落ちたとみなして
+  ジョブを待ちに戻す（MAX_ATTEMPTS 回まで）
+- 取り消しは DB の印をワーカーが見て、CancelToken（cancellation.py）で実行中の処理を止める
+
+ジョブの種類は HANDLERS に登録する（今は "question_set": sweep.py の1セルと同じ処理）。
+
+例:
+    python jobs.py worker --workers 4     # ワーカープールを起動
+    python jobs.py list                   # 最近のジョブ
+    python jobs.py cancel <job_id>
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from functools import lru_cache
+
+from cancellation import Cancelled, CancelToken
+
+JOBS_DB = os.getenv("JOBS_DB", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+
+POLL_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 5.0
+STALE_SECONDS = 60.0
+MAX_ATTEMPTS = 2
+# アプリが起動したワーカーは、この秒数ジョブがなければ終わる
+IDLE_EXIT = 600.0
+
+# 対話のジョブはスイープのセルより先に取る
+INTERACTIVE_PRIORITY = 10
+BATCH_PRIORITY = 0
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+
+@dataclass
+class Job:
+    job_id: str
+    kind: str
+    status: str
+    priority: int
+    params: dict
+    result: dict
+    error: str
+    stage: str
+    progress: int
+    total: int
+    created: float
+    started: float
+    finished: float
+    worker: str
+    attempts: int
+
+    @property
+    def done(self):
+        return self.status in FINISHED
+
+    def describe(self):
+        label = self.params.get("label") or self.kind
+        progress = f" {self.progress}/{self.total}" if self.total else ""
+        stage = f" {self.stage}" if self.stage and not self.done else ""
+        return f"{self.job_id[:8]} {label} [{self.status}{stage}{progress}]"
+
+
+_JOB_COLUMNS = ("job_id, kind, status, priority, params_json, result_json, error, stage, progress, total, "
+                "created, started, finished, worker, attempts")
+
+
+def _job(row):
+    values = list(row)
+    values[4] = json.loads(values[4] or "{}")
+    values[5] = json.loads(values[5]) if values[5] else None
+    return Job(*values)
+
+
+class JobQueue:
+    def __init__(self, path=JOBS_DB):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY, kind TEXT, status TEXT, priority INTEGER,
+                    params_json TEXT, result_json TEXT, error TEXT,
+                    stage TEXT, progress INTEGER DEFAULT 0, total INTEGER DEFAULT 0,
+                    created REAL, started REAL, finished REAL,
+                    worker TEXT, heartbeat REAL, attempts INTEGER DEFAULT 0,
+                    cancel_requested INTEGER DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    worker_id TEXT PRIMARY KEY, pid INTEGER, started REAL, heartbeat REAL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    # ===== 投入・参照 =====
+    def submit(self, kind, params, priority=BATCH_PRIORITY, total=0):
+        """ジョブを積んでジョブ ID を返す"""
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, kind, status, priority, params_json, total, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, priority, _dumps(params), total, time.time()),
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def list_jobs(self, limit=20, kind=None):
+        """新しい順にジョブを返す"""
+        sql = f"SELECT {_JOB_COLUMNS} FROM jobs"
+        args = []
+        if kind:
+            sql += " WHERE kind = ?"
+            args.append(kind)
+        with self._connect() as conn:
+            rows = conn.execute(sql + " ORDER BY created DESC LIMIT ?", args + [limit]).fetchall()
+        return [_job(row) for row in rows]
+
+    def cancel(self, job_id):
+        """待ちのジョブはその場で取り消し、実行中のジョブはワーカーに止めてもらう"""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, finished = ? WHERE job_id = ? AND status = ?",
+                         (CANCELLED, time.time(), job_id, QUEUED))
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = ?",
+                         (job_id, RUNNING))
+
+    def wait(self, job_ids, poll=POLL_INTERVAL):
+        """ジョブが終わった順に Job を返すジェネレーター"""
+        pending = set(job_ids)
+        while pending:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    f"SELECT {_JOB_COLUMNS} FROM jobs WHERE job_id IN ({', '.join('?' * len(pending))}) "
+                    f"AND status IN ({', '.join('?' * len(FINISHED))})",
+                    list(pending) + list(FINISHED),
+                ).fetchall()
+            for row in rows:
+                pending.discard(row[0])
+                yield _job(row)
+            if pending and not rows:
+                time.sleep(poll)
+
+    # ===== ワーカー側 =====
+    def claim(self, worker_id):
+        """一番優先度の高い待ちジョブを実行中にして返す（なければ None）"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # heartbeat の止まったジョブ（ワーカーが落ちた）は待ちに戻す（取り消し待ちだったものは取り消す）
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished = ? WHERE status = ? AND heartbeat < ? "
+                    "AND cancel_requested = 1",
+                    (CANCELLED, now, RUNNING, now - STALE_SECONDS),
+                )
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat < ? AND attempts < ?",
+                    (QUEUED, RUNNING, now - STALE_SECONDS, MAX_ATTEMPTS),
+                )
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE status = ? AND heartbeat < ?",
+                    (FAILED, "ワーカーが応答しなくなりました", now, RUNNING, now - STALE_SECONDS),
+                )
+                row = conn.execute(
+                    "SELECT job_id FROM jobs WHERE status = ? ORDER BY priority DESC, created LIMIT 1",
+                    (QUEUED,),
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, started = ?, heartbeat = ?, "
+                        "attempts = attempts + 1 WHERE job_id = ?",
+                        (RUNNING, worker_id, now, now, row[0]),
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return self.get(row[0]) if row is not None else None
+
+    def heartbeat(self, job_id, worker_id):
+        """実行中の印を更新し、取り消しが頼まれているかを返す"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = ? AND worker = ?", (now, job_id, worker_id))
+            conn.execute("UPDATE workers SET heartbeat = ? WHERE worker_id = ?", (now, worker_id))
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def set_progress(self, job_id, stage, progress, total):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET stage = ?, progress = ?, total = ?, heartbeat = ? WHERE job_id = ?",
+                         (stage, progress, total, time.time(), job_id))
+
+    def finish(self, job_id, status, result=None, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result_json = ?, error = ?, finished = ? WHERE job_id = ?",
+                (status, _dumps(result) if result is not None else None, error, time.time(), job_id),
+            )
+
+    def register_worker(self, worker_id):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?)", (worker_id, os.getpid(), now, now))
+            # ensure_workers が起動中として数えていた分を1つ消す
+            conn.execute("DELETE FROM workers WHERE worker_id = "
+                         "(SELECT worker_id FROM workers WHERE worker_id LIKE 'starting-%' LIMIT 1)")
+
+    def beat_worker(self, worker_id):
+        with self._connect() as conn:
+            conn.execute("UPDATE workers SET heartbeat = ? WHERE worker_id = ?", (time.time(), worker_id))
+
+    def remove_worker(self, worker_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def live_workers(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM workers WHERE heartbeat >= ?",
+                                (time.time() - STALE_SECONDS,)).fetchone()[0]
+
+    def ensure_workers(self, n=JOB_WORKERS, idle_exit=IDLE_EXIT):
+        """動いているワーカーが n 未満なら、足りない分を別プロセスで起動する（起動した数を返す）
+
+        ワーカーはアプリのプロセスから切り離して起動するので、Streamlit を止めても実行中のジョブは続く。
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            live = conn.execute("SELECT COUNT(*) FROM workers WHERE heartbeat >= ?",
+                                (time.time() - STALE_SECONDS,)).fetchone()[0]
+            missing = max(0, n - live)
+            # 起動中のワーカーを数えておき、同時に呼んだ他のセッションが重ねて起動しないようにする
+            for _ in range(missing):
+                conn.execute("INSERT INTO workers VALUES (?, NULL, ?, ?)",
+                             (f"starting-{uuid.uuid4().hex}", time.time(), time.time()))
+            conn.execute("COMMIT")
+        if missing:
+            # Windows には start_new_session が無いので、新しいプロセスグループで起動して
+            # アプリ側の Ctrl+C がワーカーに届かないようにする
+            if os.name == "nt":
+                detach = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+            else:
+                detach = {"start_new_session": True}
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--db", os.path.abspath(self.path),
+                 "worker", "--workers", str(missing), "--idle-exit", str(idle_exit)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **detach,
+            )
+        return missing
+
+    def run_job(self, job, worker_id):
+        """ジョブを1つ実行して結果を書き込む"""
+        token = CancelToken()
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(HEARTBEAT_INTERVAL):
+                if self.heartbeat(job.job_id, worker_id):
+                    token.cancel("job_cancelled")
+
+        def progress(stage, done, total):
+            self.set_progress(job.job_id, stage, done, total)
+            token.check()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            result = HANDLERS[job.kind](job.params, progress, token)
+        except Cancelled:
+            self.finish(job.job_id, CANCELLED)
+        except Exception as e:
+            self.finish(job.job_id, FAILED, error=repr(e))
+        else:
+            if token.cancelled:
+                self.finish(job.job_id, CANCELLED, result)
+            else:
+                error = result.get("error") if isinstance(result, dict) else None
+                self.finish(job.job_id, FAILED if error else DONE, result, error)
+        finally:
+            stop.set()
+            thread.join()
+
+    def report(self):
+        with self._connect() as conn:
+            counts = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE status IN (?, ?) GROUP BY status", (QUEUED, RUNNING)
+            ).fetchall())
+        return (f"ジョブ: 待ち {counts.get(QUEUED, 0)} 件・実行中 {counts.get(RUNNING, 0)} 件"
+                f"・ワーカー {self.live_workers()}")
+
+
+@lru_cache(maxsize=None)
+def get_job_queue(path=JOBS_DB):
+    """プロセス内で共有するジョブキュー（Streamlit の再実行ごとに作り直さない）"""
+    return JobQueue(path)
+
+
+# ===== ジョブの種類 =====
+def run_question_set(params, progress, cancel):
+    """問題セットの生成と指標計算（params は grid.build_grid のセルと同じ形）"""
+    from sweep import run_cell
+
+    return run_cell(params, progress=progress, cancel=cancel)
+
+
+HANDLERS = {"question_set": run_question_set}
+
+
+def question_set_params(paragraph, temperature, num_variants=15, metrics=None, paragraph_index=None,
+                        label=None, **options):
+    """アプリから投げる問題セットのジョブ。指定しない設定は sweep.py の既定値を使う"""
+    import sweep
+    from grid import build_grid
+
+    args = sweep.parse_args([])
+    args.temperatures = [temperature]
+    args.paragraphs = [0]
+    args.variants = [num_variants]
+    if metrics:
+        args.metrics = list(metrics)
+    cell = build_grid([paragraph], args)[0]
+    cell.update(options)
+    cell["paragraph_index"] = paragraph_index
+    # 結果に問題そのものも入れる（スイープの CSV には書かない）
+    cell["return_questions"] = True
+    cell["label"] = label or f"T={temperature} n={num_variants}"
+    return cell
+
+
+# ===== ワーカー =====
+def run_worker(path=JOBS_DB, poll=POLL_INTERVAL, idle_exit=None):
+    """ジョブを取っては実行する（idle_exit 秒ジョブがなければ終わる）"""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    queue = JobQueue(path)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    queue.register_worker(worker_id)
+    idle_since = time.monotonic()
+    try:
+        while True:
+            job = queue.claim(worker_id)
+            if job is None:
+                queue.beat_worker(worker_id)
+                if idle_exit is not None and time.monotonic() - idle_since > idle_exit:
+                    return
+                time.sleep(poll)
+                continue
+            queue.run_job(job, worker_id)
+            idle_since = time.monotonic()
+    finally:
+        queue.remove_worker(worker_id)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="問題セットのジョブキュー")
+    parser.add_argument("--db", default=JOBS_DB)
+    sub = parser.add_subparsers(dest="command", required=True)
+    worker = sub.add_parser("worker", help="ワーカープールを起動")
+    worker.add_argument("--workers", type=int, default=JOB_WORKERS)
+    worker.add_argument("--idle-exit", type=float, help="この秒数ジョブがなければ終わる（省略時は終わらない）")
+    listing = sub.add_parser("list", help="最近のジョブ")
+    listing.add_argument("--limit", type=int, default=20)
+    cancel = sub.add_parser("cancel", help="ジョブを取り消す")
+    cancel.add_argument("job_ids", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        processes = [multiprocessing.Process(target=run_worker, args=(args.db, POLL_INTERVAL, args.idle_exit))
+                     for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return
+
+    queue = JobQueue(args.db)
+    if args.command == "cancel":
+        for job_id in args.job_ids:
+            queue.cancel(job_id)
+    for job in queue.list_jobs(args.limit):
+        print(job.describe() + (f" {job.error}" if job.error else ""))
+    print(queue.report())
+
+
+if __name__ == "__main__":
+    main()
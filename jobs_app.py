@@ -0,0 +1,107 @@
+"""問題セットの生成・評価をバックグラウンドのジョブで実行する Streamlit アプリ
+
+生成と評価は jobs.py のワーカー（別プロセス）が実行し、このアプリは進み具合を表示するだけなので、
+待っている間も別の段落のジョブを積んだり、前の結果を見たりできる。
+開いているジョブは URL（?job=<ジョブ ID>）に入れるので、ブラウザを再読み込みしても、
+URL を別のタブ・別の人に渡しても同じ結果を開ける。
+"""
+import os
+import random
+import time
+
+import streamlit as st
+from dotenv import load_dotenv
+
+import quiz_pipeline as qp
+from jobs import INTERACTIVE_PRIORITY, JOB_WORKERS, get_job_queue, question_set_params
+from metrics import available_metrics
+
+# 実行中のジョブの進み具合を読み直す間隔（秒）
+POLL_SECONDS = 2
+
+load_dotenv()
+queue = get_job_queue()
+
+# ===== Streamlit UI =====
+st.title("兵庫学検定試験対策ツール（バックグラウンド生成）")
+
+# ファイルアップロード
+uploaded_file = st.file_uploader("クイズに使うPDFファイルを選んでください", type=["pdf"])
+
+if uploaded_file is not None and st.session_state.get("uploaded_file_id") != uploaded_file.file_id:
+    st.session_state.uploaded_file_id = uploaded_file.file_id
+    pdf_path = "uploaded.pdf"
+    with open(pdf_path, "wb") as f:
+        f.write(uploaded_file.read())
+
+    qp.pdf_to_csv(pdf_path, "Book1.csv")
+    st.session_state.explanations = qp.load_explanations_from_csv("Book1.csv")
+    st.success(f"PDFを変換して {len(st.session_state.explanations)} 件の文章を読み込みました！")
+
+# ===== ジョブの投入 =====
+if st.session_state.get("explanations"):
+    explanations = st.session_state.explanations
+    with st.form("submit_job"):
+        temperature = st.slider("temperature", 0.0, 2.0, 0.0, 0.1)
+        num_variants = st.number_input("生成する問題数", 1, 50, 15)
+        metrics = st.multiselect("指標", available_metrics(), default=["cosine", "faithfulness"])
+        submitted = st.form_submit_button("問題セットを生成")
+    if submitted:
+        QuestionNum = random.randint(0, len(explanations) - 1)
+        params = question_set_params(
+            explanations[QuestionNum], temperature, num_variants, metrics, paragraph_index=QuestionNum,
+            app=os.path.basename(__file__),
+        )
+        job_id = queue.submit("question_set", params, priority=INTERACTIVE_PRIORITY, total=num_variants)
+        # ワーカーが動いていなければ起動する（スイープと共有）
+        queue.ensure_workers(JOB_WORKERS)
+        st.query_params["job"] = job_id
+else:
+    st.info("まずはPDFファイルをアップロードしてください。")
+
+# ===== ジョブの表示 =====
+recent = {job.job_id: job for job in queue.list_jobs(20, kind="question_set")}
+job_id = st.query_params.get("job")
+if job_id and job_id not in recent:
+    job = queue.get(job_id)
+    if job is not None:
+        recent = {job_id: job, **recent}
+if recent:
+    ids = list(recent)
+    selected = st.selectbox("ジョブ", ids, index=ids.index(job_id) if job_id in recent else 0,
+                            format_func=lambda i: recent[i].describe())
+    if selected != job_id:
+        st.query_params["job"] = selected
+    job = queue.get(selected)
+
+    if not job.done:
+        label = "生成中" if job.stage == "generation" else "評価中" if job.stage == "metrics" else "待ち"
+        st.progress(min(1.0, job.progress / job.total) if job.total else 0.0,
+                    text=f"{label} {job.progress}/{job.total}")
+        if st.button("このジョブを取り消す"):
+            queue.cancel(job.job_id)
+            st.rerun()
+    elif job.status != "done":
+        st.error(f"ジョブは {job.status} で終わりました: {job.error or ''}")
+
+    if job.result and job.result.get("questions"):
+        row = job.result
+        st.subheader(f"生成された{len(row['questions'])}問すべての問題")
+        for idx, q in enumerate(row["questions"], start=1):
+            qp.render_question(st, idx, q)
+            st.info(f"解説：{job.params['paragraph']}")
+            st.write("---")
+
+        # ===== スコア表示 =====
+        st.subheader("スコアまとめ")
+        for key, value in row.items():
+            if key.startswith("avg_") and value is not None:
+                st.write(f"{key[4:]}: {value}")
+        st.caption(f"ジョブ {job.job_id}・{row.get('elapsed_sec')} 秒・${row.get('cost_usd')}")
+
+st.sidebar.caption(queue.report())
+
+# 実行中のジョブがあれば、少し待って進み具合を読み直す
+if recent and not job.done:
+    time.sleep(POLL_SECONDS)
+    st.rerun()
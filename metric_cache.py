@@ -0,0 +1,289 @@
+"""評価結果（RAGAS の指標・BERTScore）の永続キャッシュ
+
+キーは (指標名, 指標のバージョン, 評価モデル, 問題文, 回答, 根拠) のハッシュ。
+同じ問題・正解・根拠の組をもう一度評価するとき（temperature=0 の問題が再び出たときや
+スイープの再実行など）は保存済みのスコアを使い、evaluate / bert_score を呼ばない。
+
+指標のバージョンには ragas・bert_score のパッケージのバージョンを使うので、
+更新すると古いスコアは自動的に使われなくなる（DB からの削除は invalidate / prune_stale）。
+
+キャッシュは SQLite（既定 metric_cache.db）に保存され、アプリを再起動しても残る。
+環境変数 METRIC_CACHE=off で無効にできる。
+
+例:
+    python metric_cache.py                         # 指標ごとの件数・累計ヒット数
+    python metric_cache.py --prune-stale           # 今のバージョンと違うスコアを削除
+    python metric_cache.py --invalidate faithfulness
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from telemetry import JUDGE_MODEL
+
+METRIC_CACHE_DB = os.getenv("METRIC_CACHE_DB", "metric_cache.db")
+
+BERTSCORE_MODEL = "bert-base-multilingual-cased"
+BERTSCORE_PARTS = ["bertscore_precision", "bertscore_recall", "bertscore_f1"]
+
+
+def _hash(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def cache_key(metric, version, judge_model, question, answer, context):
+    return _hash({
+        "metric": metric,
+        "version": version,
+        "judge_model": judge_model,
+        "question": question,
+        "answer": answer,
+        "context": context,
+    })
+
+
+def _package_version(name):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return "unknown"
+
+
+def metric_version(metric):
+    """指標のバージョン（BERTScore は bert_score、それ以外は ragas のバージョン）"""
+    if metric.startswith("bertscore"):
+        return f"bert_score-{_package_version('bert-score')}"
+    return f"ragas-{_package_version('ragas')}"
+
+
+def _metric_name(metric):
+    return getattr(metric, "name", str(metric))
+
+
+def _judge_model(metric, default=JUDGE_MODEL):
+    """指標に設定された評価モデル名（取れなければ既定の評価モデル）"""
+    llm = getattr(metric, "llm", None)
+    for obj in (llm, getattr(llm, "langchain_llm", None)):
+        name = getattr(obj, "model_name", None) or getattr(obj, "model", None)
+        if isinstance(name, str):
+            return name
+    return default
+
+
+def _is_valid(value):
+    return value is not None and not (isinstance(value, float) and math.isnan(value))
+
+
+class MetricCache:
+    def __init__(self, path=METRIC_CACHE_DB, enabled=None):
+        if enabled is None:
+            enabled = os.getenv("METRIC_CACHE") != "off"
+        self.path = path
+        self.enabled = enabled
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS metric_cache (
+                    key TEXT PRIMARY KEY,
+                    metric TEXT, version TEXT, judge_model TEXT,
+                    value REAL, created REAL, hits INTEGER DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS metric_cache_metric ON metric_cache (metric, version)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _count(self, counter, metric, n):
+        with self.lock:
+            counter[metric] = counter.get(metric, 0) + n
+
+    def get_many(self, metric, judge_model, triples):
+        """(問題, 回答, 根拠) ごとの保存済みスコア（なければ None）"""
+        version = metric_version(metric)
+        keys = [cache_key(metric, version, judge_model, *t) for t in triples]
+        if not self.enabled:
+            return keys, [None] * len(keys)
+        with self._connect() as conn:
+            found = {}
+            for key in set(keys):
+                row = conn.execute("SELECT value FROM metric_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+            if found:
+                conn.executemany("UPDATE metric_cache SET hits = hits + 1 WHERE key = ?",
+                                 [(k,) for k in found])
+        values = [found.get(k) for k in keys]
+        hit_count = sum(v is not None for v in values)
+        self._count(self.hits, metric, hit_count)
+        self._count(self.misses, metric, len(values) - hit_count)
+        return keys, values
+
+    def put_many(self, metric, judge_model, keys, values):
+        """スコアを保存（評価に失敗した nan は保存しない）"""
+        if not self.enabled:
+            return
+        rows = [(k, metric, metric_version(metric), judge_model, float(v), time.time())
+                for k, v in zip(keys, values) if _is_valid(v)]
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO metric_cache "
+                "(key, metric, version, judge_model, value, created) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    # ===== evaluate / bert_score のラップ =====
+    def wrap_evaluate(self, evaluate_fn):
+        """ragas.evaluate をキャッシュ経由にする
+
+        保存済みでない (行, 指標) だけを evaluate に渡し、結果を {指標名: スコアのリスト} で返す。
+        telemetry.instrument_evaluate の外側に重ねると、ヒット分は評価の計測に入らない。
+        """
+        def wrapper(dataset, *args, metrics=None, **kwargs):
+            from datasets import Dataset
+
+            metrics = list(metrics or [])
+            triples = [
+                (q, a, "\n".join(c))
+                for q, a, c in zip(dataset["question"], dataset["answer"], dataset["contexts"])
+            ]
+            cached = {}
+            for metric in metrics:
+                judge_model = _judge_model(metric)
+                cached[_metric_name(metric)] = (judge_model, *self.get_many(_metric_name(metric),
+                                                                            judge_model, triples))
+
+            # 指標ごとに未評価の行をまとめ、同じ行の集合を必要とする指標は1回の evaluate で評価する
+            pending = {}
+            for metric in metrics:
+                _, _, values = cached[_metric_name(metric)]
+                rows = tuple(i for i, v in enumerate(values) if v is None)
+                if rows:
+                    pending.setdefault(rows, []).append(metric)
+
+            for rows, pending_metrics in pending.items():
+                subset = Dataset.from_dict({
+                    "question": [dataset["question"][i] for i in rows],
+                    "answer": [dataset["answer"][i] for i in rows],
+                    "contexts": [dataset["contexts"][i] for i in rows],
+                })
+                result = evaluate_fn(subset, *args, metrics=pending_metrics, **kwargs)
+                for metric in pending_metrics:
+                    name = _metric_name(metric)
+                    judge_model, keys, values = cached[name]
+                    scores = list(result[name])
+                    for i, value in zip(rows, scores):
+                        values[i] = value
+                    self.put_many(name, judge_model, [keys[i] for i in rows], scores)
+
+            return {name: values for name, (_, _, values) in cached.items()}
+
+        return wrapper
+
+    def wrap_bert_score(self, score_fn):
+        """bert_score.score をキャッシュ経由にする（候補 = 根拠、参照 = 回答）。P, R, F1 を返す"""
+        def wrapper(cands, refs, *args, model_type=BERTSCORE_MODEL, **kwargs):
+            import torch
+
+            triples = [("", r, c) for c, r in zip(cands, refs)]
+            parts = {name: self.get_many(name, model_type, triples) for name in BERTSCORE_PARTS}
+            missing = [i for i in range(len(triples))
+                       if any(values[i] is None for _, values in parts.values())]
+            if missing:
+                results = score_fn([cands[i] for i in missing], [refs[i] for i in missing],
+                                   *args, model_type=model_type, **kwargs)
+                for name, tensor in zip(BERTSCORE_PARTS, results):
+                    keys, values = parts[name]
+                    scores = tensor.tolist()
+                    for i, value in zip(missing, scores):
+                        values[i] = value
+                    self.put_many(name, model_type, [keys[i] for i in missing], scores)
+            return tuple(torch.tensor(parts[name][1]) for name in BERTSCORE_PARTS)
+
+        return wrapper
+
+    # ===== ヒット率・無効化 =====
+    def hit_rate(self, metric=None):
+        metrics = [metric] if metric else set(self.hits) | set(self.misses)
+        hits = sum(self.hits.get(m, 0) for m in metrics)
+        lookups = hits + sum(self.misses.get(m, 0) for m in metrics)
+        return hits / lookups if lookups else 0.0
+
+    def total_hits(self):
+        return sum(self.hits.values())
+
+    def report(self):
+        hits = self.total_hits()
+        lookups = hits + sum(self.misses.values())
+        return f"評価キャッシュ: ヒット {hits} / {lookups} 件（{self.hit_rate():.0%}）"
+
+    def stored_stats(self):
+        """指標・バージョンごとの保存件数と累計ヒット数（再起動をまたいだ集計）"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT metric, version, COUNT(*), COALESCE(SUM(hits), 0) FROM metric_cache "
+                "GROUP BY metric, version ORDER BY metric, version"
+            ).fetchall()
+        return [{"metric": m, "version": v, "entries": n, "hits": h} for m, v, n, h in rows]
+
+    def invalidate(self, metric, version=None):
+        """指標のスコアを削除（version を指定するとそのバージョンのものだけ）。削除件数を返す"""
+        with self._connect() as conn:
+            if version is None:
+                cursor = conn.execute("DELETE FROM metric_cache WHERE metric = ?", (metric,))
+            else:
+                cursor = conn.execute("DELETE FROM metric_cache WHERE metric = ? AND version = ?",
+                                      (metric, version))
+        return cursor.rowcount
+
+    def prune_stale(self):
+        """今の指標のバージョンと違うスコアをすべて削除。削除件数を返す"""
+        with self._connect() as conn:
+            metrics = [m for (m,) in conn.execute("SELECT DISTINCT metric FROM metric_cache")]
+        removed = 0
+        for metric in metrics:
+            current = metric_version(metric)
+            with self._connect() as conn:
+                removed += conn.execute("DELETE FROM metric_cache WHERE metric = ? AND version != ?",
+                                        (metric, current)).rowcount
+        return removed
+
+
+@lru_cache(maxsize=None)
+def get_metric_cache(path=METRIC_CACHE_DB):
+    """プロセス内で共有するキャッシュ（Streamlit の再実行ごとに作り直さない）"""
+    return MetricCache(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="評価結果キャッシュの集計・無効化")
+    parser.add_argument("--db", default=METRIC_CACHE_DB)
+    parser.add_argument("--invalidate", metavar="METRIC", help="指定した指標のスコアを削除")
+    parser.add_argument("--version", help="--invalidate で削除するバージョン（省略時はすべて）")
+    parser.add_argument("--prune-stale", action="store_true", help="今のバージョンと違うスコアを削除")
+    args = parser.parse_args(argv)
+
+    cache = MetricCache(args.db, enabled=True)
+    if args.invalidate:
+        print(f"{args.invalidate}: {cache.invalidate(args.invalidate, args.version)} 件削除")
+    if args.prune_stale:
+        print(f"古いバージョンのスコア: {cache.prune_stale()} 件削除")
+    for s in cache.stored_stats():
+        print(f"{s['metric']:<20}{s['version']:<24}{s['entries']:>8} 件  累計ヒット {s['hits']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""評価指標のプラグイン登録と並行実行
+
+指標は register_metric で名前・種類を付けて登録する。
+- kind="cpu": BERTScore・類似度・語彙の多様性など手元で計算するもの。プロセスプールで実行する
+- kind="io":  RAGAS・埋め込みなど API を待つもの。イベントループ上で並行に実行する
+requires に他の指標名を書くと、その結果を受け取ってから実行する（cosine は embeddings の後）。
+group を付けた指標は、同時に頼まれた同じ group の指標と1回の呼び出しでまとめて計算する
+（faithfulness・answer_relevancy は "ragas" で、1回の evaluate・1つの Dataset になる）。
+group の関数は register_metric_group で登録し、(sample, names, ...) から {指標名: 値} を返す。
+
+compute_metrics はすべての指標を同時に走らせるので、全指標の所要時間は合計ではなく
+いちばん遅い指標（＋依存の連鎖）程度になる。
+
+指標の関数は (sample, **依存の結果) を受け取る。sample は
+    {"questions": 問題のリスト, "answers": 正解の選択肢のリスト,
+     "paragraph": 本文, "contexts": 問題ごとの根拠（既定は本文）}
+CPU 指標はプロセスプールに渡すため、import できるモジュールの最上位に定義した関数にすること。
+I/O 指標は client・telemetry・evaluate_fn もキーワード引数で受け取る（同期関数ならスレッドで実行）。
+"""
+import asyncio
+import inspect
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+import quiz_pipeline as qp
+
+
+@dataclass
+class Metric:
+    name: str
+    fn: object
+    kind: str
+    requires: tuple = ()
+    per_question: bool = False
+    description: str = ""
+    internal: bool = False
+    group: str = None
+
+
+METRICS = {}
+METRIC_GROUPS = {}
+
+
+def register_metric(name, kind, requires=(), per_question=False, internal=False, group=None):
+    """指標を登録するデコレータ。kind は "cpu" か "io"、per_question=True なら問題ごとのリストを返す"""
+    if kind not in ("cpu", "io"):
+        raise ValueError(f"kind は 'cpu' か 'io': {kind}")
+
+    def decorator(fn):
+        METRICS[name] = Metric(name, fn, kind, tuple(requires), per_question,
+                               (fn.__doc__ or "").strip(), internal, group)
+        return fn
+
+    return decorator
+
+
+def register_metric_group(group):
+    """同じ group の指標をまとめて計算する I/O 関数を登録するデコレータ"""
+    def decorator(fn):
+        METRIC_GROUPS[group] = fn
+        return fn
+
+    return decorator
+
+
+def available_metrics():
+    """スコアとして選べる指標の名前（embeddings など中間結果は除く）"""
+    return [name for name, m in METRICS.items() if not m.internal]
+
+
+# ===== 組み込みの指標 =====
+@register_metric("embeddings", "io", internal=True)
+async def embeddings_metric(sample, client=None, **_):
+    """正解の選択肢の埋め込み（1リクエストでまとめて取得）"""
+    if not sample["answers"]:
+        return []
+    create = client.embeddings.create
+    if inspect.iscoroutinefunction(create):
+        response = await create(input=sample["answers"], model=qp.EMBEDDING_MODEL)
+    else:
+        # 同期クライアント（アプリ・replay.py）は別スレッドで呼び、待つ間も他の指標を進める
+        response = await asyncio.to_thread(create, input=sample["answers"], model=qp.EMBEDDING_MODEL)
+        if inspect.isawaitable(response):
+            response = await response
+    return [e.embedding for e in response.data]
+
+
+@register_metric("cosine", "cpu", requires=["embeddings"])
+def cosine_metric(sample, embeddings):
+    """正解の選択肢どうしの平均コサイン類似度"""
+    return qp.avg_pairwise_similarity(embeddings)
+
+
+@register_metric("lexical_diversity", "cpu")
+def lexical_diversity_metric(sample):
+    """問題文の語彙の多様性（全問の文字 2-gram のうち異なるものの割合、distinct-2）"""
+    texts = [re.sub(r"\s+", "", q["Question"]) for q in sample["questions"]]
+    ngrams = [t[i:i + 2] for t in texts for i in range(len(t) - 1)]
+    return len(set(ngrams)) / len(ngrams) if ngrams else float("nan")
+
+
+@register_metric("bertscore", "cpu", per_question=True)
+def bertscore_metric(sample):
+    """正解の選択肢と本文の BERTScore（F1）"""
+    return qp.bert_scores(sample["answers"], sample["paragraph"])
+
+
+@register_metric_group("ragas")
+def ragas_metrics(sample, names, telemetry=None, evaluate_fn=None, **_):
+    """RAGAS の指標を1回の evaluate（score_table）でまとめて計算する"""
+    rows = qp.score_table(sample["questions"], sample["contexts"], list(names),
+                          evaluate_fn=evaluate_fn, telemetry=telemetry)
+    return {name: [row[name] for row in rows] for name in names}
+
+
+def _ragas(name):
+    def metric(sample, **kwargs):
+        return ragas_metrics(sample, [name], **kwargs)[name]
+
+    metric.__doc__ = f"RAGAS の {name}"
+    return metric
+
+
+for _name in ("faithfulness", "answer_relevancy"):
+    register_metric(_name, "io", per_question=True, group="ragas")(_ragas(_name))
+
+
+# ===== 実行 =====
+@lru_cache(maxsize=None)
+def get_process_pool(max_workers=None):
+    """CPU 指標用の共有プロセスプール（BERTScore のモデル読み込みをワーカーごとに1回で済ませる）"""
+    # Streamlit などスレッドの多いプロセスから fork しないよう spawn で起動する
+    pool = ProcessPoolExecutor(max_workers=max_workers or min(4, os.cpu_count() or 1),
+                               mp_context=multiprocessing.get_context("spawn"))
+    # sweep.py のワーカープロセスの中で作ったときは、終了時に子プロセスを join する前に閉じる
+    # （閉じないと、ワーカーがこのプールの子プロセスの終了を待ち続けて sweep が終わらない）
+    multiprocessing.util.Finalize(pool, pool.shutdown, kwargs={"cancel_futures": True}, exitpriority=100)
+    return pool
+
+
+def _order(names):
+    """依存する指標も含めて、依存の後に来る順に並べる"""
+    ordered = []
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name not in METRICS:
+            raise KeyError(f"未登録の指標です: {name}")
+        for dep in METRICS[name].requires:
+            visit(dep)
+        ordered.append(name)
+
+    for name in names:
+        visit(name)
+    return ordered
+
+
+def make_sample(questions, paragraph, contexts=None):
+    return {
+        "questions": list(questions),
+        "answers": [qp.correct_answer(q) for q in questions],
+        "paragraph": paragraph,
+        "contexts": list(contexts) if contexts is not None else [paragraph] * len(questions),
+    }
+
+
+def _subset(sample, indices):
+    return {
+        **sample,
+        "questions": [sample["questions"][i] for i in indices],
+        "answers": [sample["answers"][i] for i in indices],
+        "contexts": [sample["contexts"][i] for i in indices],
+    }
+
+
+async def compute_metrics(names, questions, paragraph, contexts=None, client=None, telemetry=None,
+                          evaluate_fn=None, precomputed=None, clusters=None, executor=None):
+    """names の指標を同時に計算し {指標名: 値} を返す
+
+    precomputed に {指標名: 値} を渡すとその指標は計算しない（適応モードで取得済みの埋め込みなど）。
+    clusters（near_duplicate_clusters の結果）を渡すと、問題ごとの指標は代表だけを評価して全件に割り当てる。
+    """
+    sample = make_sample(questions, paragraph, contexts)
+    precomputed = dict(precomputed or {})
+    executor = executor or get_process_pool()
+    loop = asyncio.get_running_loop()
+    tasks = {}
+    ordered = _order(names)
+    group_tasks = {}
+
+    def group_call(group, target, kwargs):
+        """同じ group の指標はまとめて1回だけ呼ぶ（最初に頼んだ指標が起動し、残りは結果を待つ）"""
+        if group not in group_tasks:
+            members = [n for n in ordered if METRICS[n].group == group and n not in precomputed]
+            fn = METRIC_GROUPS[group]
+            if inspect.iscoroutinefunction(fn):
+                coro = fn(target, members, **kwargs)
+            else:
+                coro = asyncio.to_thread(fn, target, members, **kwargs)
+            group_tasks[group] = asyncio.ensure_future(coro)
+        return group_tasks[group]
+
+    async def run(name):
+        metric = METRICS[name]
+        deps = {dep: await tasks[dep] for dep in metric.requires}
+        target = sample
+        representatives = None
+        if clusters is not None and metric.per_question:
+            representatives = qp.cluster_representatives(clusters)
+            target = _subset(sample, representatives)
+
+        async def call():
+            if metric.kind == "cpu":
+                return await loop.run_in_executor(executor, _call_cpu, metric.fn, target, deps)
+            kwargs = {"client": client, "telemetry": telemetry, "evaluate_fn": evaluate_fn, **deps}
+            if metric.group in METRIC_GROUPS:
+                return (await group_call(metric.group, target, kwargs))[name]
+            if inspect.iscoroutinefunction(metric.fn):
+                return await metric.fn(target, **kwargs)
+            return await asyncio.to_thread(metric.fn, target, **kwargs)
+
+        if telemetry is not None:
+            with telemetry.track(f"metric:{name}"):
+                value = await call()
+        else:
+            value = await call()
+        if representatives is not None:
+            value = qp.propagate_scores(dict(zip(representatives, value)), clusters)
+        return value
+
+    for name in ordered:
+        if name in precomputed:
+            tasks[name] = _done(loop, precomputed[name])
+        else:
+            tasks[name] = asyncio.ensure_future(run(name))
+    values = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+    return {name: values[name] for name in names}
+
+
+def _done(loop, value):
+    future = loop.create_future()
+    future.set_result(value)
+    return future
+
+
+def _call_cpu(fn, sample, deps):
+    return fn(sample, **deps)
+
+
+def run_metrics(names, questions, paragraph, **kwargs):
+    """compute_metrics の同期版（Streamlit アプリ用）"""
+    return asyncio.run(compute_metrics(names, questions, paragraph, **kwargs))
+
+
+def summarize(results):
+    """問題ごとの指標は平均（nan は除く）にして {指標名: 値} を返す"""
+    return {
+        name: float(np.nanmean(value)) if isinstance(value, (list, tuple)) and value else value
+        for name, value in results.items()
+    }
@@ -0,0 +1,306 @@
+"""プロセス全体で共有する OpenAI クライアント（HTTP 接続プールつき）
+
+アプリの先頭で毎回 OpenAI(api_key=...) を作ると、Streamlit の再実行のたびに HTTP クライアントが
+作り直され、温まった keep-alive 接続が捨てられる（毎回 TCP・TLS の接続からやり直しになる）。
+get_openai_client はプロセスに1つだけクライアントを作り、生成・埋め込み・リライト・評価で使い回す。
+with_options（rate_limit.py が再試行を切るときなど）で作ったコピーも同じ接続プールを使う。
+
+- get_openai_client: 同期クライアント（Streamlit アプリ・replay.py）
+- get_async_openai_client: 非同期クライアント。接続はイベントループに結びつくので、ループごとに1つ
+- share_with_ragas: ragas.evaluate の評価モデル・埋め込みも、プロセスで共有する接続プールで呼ぶ。
+  ragas（langchain）は SDK のクライアントを通らないので、レート制限（rate_limit.py）は HTTP の層でかける
+
+接続を新しく張った回数を数え、connection_report() で接続の再利用率を表示する。
+"""
+import asyncio
+import json
+import os
+import threading
+import weakref
+from functools import lru_cache
+
+import httpx
+
+from telemetry import JUDGE_MODEL
+
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "32"))
+KEEPALIVE_EXPIRY = 120.0
+TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+# ragas の既定の埋め込みモデル（answer_relevancy）
+RAGAS_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+class ConnectionStats:
+    """リクエスト数と新しく張った接続の数（httpx の trace 拡張で数える）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def _count(self, requests=0, connections=0):
+        with self.lock:
+            self.requests += requests
+            self.connections += connections
+
+    def _trace(self, name, info):
+        if name == "connection.connect_tcp.complete":
+            self._count(connections=1)
+
+    async def _atrace(self, name, info):
+        self._trace(name, info)
+
+    def on_request(self, request):
+        self._count(requests=1)
+        request.extensions["trace"] = self._trace
+
+    async def on_request_async(self, request):
+        self._count(requests=1)
+        request.extensions["trace"] = self._atrace
+
+    def snapshot(self):
+        with self.lock:
+            return self.requests, self.connections
+
+    def reuse_rate(self, since=(0, 0)):
+        """既存の接続で送れたリクエストの割合（since は snapshot() の値。その後の増分で計算する）"""
+        requests, connections = self.snapshot()
+        requests -= since[0]
+        connections -= since[1]
+        if not requests:
+            return None
+        return max(0.0, 1 - connections / requests)
+
+    def report(self):
+        rate = self.reuse_rate()
+        if rate is None:
+            return "API 接続: まだリクエストなし"
+        requests, connections = self.snapshot()
+        return f"API 接続: {requests} リクエスト / 新規接続 {connections} 回（再利用率 {rate:.0%}）"
+
+
+STATS = ConnectionStats()
+
+
+def _limits():
+    return httpx.Limits(max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+@lru_cache(maxsize=None)
+def _sync_transport():
+    """同期の接続プール（アプリのクライアントと ragas の評価モデルで共有する）"""
+    return httpx.HTTPTransport(limits=_limits())
+
+
+@lru_cache(maxsize=None)
+def get_http_client():
+    """同期の HTTP クライアント（プロセスで1つ）"""
+    return httpx.Client(transport=_sync_transport(), timeout=TIMEOUT,
+                        event_hooks={"request": [STATS.on_request]})
+
+
+# ===== ragas のリクエストのレート制限 =====
+_LIMITED_PATHS = {"/chat/completions": "chat.completions.create", "/embeddings": "embeddings.create"}
+
+
+def _request_budget(request):
+    """レート制限で差し引く (モデル, 見積もりトークン数)。対象外のリクエストなら None"""
+    from rate_limit import estimate_tokens
+
+    call = next((c for suffix, c in _LIMITED_PATHS.items() if request.url.path.endswith(suffix)), None)
+    if call is None:
+        return None
+    try:
+        body = json.loads(request.content)
+    except ValueError:
+        return None
+    return body.get("model"), estimate_tokens(call, body)
+
+
+def _settle_budget(limiter, budget, response):
+    """応答の usage で見積もりとの差を戻し、429 ならそのモデルへの送信を全プロセスで止める"""
+    from rate_limit import backoff_delay
+
+    model, tokens = budget
+    if response.status_code == 429:
+        hint = response.headers.get("retry-after")
+        try:
+            hint = float(hint) if hint else None
+        except ValueError:
+            hint = None
+        if limiter.enabled and model:
+            limiter.block(model, backoff_delay(0, hint))
+        return
+    try:
+        usage = json.loads(response.read()).get("usage") or {}
+    except ValueError:
+        return
+    limiter.settle(model, tokens, usage.get("total_tokens"))
+
+
+class _RateLimitedTransport(httpx.BaseTransport):
+    """送る前にレート制限の予算を待って差し引く httpx の同期トランスポート"""
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def handle_request(self, request):
+        from rate_limit import get_rate_limiter
+
+        limiter = get_rate_limiter()
+        request.read()
+        budget = _request_budget(request)
+        if budget is not None:
+            limiter.acquire(*budget)
+        response = self._transport.handle_request(request)
+        if budget is None:
+            return response
+        try:
+            raw = b"".join(response.iter_raw())
+        finally:
+            response.close()
+        response = httpx.Response(response.status_code, headers=response.headers, stream=httpx.ByteStream(raw),
+                                  extensions=_response_extensions(response))
+        _settle_budget(limiter, budget, response)
+        return response
+
+
+def _response_extensions(response):
+    return {k: v for k, v in response.extensions.items() if k in ("http_version", "reason_phrase")}
+
+
+@lru_cache(maxsize=None)
+def _background_loop():
+    """ragas 用の非同期の接続プールを持つイベントループ（プロセスで1つ。デーモンスレッドで回し続ける）"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="openai-http", daemon=True).start()
+    return loop
+
+
+class _SharedPoolTransport(httpx.AsyncBaseTransport):
+    """どのイベントループから呼ばれても、専用ループ上の1つの接続プールで送る httpx のトランスポート
+
+    ragas は evaluate のたびに新しいイベントループで呼ぶので、ふつうの AsyncClient を渡すと
+    接続プールがそのループと一緒に使えなくなる。応答の本文は専用ループで読み切ってから返す。
+    送る前にレート制限の予算を（呼び出し元のループで、問題セットの取り消しを見ながら）待って差し引く。
+    """
+
+    def __init__(self):
+        self._loop = _background_loop()
+        self._transport = httpx.AsyncHTTPTransport(limits=_limits())
+
+    async def _send(self, request):
+        response = await self._transport.handle_async_request(request)
+        try:
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+        finally:
+            await response.aclose()
+        return httpx.Response(response.status_code, headers=response.headers, stream=httpx.ByteStream(raw),
+                              extensions=_response_extensions(response))
+
+    async def handle_async_request(self, request):
+        from rate_limit import get_rate_limiter
+
+        limiter = get_rate_limiter()
+        await request.aread()
+        budget = _request_budget(request)
+        if budget is not None:
+            await limiter.acquire_async(*budget)
+        future = asyncio.run_coroutine_threadsafe(self._send(request), self._loop)
+        response = await asyncio.wrap_future(future)
+        if budget is not None:
+            await asyncio.to_thread(_settle_budget, limiter, budget, response)
+        return response
+
+
+@lru_cache(maxsize=None)
+def get_judge_http_client():
+    """ragas の評価モデル用の同期の HTTP クライアント（接続プールは get_http_client と共有・レート制限つき）"""
+    return httpx.Client(transport=_RateLimitedTransport(_sync_transport()), timeout=TIMEOUT,
+                        event_hooks={"request": [STATS.on_request]})
+
+
+@lru_cache(maxsize=None)
+def get_shared_async_http_client():
+    """どのイベントループからでも使える非同期の HTTP クライアント（プロセスで1つ。呼び出しごとに閉じない）
+
+    ragas の評価モデル用なので、レート制限つき。
+    """
+    return httpx.AsyncClient(transport=_SharedPoolTransport(), timeout=TIMEOUT,
+                             event_hooks={"request": [STATS.on_request_async]})
+
+
+def new_async_http_client():
+    return httpx.AsyncClient(limits=_limits(), timeout=TIMEOUT,
+                             event_hooks={"request": [STATS.on_request_async]})
+
+
+@lru_cache(maxsize=None)
+def get_openai_client(api_key=None):
+    """プロセスで共有する OpenAI クライアント（Streamlit の再実行ごとに作り直さない）"""
+    from openai import OpenAI
+
+    return OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), http_client=get_http_client())
+
+
+_async_clients = weakref.WeakKeyDictionary()
+_async_lock = threading.Lock()
+
+
+def get_async_openai_client(api_key=None):
+    """今のイベントループで共有する AsyncOpenAI クライアント（ループの外からは呼べない）"""
+    from openai import AsyncOpenAI
+
+    loop = asyncio.get_running_loop()
+    key = api_key or os.getenv("OPENAI_API_KEY")
+    with _async_lock:
+        clients = _async_clients.setdefault(loop, {})
+        if key not in clients:
+            clients[key] = AsyncOpenAI(api_key=key, http_client=new_async_http_client())
+        return clients[key]
+
+
+@lru_cache(maxsize=None)
+def _ragas_models(judge_model):
+    """ragas に渡す評価モデルと埋め込み（プロセスで1組。evaluate をまたいで接続を使い回す）"""
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+    from ragas.embeddings import LangchainEmbeddingsWrapper
+    from ragas.llms import LangchainLLMWrapper
+
+    http_client, async_http_client = get_judge_http_client(), get_shared_async_http_client()
+    llm = LangchainLLMWrapper(ChatOpenAI(
+        model=judge_model, http_client=http_client, http_async_client=async_http_client))
+    embeddings = LangchainEmbeddingsWrapper(OpenAIEmbeddings(
+        model=RAGAS_EMBEDDING_MODEL, http_client=http_client, http_async_client=async_http_client))
+    return llm, embeddings
+
+
+def share_with_ragas(evaluate_fn, judge_model=JUDGE_MODEL):
+    """ragas.evaluate の評価モデル・埋め込みを、この接続設定（と接続の数え上げ）で呼ぶようにする
+
+    ragas は evaluate ごとに新しいイベントループで非同期に呼ぶので、非同期の呼び出しは
+    get_shared_async_http_client（専用ループ上の接続プール）に回し、evaluate をまたいで接続を使い回す。
+    評価モデル・埋め込みの呼び出しもアプリの生成と同じトークンバケット（get_rate_limiter）から差し引く。
+    langchain_openai がなければ何もしない。
+    """
+    try:
+        import langchain_openai  # noqa: F401
+        import ragas.llms  # noqa: F401
+    except ImportError:
+        return evaluate_fn
+
+    def wrapper(dataset, *args, **kwargs):
+        if "llm" not in kwargs or "embeddings" not in kwargs:
+            llm, embeddings = _ragas_models(judge_model)
+            kwargs.setdefault("llm", llm)
+            kwargs.setdefault("embeddings", embeddings)
+        return evaluate_fn(dataset, *args, **kwargs)
+
+    return wrapper
+
+
+def connection_report():
+    return STATS.report()
@@ -0,0 +1,259 @@
+"""生成 → 埋め込み → 評価 のパイプライン実行
+
+15 問すべてがそろうのを待たず、問題が1つ読み込めるたびに埋め込み・評価の段階へ流す。
+段階の間は上限つきのキューでつなぎ、後ろの段階が詰まると前の段階の put が待たされる（背圧）。
+埋め込みの段階は embed_batch 件たまるか max_wait 秒たつまでまとめてから1リクエストで取る
+（マイクロバッチ）ので、1問ずつ取るよりリクエスト数が少なくて済む。
+1問題セットの所要時間は各段階の合計ではなく、いちばん遅い段階に近づく。
+
+- StagePipeline: asyncio 版（sweep.py / bench.py）。put(q) で流し込み、finish() で結果を受け取る
+- VariantPipeline: 同期版（Streamlit アプリ）。裏のスレッドのイベントループで StagePipeline を動かす
+- pipelined_variants: 並列生成から評価までを1つのパイプラインで実行する
+"""
+import asyncio
+import threading
+import time
+from dataclasses import dataclass, field
+
+import quiz_pipeline as qp
+from cancellation import Cancelled
+from metrics import compute_metrics
+
+EMBED_BATCH = 5
+EVAL_BATCH = 3
+MAX_WAIT = 0.2
+QUEUE_SIZE = 8
+EVAL_WORKERS = 2
+
+_DONE = object()
+
+
+@dataclass
+class PipelineResult:
+    questions: list = field(default_factory=list)
+    embeddings: list = field(default_factory=list)
+    scores: dict = field(default_factory=dict)
+    stage_busy: dict = field(default_factory=dict)
+    embedding_requests: int = 0
+    wall_time: float = 0.0
+
+    def avg_cosine_similarity(self):
+        return qp.avg_pairwise_similarity(self.embeddings)
+
+
+async def _micro_batch(queue, size, max_wait):
+    """最初の1件を待ち、その後 size 件たまるか max_wait 秒たつまで集める。終わりなら (batch, True)"""
+    first = await queue.get()
+    if first is _DONE:
+        return [], True
+    batch = [first]
+    deadline = time.perf_counter() + max_wait
+    while len(batch) < size:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            break
+        try:
+            item = await asyncio.wait_for(queue.get(), remaining)
+        except asyncio.TimeoutError:
+            break
+        if item is _DONE:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+class StagePipeline:
+    """put(q) で問題を流し込み、finish() ですべての段階が終わるのを待って PipelineResult を返す
+
+    embed=False（または client なし）なら埋め込みの段階を、metrics が空なら評価の段階を飛ばす。
+    同期クライアントを渡すときは is_async=False。評価の段階は eval_workers 個のバッチを同時に進める。
+    metrics は metrics.py に登録された問題ごとの指標（faithfulness・bertscore など）。
+    contexts_fn(q) を渡すと評価の根拠を問題ごとに変えられる（select_context など）。
+    """
+
+    def __init__(self, paragraph, client=None, metrics=(), telemetry=None, evaluate_fn=None,
+                 contexts_fn=None, embed_batch=EMBED_BATCH, eval_batch=EVAL_BATCH, max_wait=MAX_WAIT,
+                 queue_size=QUEUE_SIZE, eval_workers=EVAL_WORKERS, embed=True, is_async=True,
+                 executor=None):
+        self.paragraph = paragraph
+        self.client = client
+        self.is_async = is_async
+        self.metrics = list(metrics)
+        self.telemetry = telemetry
+        self.evaluate_fn = evaluate_fn
+        self.contexts_fn = contexts_fn
+        self.embed_batch = embed_batch
+        self.eval_batch = eval_batch
+        self.max_wait = max_wait
+        self.eval_workers = eval_workers
+        self.executor = executor
+        self.embed_queue = asyncio.Queue(queue_size) if embed and client is not None else None
+        self.eval_queue = asyncio.Queue(queue_size) if self.metrics else None
+        self.result = PipelineResult(scores={m: [] for m in self.metrics})
+        self.embeddings = {}
+        self.scores = {}
+        self.start = time.perf_counter()
+        self.workers = []
+        if self.embed_queue is not None:
+            self.workers.append(asyncio.ensure_future(self._embed_worker()))
+        if self.eval_queue is not None:
+            self.workers += [asyncio.ensure_future(self._eval_worker()) for _ in range(eval_workers)]
+
+    async def put(self, q):
+        """問題を1つ流し込む（次の段階のキューがいっぱいなら空くまで待つ）"""
+        item = (len(self.result.questions), q)
+        self.result.questions.append(q)
+        if self.embed_queue is not None:
+            await self.embed_queue.put(item)
+        elif self.eval_queue is not None:
+            await self.eval_queue.put(item)
+
+    def _busy(self, stage, start):
+        self.result.stage_busy[stage] = self.result.stage_busy.get(stage, 0.0) + time.perf_counter() - start
+
+    async def _embed_worker(self):
+        done = False
+        while not done:
+            batch, done = await _micro_batch(self.embed_queue, self.embed_batch, self.max_wait)
+            if batch:
+                start = time.perf_counter()
+                answers = [qp.correct_answer(q) for _, q in batch]
+                if self.is_async:
+                    response = await self.client.embeddings.create(input=answers, model=qp.EMBEDDING_MODEL)
+                else:
+                    # 同期クライアントは別スレッドで呼び、待っている間も次の問題を受け付ける
+                    response = await asyncio.to_thread(self.client.embeddings.create, input=answers,
+                                                       model=qp.EMBEDDING_MODEL)
+                self.result.embedding_requests += 1
+                for (i, _), e in zip(batch, response.data):
+                    self.embeddings[i] = e.embedding
+                self._busy("embedding", start)
+                if self.eval_queue is not None:
+                    for item in batch:
+                        await self.eval_queue.put(item)
+        await self._close_eval_queue()
+
+    async def _close_eval_queue(self):
+        if self.eval_queue is not None:
+            for _ in range(self.eval_workers):
+                await self.eval_queue.put(_DONE)
+
+    async def _eval_worker(self):
+        done = False
+        while not done:
+            batch, done = await _micro_batch(self.eval_queue, self.eval_batch, self.max_wait)
+            if not batch:
+                continue
+            start = time.perf_counter()
+            questions = [q for _, q in batch]
+            contexts = None
+            if self.contexts_fn is not None:
+                contexts = await asyncio.to_thread(lambda: [self.contexts_fn(q) for q in questions])
+            values = await compute_metrics(
+                self.metrics, questions, self.paragraph, contexts=contexts, client=self.client,
+                telemetry=self.telemetry, evaluate_fn=self.evaluate_fn, executor=self.executor,
+            )
+            for metric, scores in values.items():
+                for (i, _), score in zip(batch, scores):
+                    self.scores[(metric, i)] = score
+            self._busy("evaluation", start)
+
+    async def finish(self):
+        """流し込みの終わりを伝え、すべての段階が終わるのを待つ"""
+        if self.embed_queue is not None:
+            await self.embed_queue.put(_DONE)
+        else:
+            await self._close_eval_queue()
+        await asyncio.gather(*self.workers)
+        n = len(self.result.questions)
+        if self.embed_queue is not None:
+            self.result.embeddings = [self.embeddings[i] for i in range(n)]
+        for metric in self.metrics:
+            self.result.scores[metric] = [self.scores[(metric, i)] for i in range(n)]
+        self.result.wall_time = time.perf_counter() - self.start
+        if self.telemetry is not None:
+            self.telemetry.record_event(
+                "pipeline", questions=n, embedding_requests=self.result.embedding_requests,
+                wall_time=round(self.result.wall_time, 4),
+                **{f"{stage}_busy": round(t, 4) for stage, t in self.result.stage_busy.items()},
+            )
+        return self.result
+
+
+class VariantPipeline:
+    """Streamlit アプリ用の同期版。生成ループで submit(q) し、ループの後で close() が PipelineResult を返す
+
+    パイプライン本体は裏のスレッドのイベントループで動くので、生成（ストリーミング）の最中に
+    埋め込み・評価が進む。次の段階が詰まっていると submit は空くまで待つ（背圧）。
+    cancel（cancellation.CancelToken）が取り消されると、段階のタスクを止めてスレッドを終える
+    （再実行で捨てられた問題セットの埋め込み・評価を続けない）。
+    """
+
+    def __init__(self, paragraph, client=None, metrics=(), cancel=None, **kwargs):
+        self.cancel = cancel
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.pipeline = self._call(self._create(paragraph, client, metrics, kwargs))
+        if cancel is not None:
+            cancel.on_cancel(lambda: self.loop.call_soon_threadsafe(self._abort))
+
+    def _run(self):
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def _create(self, paragraph, client, metrics, kwargs):
+        if self.cancel is not None:
+            # 段階のタスク（とそこから to_thread で呼ぶ API）がトークンを current_token で見られるようにする
+            self.cancel.activate()
+        return StagePipeline(paragraph, client, metrics, is_async=False, **kwargs)
+
+    def _abort(self):
+        # 段階のタスクに加え、submit / close で待っているタスクも止める（呼び出し側が待ち続けないように）
+        tasks = [task for task in asyncio.all_tasks(self.loop) if not task.done()]
+        if not tasks:
+            self.loop.stop()
+            return
+        for task in tasks:
+            task.cancel()
+        # wait_for の最中の取り消しは取りこぼされることがある（Python 3.11）ので、止まるまで繰り返す
+        self.loop.call_later(0.05, self._abort)
+
+    def _call(self, coro):
+        if self.cancel is not None and self.cancel.cancelled:
+            coro.close()
+            raise Cancelled(self.cancel.reason)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def submit(self, q):
+        self._call(self.pipeline.put(q))
+
+    def close(self):
+        try:
+            return self._call(self.pipeline.finish())
+        finally:
+            try:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+            except RuntimeError:
+                pass  # 取り消しで既に止まっている
+            self.thread.join()
+
+
+async def pipelined_variants(aclient, paragraph, num_variants, temperature, model=qp.GENERATION_MODEL,
+                             concurrency=5, seed=None, per_call=1, telemetry=None, run=None,
+                             metrics=(), evaluate_fn=None, embed=True, **kwargs):
+    """num_variants 問を並列生成し、読み込めた問題から順に埋め込み・評価へ流す。PipelineResult を返す"""
+    pipeline = StagePipeline(paragraph, aclient, metrics, telemetry=telemetry, evaluate_fn=evaluate_fn,
+                             embed=embed, **kwargs)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(v, k):
+        async with semaphore:
+            questions = await qp.generate_question_set(aclient, paragraph, k, temperature, model,
+                                                       qp.variant_seed(seed, v), telemetry, run)
+        for q in questions:
+            await pipeline.put(q)
+
+    starts = range(0, num_variants, per_call)
+    await asyncio.gather(*(_one(v, min(per_call, num_variants - v)) for v in starts))
+    return await pipeline.finish()
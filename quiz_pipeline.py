@@ -0,0 +1,1025 @@
+import asyncio
+import copy
+import csv
+import math
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from json import loads
+
+import numpy as np
+
+from metric_cache import get_metric_cache
+
+# ===== 共通設定 =====
+GENERATION_MODEL = "gpt-4.1"
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+SYSTEM_PROMPT = (
+    "あなたはクイズの出題者です。以下の文から四択問題を作成してください。"
+    "本文内容に基づいた問題にしてください。"
+    "出力はJSON形式で返してください。"
+)
+
+QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Question": {"type": "string"},
+        "Choice1": {"type": "string"},
+        "Choice2": {"type": "string"},
+        "Choice3": {"type": "string"},
+        "Choice4": {"type": "string"},
+        "CorrectAnswer": {"type": "number"},
+    },
+    "required": ["Question", "Choice1", "Choice2", "Choice3", "Choice4", "CorrectAnswer"],
+    "additionalProperties": False,
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "QuestionData",
+        "schema": QUESTION_SCHEMA,
+        "strict": True,
+    },
+}
+
+
+def question_response_format(k=1, with_explanation=False):
+    """k 問を1回で生成する response_format（k=1 なら従来の QuestionData と同じ）"""
+    item = QUESTION_SCHEMA
+    if with_explanation:
+        item = {
+            **QUESTION_SCHEMA,
+            "properties": {**QUESTION_SCHEMA["properties"], "Explanation": {"type": "string"}},
+            "required": QUESTION_SCHEMA["required"] + ["Explanation"],
+        }
+    if k == 1:
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": "QuestionData", "schema": item, "strict": True},
+        }
+    # strict モードでは最上位が object である必要があるので配列を Questions で包む
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "QuestionSet",
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "Questions": {
+                        "type": "array",
+                        "description": f"互いに異なる観点から作った四択問題 {k} 問",
+                        "items": item,
+                        "minItems": k,
+                        "maxItems": k,
+                    },
+                },
+                "required": ["Questions"],
+                "additionalProperties": False,
+            },
+            "strict": True,
+        },
+    }
+
+
+def parse_questions(data):
+    """QuestionSet / QuestionData / 配列のどれでも問題のリストにする"""
+    if isinstance(data, dict) and "Questions" in data:
+        return list(data["Questions"])
+    if isinstance(data, list):
+        return data
+    return [data]
+
+
+def expected_question_count(response_format):
+    """response_format から1回の応答に入るはずの問題数を読む"""
+    try:
+        return response_format["json_schema"]["schema"]["properties"]["Questions"]["minItems"]
+    except (KeyError, TypeError):
+        return 1
+
+
+def with_question_count(response_format, k):
+    """QuestionSet の問題数だけを k に変えた response_format（QuestionData はそのまま）"""
+    if not response_format or response_format.get("json_schema", {}).get("name") != "QuestionSet":
+        return response_format
+    response_format = copy.deepcopy(response_format)
+    questions = response_format["json_schema"]["schema"]["properties"]["Questions"]
+    questions.update({"minItems": k, "maxItems": k,
+                      "description": f"互いに異なる観点から作った四択問題 {k} 問"})
+    return response_format
+
+
+# ===== JSON の修復 =====
+_CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+
+# 構造に使われた全角記号（文字列の外だけ置き換える）
+_FULLWIDTH = {"｛": "{", "｝": "}", "［": "[", "］": "]", "：": ":", "，": ",",
+              "＂": '"', "“": '"', "”": '"'}
+_CLOSE_QUOTE_FOLLOWERS = ",:}]，：｝］"
+
+
+def _next_char(text, i):
+    """i 以降で最初の空白以外の文字（なければ空文字）"""
+    while i < len(text) and text[i].isspace():
+        i += 1
+    return text[i] if i < len(text) else ""
+
+
+def repair_json(text):
+    """生成結果の JSON をローカルで修復して読み込む
+
+    コードフェンス・前後の説明文・全角の記号・末尾のカンマ・文字列中の改行・途中で切れた括弧を直す。
+    戻り値は (data, 適用した修復名のリスト)。直せなければ ValueError を投げる。
+    """
+    try:
+        return loads(text), []
+    except ValueError:
+        pass
+
+    repairs = []
+    fence = _CODE_FENCE.search(text)
+    if fence:
+        text = fence.group(1)
+        repairs.append("code_fence")
+    starts = [i for i in (text.find("{"), text.find("｛")) if i >= 0]
+    if not starts:
+        raise ValueError("JSON オブジェクトが見つかりません")
+    if text[:min(starts)].strip():
+        repairs.append("surrounding_text")
+    text = text[min(starts):]
+
+    out = []
+    stack = []
+    cuts = []  # 値が1つ閉じた位置（切り詰めて閉じ直す候補）と、その時点の括弧の状態
+    in_string = escape = False
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"' or (c in "”＂" and _next_char(text, i + 1) in _CLOSE_QUOTE_FOLLOWERS):
+                in_string = False
+                if c != '"':
+                    repairs.append("fullwidth")
+                c = '"'
+            elif c == "\n":
+                repairs.append("newline_in_string")
+                c = "\\n"
+            out.append(c)
+            i += 1
+            continue
+
+        if c in _FULLWIDTH:
+            repairs.append("fullwidth")
+            c = _FULLWIDTH[c]
+        if c == '"':
+            in_string = True
+        elif c == ",":
+            if _next_char(text, i + 1) in ("}", "]", "｝", "］"):
+                repairs.append("trailing_comma")
+                i += 1
+                continue
+            cuts.append((len(out), list(stack)))
+        elif c in "{[":
+            stack.append(c)
+        elif c in "}]":
+            if not stack:
+                break
+            stack.pop()
+            out.append(c)
+            i += 1
+            if not stack:
+                if text[i:].strip():
+                    repairs.append("surrounding_text")
+                break
+            cuts.append((len(out), list(stack)))
+            continue
+        out.append(c)
+        i += 1
+
+    def _closed(body, open_brackets):
+        return body + "".join("}" if b == "{" else "]" for b in reversed(open_brackets))
+
+    body = "".join(out)
+    candidates = []
+    if in_string:
+        candidates.append(_closed(body + '"', stack))
+    elif stack:
+        candidates.append(_closed(body.rstrip().rstrip(","), stack))
+    else:
+        candidates.append(body)
+    if stack:
+        repairs.append("truncated")
+        # 閉じ直しても読めなければ、最後に値が閉じた位置まで戻って閉じる
+        candidates += [_closed("".join(out[:cut]), brackets) for cut, brackets in reversed(cuts)]
+
+    for candidate in candidates:
+        try:
+            data = loads(candidate)
+        except ValueError:
+            continue
+        return data, sorted(set(repairs))
+    raise ValueError("JSON を修復できませんでした")
+
+
+def _is_complete(q):
+    return isinstance(q, dict) and all(key in q for key in QUESTION_SCHEMA["required"])
+
+
+def load_questions(text):
+    """生成結果を問題のリストにする（必要ならローカル修復）。戻り値は (questions, 修復名のリスト)
+
+    途中で切れた問題など必須項目の欠けたものは除く。1問も残らなければ ValueError。
+    """
+    data, repairs = repair_json(text)
+    questions = [q for q in parse_questions(data) if _is_complete(q)]
+    if not questions:
+        raise ValueError("問題として読める項目がありません")
+    return questions, repairs
+
+
+def _parse_output(text):
+    """(questions, 修復名のリスト)。読めなければ ([], None)"""
+    try:
+        return load_questions(text or "")
+    except ValueError:
+        return [], None
+
+
+def _repair_outcome(parsed, expected, repairs, recovered):
+    """JSON 読み込みの結果。parsed: 最初の応答から読めた問題数、recovered: 再リクエストで読めた問題数"""
+    if parsed >= expected:
+        return "repaired" if repairs else "ok"
+    return "rerequested" if recovered else "failed"
+
+
+def _log_repair(telemetry, outcome, repairs):
+    """JSON 読み込みの結果（ok / repaired / rerequested / failed）を記録"""
+    if telemetry is not None:
+        telemetry.record_event("json_repair", outcome=outcome, repairs=repairs or [])
+
+
+# ===== 生成結果のローカル検証 =====
+# 正解の選択肢の文字 n-gram のうち、元の文章にも現れる割合の下限
+MIN_ANSWER_OVERLAP = 0.3
+ANSWER_NGRAM = 2
+
+
+def _normalize_text(text):
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(text))).lower()
+
+
+def _char_ngrams(text, n):
+    if len(text) < n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+def validate_questions(questions, source, ngram=ANSWER_NGRAM, min_overlap=MIN_ANSWER_OVERLAP):
+    """評価に回す前の安価な検証（API 呼び出しなし）
+
+    - CorrectAnswer が 1〜4 の整数か（2.0 のような値も通す。直した値は screen_questions が返す）
+    - 4つの選択肢が互いに異なるか
+    - 正解の選択肢の文字 n-gram が元の文章に min_overlap 以上含まれるか
+
+    問題数ぶんをまとめて numpy で判定し、(合格マスク, 問題ごとの不合格理由のリスト) を返す。
+    """
+    n = len(questions)
+    if n == 0:
+        return np.zeros(0, dtype=bool), []
+
+    # 正解番号の範囲
+    raw = [q.get("CorrectAnswer") for q in questions]
+    values = np.array([float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan
+                       for v in raw])
+    index_ok = np.isfinite(values) & (values == np.round(values)) & (values >= 1) & (values <= 4)
+
+    # 選択肢の重複（正規化した文字列の 4×4 比較で対角以外に一致があれば重複）
+    choices = np.array([[_normalize_text(q.get(f"Choice{j}", "")) for j in range(1, 5)] for q in questions])
+    same = choices[:, :, None] == choices[:, None, :]
+    unique_ok = same.sum(axis=(1, 2)) == 4
+
+    # 正解の選択肢と元の文章の文字 n-gram の重なり
+    source_text = _normalize_text(source)
+    source_grams = np.array(sorted(set(_char_ngrams(source_text, ngram)) | set(source_text)) or [""])
+    grams, owners = [], []
+    for i, q in enumerate(questions):
+        if not index_ok[i]:
+            continue
+        answer_grams = _char_ngrams(_normalize_text(q.get(f"Choice{int(values[i])}", "")), ngram)
+        grams += answer_grams
+        owners += [i] * len(answer_grams)
+    hits = np.isin(np.array(grams, dtype=str), source_grams)
+    totals = np.bincount(np.array(owners, dtype=int), minlength=n)
+    matched = np.bincount(np.array(owners, dtype=int), weights=hits.astype(float), minlength=n)
+    overlap = np.divide(matched, totals, out=np.zeros(n), where=totals > 0)
+    overlap_ok = overlap >= min_overlap
+
+    valid = index_ok & unique_ok & overlap_ok
+    reasons = []
+    for i, q in enumerate(questions):
+        reason = []
+        if not index_ok[i]:
+            reason.append("answer_index")
+        if not unique_ok[i]:
+            reason.append("duplicate_choices")
+        if index_ok[i] and not overlap_ok[i]:
+            reason.append("answer_not_in_source")
+        reasons.append(reason)
+    return valid, reasons
+
+
+def partition_questions(questions, source):
+    """(検証に通った問題のコピー, [(落ちた問題, 理由のリスト), ...]) に分ける
+
+    通った問題は CorrectAnswer を整数に直したコピー（渡された問題は書き換えない）。
+    """
+    if not questions:
+        return [], []
+    valid, reasons = validate_questions(questions, source)
+    accepted = [{**q, "CorrectAnswer": int(q["CorrectAnswer"])} for q, ok in zip(questions, valid) if ok]
+    rejected = [(q, reason) for q, ok, reason in zip(questions, valid, reasons) if not ok]
+    return accepted, rejected
+
+
+def screen_questions(questions, source, telemetry=None):
+    """検証に通った問題だけを返し、落ちた理由を記録する
+
+    返すのは CorrectAnswer を整数に直したコピー（渡された問題は書き換えない）。
+    """
+    accepted, rejected = partition_questions(questions, source)
+    for _, reason in rejected:
+        _log_validation(telemetry, reason)
+    return accepted
+
+
+def _log_validation(telemetry, reasons):
+    if telemetry is not None:
+        telemetry.record_event("validation", outcome="rejected", reasons=reasons)
+
+
+def _source_text(kwargs):
+    """検証に使う元の文章（user メッセージの本文）"""
+    return "\n".join(m.get("content") or "" for m in kwargs.get("messages", []) if m.get("role") == "user")
+
+
+RETRY_PROMPT = (
+    "前回の出力は JSON として読み込めないか、使えない問題を含んでいました。"
+    "指定された JSON Schema に厳密に従い、本文の内容に基づいた問題を {k} 問だけ出力してください。"
+)
+
+
+def _record(run, questions, kwargs):
+    """生成できた問題をリクエストと一緒に保存（run がなければ何もしない）"""
+    if run is not None:
+        for q in questions:
+            run.add(q, kwargs)
+
+
+def retry_request(kwargs, missing):
+    """足りない問題数だけを1回で頼み直すリクエスト"""
+    return {
+        **kwargs,
+        "messages": list(kwargs.get("messages", [])) + [
+            {"role": "user", "content": RETRY_PROMPT.format(k=missing)}
+        ],
+        "response_format": with_question_count(kwargs.get("response_format"), missing),
+    }
+
+
+# ===== PDF → CSV変換 =====
+def pdf_to_csv(pdf_file, csv_file="Book1.csv", split="paragraph"):
+    """PDFを段落（paragraph）またはページ（page）単位でCSVに保存"""
+    import pdfplumber
+
+    explanations = []
+    with pdfplumber.open(pdf_file) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text()
+            if not text:
+                continue
+            if split == "page":
+                explanations.append([text.strip()])
+                continue
+            for line in text.split("\n\n"):
+                line = line.strip()
+                if line:
+                    explanations.append([line])
+    with open(csv_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerows(explanations)
+
+
+def load_explanations_from_csv(filename="Book1.csv"):
+    explanations = []
+    with open(filename, "r", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if row:
+                explanations.append(row[0])
+    return explanations
+
+
+# ===== 問題生成 =====
+def build_messages(paragraph, system_prompt=SYSTEM_PROMPT):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": paragraph},
+    ]
+
+
+# ===== ストリーミング生成 =====
+class IncrementalQuestionParser:
+    """ストリームの断片を受け取り、閉じた QuestionData オブジェクトから順に返す
+
+    QuestionSet（{"Questions": [...]}）では配列要素の {...} が閉じるたびに1問返す。
+    単一の QuestionData は最上位の {...} が閉じた時点で返す。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.emitted = 0
+        self.questions = []
+        self.repairs = []
+
+    def feed(self, text):
+        self.buffer += text
+        questions = []
+        while self.pos < len(self.buffer):
+            c = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.stack.append((c, self.pos))
+            elif c in "}]" and self.stack:
+                opener, start = self.stack.pop()
+                if c == "}" and opener == "{":
+                    questions.extend(self._closed_object(start, self.emitted + len(questions)))
+            self.pos += 1
+        self.emitted += len(questions)
+        self.questions.extend(questions)
+        return questions
+
+    def _closed_object(self, start, emitted):
+        inside_array = bool(self.stack) and self.stack[-1][0] == "["
+        is_root = not self.stack
+        # 最上位の {...} は、配列の要素をまだ1問も返していないとき（単一の QuestionData）だけ読む
+        if not inside_array and not (is_root and emitted == 0):
+            return []
+        try:
+            data = loads(self.buffer[start:self.pos + 1])
+        except Exception:
+            return []
+        return [data] if inside_array else parse_questions(data)
+
+    def close(self):
+        """ストリーム終了時の処理。途中で取り出せなかった問題をローカル修復で回収する（読めなければ ValueError）"""
+        questions, self.repairs = load_questions(self.buffer)
+        rest = [q for q in questions if q not in self.questions]
+        self.emitted += len(rest)
+        self.questions.extend(rest)
+        return rest
+
+
+def _stream_once(client, parser, kwargs, cancel=None):
+    """ストリームを読み、同じ断片で閉じた問題（と終了時に修復で回収した問題）をリストでまとめて yield する"""
+    # 最後の断片で usage を受け取り、telemetry がトークン数・コストを記録できるようにする
+    stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+    if cancel is not None and hasattr(stream, "close"):
+        # 取り消されたら接続を閉じ、残りの出力を待たない
+        cancel.on_cancel(stream.close)
+    for chunk in stream:
+        if cancel is not None and cancel.cancelled:
+            return
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            batch = parser.feed(delta)
+            if batch:
+                yield batch
+    rest = parser.close()
+    if rest:
+        yield rest
+
+
+def stream_questions(client, telemetry=None, run=None, cancel=None, **kwargs):
+    """stream=True で生成し、問題が1つ閉じて検証に通るたびに dict を yield する
+
+    読み切れなかった部分はローカルで修復し、修復や検証で足りなくなった問題数だけを1回だけ再リクエストする。
+    1問も得られなかった場合は ValueError を投げる。
+    run（run_store.GenerationRun）を渡すと、yield する問題をリクエストと一緒に保存する。
+    cancel（cancellation.CancelToken）が取り消されたら、ストリームを閉じて何も言わずに終わる。
+    """
+    expected = expected_question_count(kwargs.get("response_format"))
+    source = _source_text(kwargs)
+    parser = IncrementalQuestionParser()
+    accepted = 0
+    try:
+        # 検証は取り出せた問題ごとではなく、断片ごとにまとめて行う（修復で回収した分は1回で）
+        for batch in _stream_once(client, parser, kwargs, cancel):
+            for q in screen_questions(batch, source, telemetry):
+                accepted += 1
+                _record(run, [q], kwargs)
+                yield q
+    except ValueError:
+        pass
+    except Exception:
+        # 取り消しで閉じたストリームの読み込みエラーは無視する
+        if cancel is None or not cancel.cancelled:
+            raise
+    if cancel is not None and cancel.cancelled:
+        return
+    missing = expected - accepted
+    if missing <= 0:
+        _log_repair(telemetry, _repair_outcome(parser.emitted, expected, parser.repairs, 0), parser.repairs)
+        return
+
+    retry = IncrementalQuestionParser()
+    retry_kwargs = retry_request(kwargs, missing)
+    recovered = 0
+    try:
+        for batch in _stream_once(client, retry, retry_kwargs, cancel):
+            for q in screen_questions(batch, source, telemetry)[:missing - recovered]:
+                recovered += 1
+                _record(run, [q], retry_kwargs)
+                yield q
+    except ValueError:
+        pass
+    except Exception:
+        if cancel is None or not cancel.cancelled:
+            raise
+    if cancel is not None and cancel.cancelled:
+        return
+    _log_repair(telemetry, _repair_outcome(parser.emitted, expected, parser.repairs, retry.emitted),
+                parser.repairs)
+    if accepted + recovered == 0:
+        raise ValueError("JSON の修復・検証・再リクエストのいずれでも使える問題が得られませんでした")
+
+
+def complete_questions(client, telemetry=None, run=None, **kwargs):
+    """1回生成して検証済みの問題リストを返す（ストリームなし）
+
+    修復や検証で足りなくなった問題数だけを1回だけ再リクエストする。得られなければ空リスト。
+    """
+    expected = expected_question_count(kwargs.get("response_format"))
+    source = _source_text(kwargs)
+    response = client.chat.completions.create(**kwargs)
+    parsed, repairs = _parse_output(response.choices[0].message.content)
+    questions = screen_questions(parsed, source, telemetry)
+    _record(run, questions, kwargs)
+    recovered = []
+    missing = expected - len(questions)
+    if missing > 0:
+        retry_kwargs = retry_request(kwargs, missing)
+        response = client.chat.completions.create(**retry_kwargs)
+        recovered, _ = _parse_output(response.choices[0].message.content)
+        retried = screen_questions(recovered, source, telemetry)[:missing]
+        _record(run, retried, retry_kwargs)
+        questions += retried
+    _log_repair(telemetry, _repair_outcome(len(parsed), expected, repairs, len(recovered)), repairs)
+    return questions
+
+
+def render_question(container, idx, q):
+    """生成途中の一覧表示用（Streamlit の container / placeholder に描画）"""
+    container.markdown(f"### 問題 {idx}: {q['Question']}")
+    container.markdown(
+        f"1. {q['Choice1']}  \n"
+        f"2. {q['Choice2']}  \n"
+        f"3. {q['Choice3']}  \n"
+        f"4. {q['Choice4']}  \n"
+        f"✅ 正解: {correct_answer(q)}"
+    )
+
+
+def variant_seed(seed, variant):
+    """variant 番目（0 始まり）の問題から始まる生成呼び出しに送る seed（seed が None なら送らない）
+
+    同じプロンプトの呼び出しに同じ seed を送ると temperature>0 でも出力が似通うので、呼び出しごとにずらす。
+    """
+    return None if seed is None else seed + variant
+
+
+def correct_answer(q):
+    """問題データから正解の選択肢テキストを取り出す"""
+    return q[f"Choice{int(q['CorrectAnswer'])}"]
+
+
+async def generate_question_set(aclient, paragraph, k, temperature, model=GENERATION_MODEL, seed=None,
+                                telemetry=None, run=None):
+    """1回の呼び出しで k 問生成（修復・検証・1回の再リクエストでも足りなかった分は欠ける）"""
+    kwargs = {
+        "model": model,
+        "messages": build_messages(paragraph),
+        "response_format": question_response_format(k),
+        "temperature": temperature,
+    }
+    if seed is not None:
+        kwargs["seed"] = seed
+    response = await aclient.chat.completions.create(**kwargs)
+    parsed, repairs = _parse_output(response.choices[0].message.content)
+    questions = screen_questions(parsed, paragraph, telemetry)
+    _record(run, questions, kwargs)
+    recovered = []
+    missing = k - len(questions)
+    if missing > 0:
+        retry_kwargs = retry_request(kwargs, missing)
+        response = await aclient.chat.completions.create(**retry_kwargs)
+        recovered, _ = _parse_output(response.choices[0].message.content)
+        retried = screen_questions(recovered, paragraph, telemetry)[:missing]
+        _record(run, retried, retry_kwargs)
+        questions += retried
+    _log_repair(telemetry, _repair_outcome(len(parsed), k, repairs, len(recovered)), repairs)
+    return questions
+
+
+async def generate_variant(aclient, paragraph, temperature, model=GENERATION_MODEL, seed=None,
+                           telemetry=None, run=None):
+    """1問生成（読み込めなかった場合は None）"""
+    questions = await generate_question_set(aclient, paragraph, 1, temperature, model, seed, telemetry,
+                                            run)
+    return questions[0] if questions else None
+
+
+async def generate_variants(aclient, paragraph, num_variants, temperature,
+                            model=GENERATION_MODEL, concurrency=5, seed=None, per_call=1,
+                            telemetry=None, run=None):
+    """num_variants 問を同時実行数 concurrency で並列生成（1回の呼び出しで per_call 問ずつ）
+
+    seed を渡すと、v 問目から始まる呼び出しには seed + v を送る（variant_seed）。
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(v, k):
+        async with semaphore:
+            return await generate_question_set(aclient, paragraph, k, temperature, model,
+                                               variant_seed(seed, v), telemetry, run)
+
+    starts = range(0, num_variants, per_call)
+    results = await asyncio.gather(*(_one(v, min(per_call, num_variants - v)) for v in starts))
+    return [q for questions in results for q in questions]
+
+
+# ===== 埋め込み + 類似度 =====
+async def embed_texts(aclient, texts, model=EMBEDDING_MODEL):
+    """テキストの埋め込みを1リクエストでまとめて取得"""
+    if not texts:
+        return []
+    response = await aclient.embeddings.create(input=texts, model=model)
+    return [e.embedding for e in response.data]
+
+
+class EmbeddingCache:
+    """同じ文の埋め込みを取り直さないためのプロセス内キャッシュ（古いものから捨てる）"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def embed(self, client, texts, model=EMBEDDING_MODEL):
+        """texts の埋め込みを返す。未取得の分だけを1リクエストでまとめて取る"""
+        with self.lock:
+            missing = list(dict.fromkeys(t for t in texts if (model, t) not in self.entries))
+        if missing:
+            response = client.embeddings.create(input=missing, model=model)
+            with self.lock:
+                for text, e in zip(missing, response.data):
+                    self.entries[(model, text)] = e.embedding
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        with self.lock:
+            for t in texts:
+                self.entries.move_to_end((model, t))
+            return [self.entries[(model, t)] for t in texts]
+
+
+_embedding_cache = EmbeddingCache()
+
+
+def cached_embeddings(client, texts, model=EMBEDDING_MODEL):
+    return _embedding_cache.embed(client, texts, model)
+
+
+def cosine_similarity(a, b):
+    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+def similarity_matrix(embeddings):
+    """正規化済み埋め込みからコサイン類似度行列を一括計算"""
+    vectors = np.asarray(embeddings, dtype=float)
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors @ vectors.T
+
+
+def avg_pairwise_similarity(embeddings):
+    """全ペア（i < j）の平均コサイン類似度"""
+    n = len(embeddings)
+    if n < 2:
+        return float("nan")
+    sims = similarity_matrix(embeddings)
+    return float(sims[np.triu_indices(n, k=1)].mean())
+
+
+# ===== ほぼ同じ問題のまとめ =====
+# 正解の選択肢の埋め込みがこれ以上似ている問題は同じクラスタとみなす
+DUPLICATE_THRESHOLD = 0.95
+
+
+def near_duplicate_clusters(embeddings, threshold=DUPLICATE_THRESHOLD):
+    """類似度行列でしきい値以上の問題をまとめ、各問題が属するクラスタの代表の番号を返す
+
+    前から順に、まだどこにも属していない問題を代表にして、それに似た未所属の問題を取り込む。
+    """
+    n = len(embeddings)
+    clusters = np.full(n, -1, dtype=int)
+    if n == 0:
+        return clusters
+    sims = similarity_matrix(embeddings)
+    for i in range(n):
+        if clusters[i] >= 0:
+            continue
+        members = (clusters < 0) & (sims[i] >= threshold)
+        members[i] = True
+        clusters[members] = i
+    return clusters
+
+
+def cluster_representatives(clusters):
+    """評価する代表の問題番号（昇順）"""
+    return sorted({int(c) for c in clusters})
+
+
+def propagate_scores(scores_by_representative, clusters):
+    """代表のスコアを同じクラスタの問題すべてに割り当てる"""
+    return [scores_by_representative[int(c)] for c in clusters]
+
+
+def evaluate_representatives(items, clusters, score_fn):
+    """代表だけを score_fn（リスト → スコアのリスト）で評価し、全件ぶんのスコアにして返す"""
+    representatives = cluster_representatives(clusters)
+    scores = score_fn([items[i] for i in representatives])
+    return propagate_scores(dict(zip(representatives, scores)), clusters)
+
+
+# ===== 生成数の適応的な打ち切り =====
+class PairwiseSimilarityStats:
+    """全ペアのコサイン類似度の平均・分散を、1件追加ごとに O(n) で更新する"""
+
+    def __init__(self):
+        self.vectors = []
+        self.pairs = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, embedding):
+        v = np.asarray(embedding, dtype=float)
+        v = v / np.linalg.norm(v)
+        if self.vectors:
+            sims = np.stack(self.vectors) @ v
+            self.pairs += len(sims)
+            self.total += float(sims.sum())
+            self.total_sq += float((sims ** 2).sum())
+        self.vectors.append(v)
+
+    @property
+    def n(self):
+        return len(self.vectors)
+
+    def mean(self):
+        return self.total / self.pairs if self.pairs else float("nan")
+
+    def ci_width(self, z=1.96):
+        """平均類似度の信頼区間の幅
+
+        ペアは同じ問題を共有していて独立ではないので、標本数はペア数ではなく問題数 n で数える。
+        """
+        if self.pairs < 2:
+            return float("inf")
+        mean = self.mean()
+        var = max(self.total_sq - self.pairs * mean ** 2, 0.0) / (self.pairs - 1)
+        return 2 * z * math.sqrt(var / self.n)
+
+
+# 固定生成数の従来設定（節約できた呼び出し数の比較基準）
+BASELINE_VARIANTS = 15
+
+
+class AdaptiveVariantCount:
+    """少しずつ生成し、平均類似度の信頼区間が ci_width より狭くなったら生成を打ち切る
+
+    アプリでは生成ループの1回ごとに update(client, generated_answers) を呼び、True なら break する。
+    埋め込みは新しく増えた問題の分だけ1リクエストで取り、embeddings に溜めるので後段で使い回せる。
+    """
+
+    def __init__(self, max_variants=BASELINE_VARIANTS, per_call=1, min_variants=5, ci_width=0.1,
+                 baseline=BASELINE_VARIANTS):
+        self.max_variants = max_variants
+        self.per_call = per_call
+        self.min_variants = min_variants
+        self.target_width = ci_width
+        self.baseline = baseline
+        self.stats = PairwiseSimilarityStats()
+        self.embeddings = []
+        self.generation_calls = 0
+
+    def _answers_to_embed(self, questions):
+        return [correct_answer(q) for q in questions[len(self.embeddings):]]
+
+    def add_embeddings(self, embeddings):
+        for e in embeddings:
+            self.stats.add(e)
+            self.embeddings.append(e)
+
+    def should_stop(self):
+        if self.stats.n >= self.max_variants:
+            return True
+        return self.stats.n >= self.min_variants and self.stats.ci_width() <= self.target_width
+
+    def update(self, client, questions, model=EMBEDDING_MODEL):
+        """生成1回分の結果を取り込み、打ち切るなら True"""
+        self.generation_calls += 1
+        answers = self._answers_to_embed(questions)
+        if answers:
+            response = client.embeddings.create(input=answers, model=model)
+            self.add_embeddings([e.embedding for e in response.data])
+        return self.should_stop()
+
+    async def aupdate(self, aclient, questions, model=EMBEDDING_MODEL):
+        self.generation_calls += 1
+        self.add_embeddings(await embed_texts(aclient, self._answers_to_embed(questions), model))
+        return self.should_stop()
+
+    def baseline_calls(self):
+        return math.ceil(self.baseline / self.per_call)
+
+    def calls_saved(self):
+        return max(self.baseline_calls() - self.generation_calls, 0)
+
+    def report(self):
+        return (f"{self.stats.n} 問で打ち切り（信頼区間幅 {self.stats.ci_width():.3f}）: "
+                f"生成呼び出し {self.generation_calls} 回 / 固定{self.baseline}問なら "
+                f"{self.baseline_calls()} 回（{self.calls_saved()} 回節約）")
+
+
+async def generate_variants_adaptive(aclient, paragraph, temperature, model=GENERATION_MODEL,
+                                     max_variants=BASELINE_VARIANTS, batch_size=3, min_variants=5,
+                                     ci_width=0.1, concurrency=5, seed=None, per_call=1, telemetry=None,
+                                     run=None):
+    """batch_size 問ずつ生成し、平均類似度が収束したら止める。(questions, controller) を返す"""
+    controller = AdaptiveVariantCount(max_variants, per_call, min_variants, ci_width)
+    questions = []
+    requested = 0
+    while len(questions) < max_variants:
+        k = min(batch_size, max_variants - len(questions))
+        # バッチをまたいで同じ seed を送らないよう、これまでに頼んだ問題数だけずらす
+        batch = await generate_variants(aclient, paragraph, k, temperature, model, concurrency,
+                                        variant_seed(seed, requested), per_call, telemetry, run)
+        requested += k
+        if not batch:
+            break
+        questions += batch
+        # バッチ内の生成呼び出し数ぶん数える（埋め込みはまとめて1回）
+        controller.generation_calls += math.ceil(k / per_call) - 1
+        if await controller.aupdate(aclient, questions):
+            break
+    return questions, controller
+
+
+# ===== 評価用コンテキストの絞り込み =====
+CONTEXT_TOP_K = 3
+CONTEXT_TOKEN_BUDGET = 400
+
+
+def approx_tokens(text):
+    """トークン数の目安（英数字は4文字で1トークン、日本語などは1文字1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def split_sentences(text):
+    sentences = [s.strip() for s in re.split(r"(?<=[。！？!?])|\n", text)]
+    return [s for s in sentences if s] or [text]
+
+
+def select_context(client, q, paragraph, k=CONTEXT_TOP_K, token_budget=CONTEXT_TOKEN_BUDGET,
+                   telemetry=None):
+    """本文を文に分け、問題文と正解に近い上位 k 文（token_budget 以内）だけを元の順で返す
+
+    文の埋め込みは EmbeddingCache に残るので、同じ本文の問題が続いても取り直さない。
+    """
+    sentences = split_sentences(paragraph)
+    if len(sentences) <= k and approx_tokens(paragraph) <= token_budget:
+        return paragraph
+
+    query = f"{q['Question']} {correct_answer(q)}"
+    vectors = np.asarray(cached_embeddings(client, sentences + [query]), dtype=float)
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    sims = vectors[:-1] @ vectors[-1]
+
+    chosen = []
+    used = 0
+    for i in np.argsort(-sims):
+        if len(chosen) >= k:
+            break
+        tokens = approx_tokens(sentences[i])
+        if chosen and used + tokens > token_budget:
+            continue
+        chosen.append(int(i))
+        used += tokens
+    trimmed = "\n".join(sentences[i] for i in sorted(chosen))
+
+    if telemetry is not None:
+        telemetry.record_event("context_trim", before_tokens=approx_tokens(paragraph),
+                               after_tokens=approx_tokens(trimmed))
+    return trimmed
+
+
+# ===== 評価 =====
+def score_table(questions, contexts, metrics=("faithfulness", "answer_relevancy"), evaluate_fn=None,
+                telemetry=None):
+    """複数の RAGAS 指標を1回の evaluate でまとめて評価し、問題ごとの表（dict のリスト）を返す
+
+    Dataset は1つだけ作り、指標 × 問題の評価は RAGAS の executor で並行に実行される。
+    contexts は問題ごとの根拠の文字列のリスト（1つの文字列なら全問共通）。
+    metrics には指標名か ragas.metrics の指標オブジェクトを渡す。
+    evaluate_fn を省略すると評価結果キャッシュ（metric_cache.py）を通す。
+    """
+    from datasets import Dataset
+    import ragas.metrics
+
+    if evaluate_fn is None:
+        from ragas import evaluate as evaluate_fn
+        from openai_client import share_with_ragas
+
+        evaluate_fn = share_with_ragas(evaluate_fn)
+        if telemetry is not None:
+            evaluate_fn = telemetry.instrument_evaluate(evaluate_fn)
+        evaluate_fn = get_metric_cache().wrap_evaluate(evaluate_fn)
+
+    if not questions:
+        return []
+    if isinstance(contexts, str):
+        contexts = [contexts] * len(questions)
+    metrics = [getattr(ragas.metrics, m) if isinstance(m, str) else m for m in metrics]
+    names = [m.name for m in metrics]
+
+    answers = [correct_answer(q) for q in questions]
+    data = Dataset.from_dict({
+        "question": [q["Question"] for q in questions],
+        "answer": answers,
+        "contexts": [[c] for c in contexts],
+    })
+    result = evaluate_fn(data, metrics=metrics)
+    return [
+        {"question": q["Question"], "answer": a, **{name: result[name][i] for name in names}}
+        for i, (q, a) in enumerate(zip(questions, answers))
+    ]
+
+
+def faithfulness_scores(questions, context, telemetry=None, trim_client=None):
+    """各問題の Faithfulness を RAGAS で評価（trim_client を渡すと問題ごとに根拠の文を絞る）"""
+    contexts = [
+        select_context(trim_client, q, context, telemetry=telemetry) if trim_client else context
+        for q in questions
+    ]
+    return [row["faithfulness"] for row in score_table(questions, contexts, ["faithfulness"],
+                                                        telemetry=telemetry)]
+
+
+def bert_scores(answers, context, telemetry=None):
+    """正解選択肢と解説文の BERTScore（F1）。context は1つの文字列か、回答ごとの文字列のリスト"""
+    from bert_score import score
+
+    if telemetry is not None:
+        score = telemetry.instrument_function(score, "bertscore")
+    score = get_metric_cache().wrap_bert_score(score)
+
+    if not answers:
+        return []
+    cands = [context] * len(answers) if isinstance(context, str) else list(context)
+    P, R, F1 = score(
+        cands,
+        answers,
+        lang="ja",
+        model_type="bert-base-multilingual-cased"
+    )
+    return F1.tolist()
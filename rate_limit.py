@@ -0,0 +1,380 @@
+"""OpenAI API のレート制限（セッション・ワーカープロセスをまたいで共有するトークンバケット）
+
+モデルごとに「リクエスト数/分（RPM）」と「推定トークン数/分（TPM）」の2つのバケットを持ち、
+呼び出しの前に両方から差し引く。足りなければ補充されるまで待つので、429 を受けてから
+やり直すのではなく、はじめからクォータの上限の速さで送ることになる。
+
+バケットは SQLite（既定 rate_limit.db）に置き、BEGIN IMMEDIATE で読み書きするので、
+Streamlit の複数セッション（スレッド）・sweep.py・batch_sweep.py など別プロセスで同じ予算を分け合う。
+
+それでも 429 が返ったときは retry-after（retry-after-ms）を守り、ジッターつきの指数バックオフでやり直す。
+429 を受けたモデルは DB に「この時刻まで送らない」と書くので、他のプロセスもいっせいに止まり、
+429 が連鎖しない。
+
+上限は MODEL_LIMITS（環境変数 OPENAI_RATE_LIMITS="gpt-4.1=500:30000,gpt-4o-mini=500:200000" で上書き）。
+上限が未登録のモデルは待たない（429 の再試行だけ行う）。環境変数 RATE_LIMIT=off で無効にできる。
+待っている間に問題セットが取り消されたら（cancellation.current_token）、待つのをやめて Cancelled を投げる。
+
+例:
+    python rate_limit.py            # バケットの残量・停止中のモデル
+    python rate_limit.py --reset    # バケットを満タンに戻す
+"""
+import argparse
+import asyncio
+import inspect
+import os
+import random
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from cancellation import current_token
+from quiz_pipeline import approx_tokens
+
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "rate_limit.db")
+
+# モデルごとの (RPM, TPM)
+MODEL_LIMITS = {
+    "gpt-4.1": (500, 30000),
+    "gpt-4o-mini": (500, 200000),
+    "text-embedding-3-small": (3000, 1000000),
+}
+
+# バケットの容量（何秒分までため込めるか）。1分ぶんを一度に使い切らないようにする
+BURST_SECONDS = 10
+# 応答の長さが指定されていない生成で見込む出力トークン数（問題1つの JSON がおよそこの程度）
+COMPLETION_TOKENS = 800
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# 待つときに一度に眠る上限（他のプロセスの返却・停止を見直す間隔）
+POLL_INTERVAL = 1.0
+
+
+def parse_limits(spec):
+    """"model=rpm:tpm,..." を {model: (rpm, tpm)} にする"""
+    limits = {}
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition(":")
+        limits[model.strip()] = (float(rpm), float(tpm) if tpm else None)
+    return limits
+
+
+def model_limits():
+    return {**MODEL_LIMITS, **parse_limits(os.getenv("OPENAI_RATE_LIMITS", ""))}
+
+
+def estimate_tokens(path, kwargs):
+    """リクエストが消費するトークン数の見積もり（入力＋出力の上限）"""
+    if path == "embeddings.create":
+        texts = kwargs.get("input") or []
+        if isinstance(texts, str) or (texts and isinstance(texts[0], int)):
+            texts = [texts]
+        # langchain の OpenAIEmbeddings はトークン ID の列で送ってくる
+        return sum(approx_tokens(t) if isinstance(t, str) else len(t) for t in texts)
+    prompt = 0
+    for message in kwargs.get("messages") or []:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        prompt += approx_tokens(content or "") + 4
+    completion = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or COMPLETION_TOKENS
+    return prompt + completion * (kwargs.get("n") or 1)
+
+
+# ===== 429 の判定と待ち時間 =====
+def is_rate_limited(error):
+    if getattr(error, "status_code", None) != 429 and type(error).__name__ != "RateLimitError":
+        return False
+    # 利用枠の使い切り（insufficient_quota）は待っても回復しない
+    return getattr(error, "code", None) != "insufficient_quota"
+
+
+def retry_after(error):
+    """retry-after-ms / retry-after ヘッダーの秒数（なければ None）"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _sleep(seconds):
+    """time.sleep と同じだが、問題セットが取り消されたらすぐに Cancelled を投げる"""
+    token = current_token()
+    if token is None:
+        time.sleep(seconds)
+    else:
+        token.wait(seconds)
+
+
+def backoff_delay(attempt, hint=None):
+    """ジッターつき指数バックオフ。retry-after があればそれより短くはしない"""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, hint) if hint is not None else delay
+
+
+class RateLimiter:
+    def __init__(self, path=RATE_LIMIT_DB, limits=None, enabled=None):
+        if enabled is None:
+            enabled = os.getenv("RATE_LIMIT") != "off"
+        self.path = path
+        self.limits = model_limits() if limits is None else limits
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "waits": 0, "wait_sec": 0.0, "retries": 0, "failures": 0}
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    model TEXT, kind TEXT, level REAL, updated REAL,
+                    PRIMARY KEY (model, kind)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blocked (
+                    model TEXT PRIMARY KEY, until REAL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _count(self, **deltas):
+        with self.lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+    # ===== バケット =====
+    def _buckets(self, model, tokens):
+        """[(種類, 容量, 毎秒の補充量, 今回の消費量)]"""
+        rpm, tpm = self.limits.get(model, (None, None))
+        buckets = []
+        for kind, limit, cost in (("rpm", rpm, 1), ("tpm", tpm, tokens)):
+            if limit:
+                capacity = max(limit * BURST_SECONDS / 60, 1)
+                # 容量より大きいリクエストは満タンになれば通す（永久に待たないように）
+                buckets.append((kind, capacity, limit / 60, min(cost, capacity)))
+        return buckets
+
+    def try_acquire(self, model, tokens):
+        """予算を差し引けたら 0、足りなければ待つべき秒数を返す"""
+        buckets = self._buckets(model, tokens)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT until FROM blocked WHERE model = ?", (model,)).fetchone()
+            if row is not None and row[0] > now:
+                conn.execute("ROLLBACK")
+                return row[0] - now
+            levels, wait = {}, 0.0
+            for kind, capacity, rate, cost in buckets:
+                row = conn.execute("SELECT level, updated FROM buckets WHERE model = ? AND kind = ?",
+                                   (model, kind)).fetchone()
+                level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                levels[kind] = level - cost
+                if level < cost:
+                    wait = max(wait, (cost - level) / rate)
+            if wait > 0:
+                conn.execute("ROLLBACK")
+                return wait
+            conn.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                             [(model, kind, level, now) for kind, level in levels.items()])
+            conn.execute("COMMIT")
+            return 0.0
+        finally:
+            conn.close()
+
+    def settle(self, model, estimated, actual):
+        """見積もりと実際のトークン数の差を TPM バケットに戻す（足りなければ追加で引く）"""
+        if not self.enabled or actual is None or "tpm" not in {k for k, *_ in self._buckets(model, 0)}:
+            return
+        with self._connect() as conn:
+            conn.execute("UPDATE buckets SET level = level + ? WHERE model = ? AND kind = 'tpm'",
+                         (estimated - actual, model))
+
+    def block(self, model, seconds):
+        """429 を受けたモデルへの送信を、すべてのプロセスで seconds 秒止める"""
+        until = time.time() + seconds
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO blocked VALUES (?, ?) "
+                "ON CONFLICT(model) DO UPDATE SET until = MAX(until, excluded.until)",
+                (model, until),
+            )
+
+    def acquire(self, model, tokens):
+        """予算が空くまで待って差し引く。待った秒数を返す"""
+        if not self.enabled:
+            return 0.0
+        waited = 0.0
+        while (wait := self.try_acquire(model, tokens)) > 0:
+            wait = min(wait, POLL_INTERVAL) * random.uniform(1.0, 1.2)
+            _sleep(wait)
+            waited += wait
+        self._record_wait(waited)
+        return waited
+
+    async def acquire_async(self, model, tokens):
+        if not self.enabled:
+            return 0.0
+        waited = 0.0
+        while (wait := await asyncio.to_thread(self.try_acquire, model, tokens)) > 0:
+            wait = min(wait, POLL_INTERVAL) * random.uniform(1.0, 1.2)
+            if (token := current_token()) is not None:
+                token.check()
+            await asyncio.sleep(wait)
+            waited += wait
+        self._record_wait(waited)
+        return waited
+
+    def _record_wait(self, waited):
+        self._count(requests=1, waits=int(waited > 0), wait_sec=waited)
+
+    # ===== API 呼び出しのラップ =====
+    def wrap_call(self, fn, path, telemetry=None):
+        """create 関数を「予算を待つ → 呼ぶ → 429 ならバックオフしてやり直す」にする"""
+        def before(kwargs):
+            model = kwargs.get("model")
+            return model, estimate_tokens(path, kwargs)
+
+        def on_error(error, model, attempt):
+            if not is_rate_limited(error) or attempt >= MAX_RETRIES:
+                self._count(failures=int(is_rate_limited(error)))
+                raise error
+            delay = backoff_delay(attempt, retry_after(error))
+            if self.enabled and model:
+                self.block(model, delay)
+            self._count(retries=1)
+            return delay
+
+        def after(response, model, tokens, waited, attempt):
+            usage = getattr(response, "usage", None)
+            self.settle(model, tokens, getattr(usage, "total_tokens", None))
+            if telemetry is not None and (waited > 0 or attempt > 0):
+                telemetry.record_event("rate_limit", model=model, call=path,
+                                       waited=round(waited, 4), retries=attempt)
+            return response
+
+        if inspect.iscoroutinefunction(fn):
+            async def async_wrapper(*args, **kwargs):
+                model, tokens = before(kwargs)
+                waited = 0.0
+                for attempt in range(MAX_RETRIES + 1):
+                    waited += await self.acquire_async(model, tokens)
+                    try:
+                        response = await fn(*args, **kwargs)
+                    except Exception as e:
+                        delay = on_error(e, model, attempt)
+                        await asyncio.sleep(delay)
+                        waited += delay
+                        continue
+                    return after(response, model, tokens, waited, attempt)
+
+            return async_wrapper
+
+        def wrapper(*args, **kwargs):
+            model, tokens = before(kwargs)
+            waited = 0.0
+            for attempt in range(MAX_RETRIES + 1):
+                waited += self.acquire(model, tokens)
+                try:
+                    response = fn(*args, **kwargs)
+                except Exception as e:
+                    delay = on_error(e, model, attempt)
+                    _sleep(delay)
+                    waited += delay
+                    continue
+                return after(response, model, tokens, waited, attempt)
+
+        return wrapper
+
+    def wrap(self, client, telemetry=None):
+        """chat.completions.create / embeddings.create をレート制限つきにしたクライアントを返す
+
+        OpenAI / AsyncOpenAI どちらでもよい。再試行はこちらで行うので、クライアント自身の再試行は切る。
+        """
+        if hasattr(client, "with_options"):
+            client = client.with_options(max_retries=0)
+        return _RateLimitedResource(client, self, telemetry)
+
+    # ===== 集計 =====
+    def report(self):
+        s = self.stats
+        return (f"レート制限: {s['requests']} 件中 {s['waits']} 件が待機（計 {s['wait_sec']:.1f} 秒）"
+                f"・429 再試行 {s['retries']} 回")
+
+    def stored_state(self):
+        """バケットの今の残量と停止中のモデル（全プロセス共通の状態）"""
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute("SELECT model, kind, level, updated FROM buckets ORDER BY model, kind").fetchall()
+            blocked = conn.execute("SELECT model, until FROM blocked WHERE until > ?", (now,)).fetchall()
+        buckets = []
+        for model, kind, level, updated in rows:
+            for k, capacity, rate, _ in self._buckets(model, 0):
+                if k == kind:
+                    buckets.append({"model": model, "kind": kind, "capacity": capacity,
+                                    "level": min(capacity, level + (now - updated) * rate)})
+        return {"buckets": buckets, "blocked": {m: until - now for m, until in blocked}}
+
+    def reset(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM buckets")
+            conn.execute("DELETE FROM blocked")
+
+
+_LIMITED_CALLS = ("chat.completions.create", "embeddings.create")
+
+
+class _RateLimitedResource:
+    """OpenAI / AsyncOpenAI クライアントの代理。create だけをレート制限つきにする"""
+
+    def __init__(self, target, limiter, telemetry=None, path=""):
+        self._target = target
+        self._limiter = limiter
+        self._telemetry = telemetry
+        self._path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = f"{self._path}.{name}" if self._path else name
+        if path in _LIMITED_CALLS:
+            return self._limiter.wrap_call(attr, path, self._telemetry)
+        if any(limited.startswith(path + ".") for limited in _LIMITED_CALLS):
+            return _RateLimitedResource(attr, self._limiter, self._telemetry, path)
+        return attr
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter(path=RATE_LIMIT_DB):
+    """プロセス内で共有するリミッター（Streamlit の再実行ごとに作り直さない）"""
+    return RateLimiter(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="レート制限の状態表示・リセット")
+    parser.add_argument("--db", default=RATE_LIMIT_DB)
+    parser.add_argument("--reset", action="store_true", help="バケットを満タンに戻し、停止を解除")
+    args = parser.parse_args(argv)
+
+    limiter = RateLimiter(args.db, enabled=True)
+    if args.reset:
+        limiter.reset()
+    state = limiter.stored_state()
+    for b in state["buckets"]:
+        print(f"{b['model']:<26}{b['kind']:<5}{b['level']:>12.1f} / {b['capacity']:.1f}")
+    for model, seconds in state["blocked"].items():
+        print(f"{model}: あと {seconds:.1f} 秒停止中")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""保存済みの生成結果に指標をまとめて計算し直す（生成 API は呼ばない）
+
+run_store.py が保存した run（1回の問題セット生成）を読み出し、登録済みの指標を run ごとに計算する。
+REPLAY_METRICS の指標は全 run ぶんをまとめて計算する（埋め込みは数リクエスト、BERTScore は1回の呼び出し）。
+RAGAS の指標（faithfulness・answer_relevancy）は頼まれたものを全部まとめて1回の evaluate で計算する。
+それ以外の metrics.py に登録された指標（lexical_diversity など）は run ごとに計算する。
+結果は generation_runs.db の run_metrics テーブルと CSV に保存する。
+
+例:
+    python replay.py --list
+    python replay.py --app cos0.6.py --metrics cosine bertscore
+    python replay.py --temperatures 0.0 0.6 --metrics cosine faithfulness --out replay.csv
+"""
+import argparse
+import csv
+import os
+from datetime import datetime
+
+import numpy as np
+from dotenv import load_dotenv
+
+import quiz_pipeline as qp
+from metrics import available_metrics, run_metrics, summarize
+from rate_limit import get_rate_limiter
+from run_store import RUN_STORE_DB, RunStore
+from telemetry import Telemetry
+
+# 埋め込み API の1リクエストあたりの入力数の上限
+EMBEDDING_BATCH = 2048
+
+
+def _answers(run):
+    return [qp.correct_answer(q) for q in run.questions]
+
+
+def _flatten(runs, per_run):
+    """run ごとのリストを1本にまとめ、後で run ごとに切り戻すための区切りも返す"""
+    items, bounds = [], []
+    for run in runs:
+        values = per_run(run)
+        bounds.append((len(items), len(items) + len(values)))
+        items += values
+    return items, bounds
+
+
+# ===== 指標（run のリスト → run ごとの値のリスト） =====
+def replay_cosine(client, runs, telemetry=None):
+    """正解選択肢どうしの平均コサイン類似度"""
+    answers, bounds = _flatten(runs, _answers)
+    embeddings = []
+    for i in range(0, len(answers), EMBEDDING_BATCH):
+        embeddings += qp.cached_embeddings(client, answers[i:i + EMBEDDING_BATCH])
+    return [qp.avg_pairwise_similarity(embeddings[a:b]) for a, b in bounds]
+
+
+def replay_bertscore(client, runs, telemetry=None):
+    """正解選択肢と本文の平均 BERTScore（F1）"""
+    answers, bounds = _flatten(runs, _answers)
+    contexts, _ = _flatten(runs, lambda run: [run.paragraph] * len(run.questions))
+    scores = qp.bert_scores(answers, contexts, telemetry)
+    return [float(np.mean(scores[a:b])) for a, b in bounds]
+
+
+def replay_ragas(client, runs, names, telemetry=None):
+    """RAGAS の指標（run 内の平均）。頼まれた指標を1回の evaluate でまとめて計算し {指標: 値のリスト} を返す"""
+    questions, bounds = _flatten(runs, lambda run: run.questions)
+    contexts, _ = _flatten(runs, lambda run: [run.paragraph] * len(run.questions))
+    rows = qp.score_table(questions, contexts, list(names), telemetry=telemetry)
+    return {name: [float(np.nanmean([r[name] for r in rows[a:b]])) for a, b in bounds] for name in names}
+
+
+REPLAY_METRICS = {
+    "cosine": replay_cosine,
+    "bertscore": replay_bertscore,
+}
+RAGAS_METRICS = ("faithfulness", "answer_relevancy")
+
+
+def replay(store, runs, metrics, client=None, telemetry=None):
+    """runs に metrics を計算し、run_metrics に保存して {run_id: {指標: 値}} を返す"""
+    results = {run.run_id: {} for run in runs}
+    ragas = [m for m in metrics if m in RAGAS_METRICS]
+    ragas_values = replay_ragas(client, runs, ragas, telemetry) if ragas else {}
+    for metric in metrics:
+        if metric in ragas_values:
+            values = ragas_values[metric]
+        elif metric in REPLAY_METRICS:
+            values = REPLAY_METRICS[metric](client, runs, telemetry)
+        else:
+            # 一括版のない登録済み指標（metrics.py）は run ごとに計算する
+            values = [
+                summarize(run_metrics([metric], run.questions, run.paragraph, client=client,
+                                      telemetry=telemetry))[metric]
+                for run in runs
+            ]
+        for run, value in zip(runs, values):
+            results[run.run_id][metric] = value
+    store.save_metrics(results)
+    return results
+
+
+# ===== 出力 =====
+def write_results(runs, results, metrics, out_path):
+    fields = ["run_id", "app", "created", "paragraph_index", "model", "temperature", "seed",
+              "num_variants", *metrics]
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for run in runs:
+            writer.writerow({
+                "run_id": run.run_id,
+                "app": run.app,
+                "created": datetime.fromtimestamp(run.created).isoformat(timespec="seconds"),
+                "paragraph_index": run.paragraph_index,
+                "model": run.model,
+                "temperature": run.temperature,
+                "seed": run.seed,
+                "num_variants": len(run.questions),
+                **results[run.run_id],
+            })
+
+
+def print_runs(runs):
+    print(f"{'run_id':<34}{'app':<22}{'created':<21}{'T':>5}{'para':>6}{'n':>4}")
+    for run in runs:
+        created = datetime.fromtimestamp(run.created).isoformat(sep=" ", timespec="seconds")
+        temperature = "-" if run.temperature is None else f"{run.temperature:.1f}"
+        print(f"{run.run_id:<34}{run.app:<22}{created:<21}{temperature:>5}"
+              f"{run.paragraph_index if run.paragraph_index is not None else '-':>6}{len(run.questions):>4}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="保存済みの生成結果に指標を計算し直す")
+    parser.add_argument("--db", default=RUN_STORE_DB)
+    parser.add_argument("--runs", nargs="+", help="対象の run_id（省略時は条件に合うすべて）")
+    parser.add_argument("--app", help="生成したアプリ（例: cos0.6.py, sweep）")
+    parser.add_argument("--temperatures", type=float, nargs="+")
+    parser.add_argument("--since", help="この日時（ISO 形式）以降の run だけ")
+    parser.add_argument("--metrics", nargs="+", default=["cosine"], choices=list(dict.fromkeys([*REPLAY_METRICS, *available_metrics()])))
+    parser.add_argument("--list", action="store_true", help="対象の run を一覧表示するだけ")
+    parser.add_argument("--out", default="replay_results.csv")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = RunStore(args.db, enabled=True)
+    since = datetime.fromisoformat(args.since).timestamp() if args.since else None
+    runs = store.list_runs(args.runs, args.app, args.temperatures, since)
+    if args.list or not runs:
+        print_runs(runs)
+        if not runs:
+            print("条件に合う run がありません")
+        return
+
+    load_dotenv()
+    from openai_client import connection_report, get_openai_client
+
+    telemetry = Telemetry(session_id=f"replay-{os.getpid()}")
+    telemetry.new_question()
+    client = get_rate_limiter().wrap(get_openai_client(), telemetry=telemetry)
+    client = telemetry.instrument(client)
+    results = replay(store, runs, args.metrics, client, telemetry)
+    write_results(runs, results, args.metrics, args.out)
+    print(f"{len(runs)} 件の run に {', '.join(args.metrics)} を計算し、{args.out} に保存しました")
+    print(connection_report())
+
+
+if __name__ == "__main__":
+    main()
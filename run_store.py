@@ -0,0 +1,181 @@
+"""生成した問題（バリアント）の永続保存
+
+アプリ・スイープで生成した問題を、生成に使ったリクエスト（プロンプト・モデル・温度・seed など）と
+一緒に SQLite（既定 generation_runs.db）に保存する。1回の問題セット生成が1つの run になる。
+
+保存した run は replay.py で読み出し、生成 API を呼ばずに好きな指標をまとめて計算できる
+（同じ温度でコサイン類似度と BERTScore を比べるときも、同じ問題に対して計算される）。
+
+環境変数 RUN_STORE=off で保存しない。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+RUN_STORE_DB = os.getenv("RUN_STORE_DB", "generation_runs.db")
+
+# 保存しないリクエストの引数（結果に関係しない・再現に不要なもの）
+_VOLATILE_KEYS = {"stream", "stream_options"}
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _request_record(kwargs):
+    return {k: v for k, v in kwargs.items() if k not in _VOLATILE_KEYS}
+
+
+@dataclass
+class StoredRun:
+    run_id: str
+    app: str
+    created: float
+    paragraph_index: int
+    paragraph: str
+    model: str
+    temperature: float
+    seed: int
+    params: dict
+    questions: list = field(default_factory=list)
+    requests: list = field(default_factory=list)
+
+
+class GenerationRun:
+    """1回の問題セット生成。add(question, request) で生成できた問題を1つずつ保存する"""
+
+    def __init__(self, store, run_id):
+        self.store = store
+        self.run_id = run_id
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, question, request):
+        with self.lock:
+            idx = self.count
+            self.count += 1
+        self.store.add_variant(self.run_id, idx, question, request)
+
+
+class RunStore:
+    def __init__(self, path=RUN_STORE_DB, enabled=None):
+        if enabled is None:
+            enabled = os.getenv("RUN_STORE") != "off"
+        self.path = path
+        self.enabled = enabled
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY, app TEXT, created REAL,
+                    paragraph_index INTEGER, paragraph TEXT,
+                    model TEXT, temperature REAL, seed INTEGER, params_json TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS prompts (
+                    prompt_hash TEXT PRIMARY KEY, request_json TEXT
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS variants (
+                    run_id TEXT, idx INTEGER, prompt_hash TEXT, question_json TEXT, created REAL,
+                    PRIMARY KEY (run_id, idx)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS run_metrics (
+                    run_id TEXT, metric TEXT, value REAL, created REAL,
+                    PRIMARY KEY (run_id, metric)
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    # ===== 保存 =====
+    def start_run(self, app, paragraph, paragraph_index=None, **params):
+        """新しい run を作る（RUN_STORE=off なら None を返し、何も保存しない）"""
+        if not self.enabled:
+            return None
+        run_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO runs (run_id, app, created, paragraph_index, paragraph, params_json) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, app, time.time(), paragraph_index, paragraph, _dumps(params)),
+            )
+        return GenerationRun(self, run_id)
+
+    def add_variant(self, run_id, idx, question, request):
+        request = _request_record(request)
+        request_json = _dumps(request)
+        prompt_hash = hashlib.sha256(request_json.encode("utf-8")).hexdigest()
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO prompts VALUES (?, ?)", (prompt_hash, request_json))
+            conn.execute(
+                "INSERT OR REPLACE INTO variants VALUES (?, ?, ?, ?, ?)",
+                (run_id, idx, prompt_hash, _dumps(question), time.time()),
+            )
+            # モデル・温度・seed は最初の問題のリクエストから埋める
+            conn.execute(
+                "UPDATE runs SET model = COALESCE(model, ?), temperature = COALESCE(temperature, ?), "
+                "seed = COALESCE(seed, ?) WHERE run_id = ?",
+                (request.get("model"), request.get("temperature"), request.get("seed"), run_id),
+            )
+
+    def save_metrics(self, results):
+        """replay.py で計算した {run_id: {指標: 値}} を保存"""
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO run_metrics VALUES (?, ?, ?, ?)",
+                [(run_id, metric, value, time.time())
+                 for run_id, values in results.items() for metric, value in values.items()],
+            )
+
+    # ===== 読み出し =====
+    def list_runs(self, run_ids=None, app=None, temperatures=None, since=None):
+        """条件に合う run を問題・リクエストつきで返す（作成順）"""
+        where, args = [], []
+        if run_ids:
+            where.append(f"run_id IN ({', '.join('?' * len(run_ids))})")
+            args += list(run_ids)
+        if app:
+            where.append("app = ?")
+            args.append(app)
+        if temperatures:
+            where.append(f"temperature IN ({', '.join('?' * len(temperatures))})")
+            args += [float(t) for t in temperatures]
+        if since is not None:
+            where.append("created >= ?")
+            args.append(since)
+        sql = ("SELECT run_id, app, created, paragraph_index, paragraph, model, temperature, seed, "
+               "params_json FROM runs")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._connect() as conn:
+            runs = [StoredRun(*row[:-1], params=json.loads(row[-1] or "{}"))
+                    for row in conn.execute(sql + " ORDER BY created", args)]
+            for run in runs:
+                for question_json, request_json in conn.execute(
+                    "SELECT v.question_json, p.request_json FROM variants v "
+                    "JOIN prompts p ON p.prompt_hash = v.prompt_hash "
+                    "WHERE v.run_id = ? ORDER BY v.idx",
+                    (run.run_id,),
+                ):
+                    run.questions.append(json.loads(question_json))
+                    run.requests.append(json.loads(request_json))
+        return [run for run in runs if run.questions]
+
+
+@lru_cache(maxsize=None)
+def get_run_store(path=RUN_STORE_DB):
+    """プロセス内で共有する保存先（Streamlit の再実行ごとに作り直さない）"""
+    return RunStore(path)
@@ -0,0 +1,467 @@
+"""OpenAI 互換のローカルスタブサーバー（録画・再生つき）
+
+ネットワークなしでパイプラインの速度測定や回帰テストをするためのもの。
+chat.completions（json_schema / n / stream）と embeddings に応答する。
+
+例:
+    python stub_server.py --port 8787 --latency lognormal:-1.2,0.4 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 OPENAI_API_KEY=stub python sweep.py ...
+
+    # 本物の応答を一度だけ録画し、以後は決定的に再生
+    python stub_server.py --mode record --cassette cassettes/sweep.json
+    python stub_server.py --mode replay --cassette cassettes/sweep.json
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+UPSTREAM_URL = "https://api.openai.com"
+
+
+# ===== 遅延分布 =====
+class LatencyModel:
+    """"fixed:0.2" / "uniform:0.1,0.5" / "normal:0.3,0.1" / "lognormal:mu,sigma" 形式で指定
+
+    "spike:0.3,4,0.05" は 5% の確率で 4 秒かかり、それ以外は 0.3 秒（まれに遅い呼び出しのテール）
+    """
+
+    def __init__(self, spec="fixed:0", seed=None):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p]
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        if kind not in ("fixed", "uniform", "normal", "lognormal", "spike"):
+            raise ValueError(f"未知の遅延分布です: {spec}")
+
+    def sample(self):
+        with self.lock:
+            if self.kind == "fixed":
+                value = self.params[0] if self.params else 0.0
+            elif self.kind == "uniform":
+                value = self.rng.uniform(*self.params)
+            elif self.kind == "normal":
+                value = self.rng.gauss(*self.params)
+            elif self.kind == "spike":
+                base, slow, probability = self.params
+                value = slow if self.rng.random() < probability else base
+            else:
+                value = self.rng.lognormvariate(*self.params)
+        return max(0.0, value)
+
+
+# ===== ダミー応答の生成 =====
+def _request_key(path, body):
+    canonical = json.dumps({"path": path, "body": body}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _approx_tokens(text):
+    return max(1, math.ceil(len(text) / 2))
+
+
+def _fake_value(schema, rng, words):
+    """JSON Schema に合う値を乱数で作る"""
+    kind = schema.get("type")
+    if kind == "object":
+        return {
+            name: _fake_value(prop, rng, words)
+            for name, prop in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        low = schema.get("minItems", 1)
+        high = schema.get("maxItems", max(low, 3))
+        return [_fake_value(schema.get("items", {}), rng, words) for _ in range(rng.randint(low, high))]
+    if kind in ("number", "integer"):
+        return rng.randint(1, 4)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    return "".join(rng.choice(words) for _ in range(rng.randint(2, 5)))
+
+
+def _words(messages):
+    text = "".join(m.get("content") or "" for m in messages if m.get("role") == "user")
+    words = [w for w in text.replace("。", "、").split("、") if w.strip()]
+    return [w.strip()[:12] for w in words] or ["兵庫", "神戸", "播磨", "丹波", "但馬", "淡路"]
+
+
+def fake_chat_completion(body, seed):
+    rng = random.Random(seed)
+    words = _words(body.get("messages", []))
+    schema = ((body.get("response_format") or {}).get("json_schema") or {}).get("schema")
+    prompt_text = "".join(m.get("content") or "" for m in body.get("messages", []))
+
+    choices = []
+    completion_tokens = 0
+    for i in range(body.get("n") or 1):
+        if schema is not None:
+            content = json.dumps(_fake_value(schema, rng, words), ensure_ascii=False)
+        else:
+            content = "".join(rng.choice(words) for _ in range(rng.randint(3, 8)))
+        completion_tokens += _approx_tokens(content)
+        choices.append({
+            "index": i,
+            "message": {"role": "assistant", "content": content, "refusal": None},
+            "finish_reason": "stop",
+            "logprobs": None,
+        })
+    prompt_tokens = _approx_tokens(prompt_text)
+    return {
+        "id": f"chatcmpl-stub{seed:016x}"[:40],
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def fake_embedding(text, dim):
+    """同じテキストには同じ単位ベクトルを返す"""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def fake_embeddings(body, dim):
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    data = []
+    for i, text in enumerate(inputs):
+        vector = fake_embedding(str(text), body.get("dimensions") or dim)
+        if body.get("encoding_format") == "base64":
+            vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+        data.append({"object": "embedding", "index": i, "embedding": vector})
+    tokens = sum(_approx_tokens(str(t)) for t in inputs)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "stub"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+def stream_chunks(completion, chunk_chars=8, include_usage=False):
+    """完成済みの chat.completion を SSE 用のチャンク列に分解"""
+    base = {
+        "id": completion["id"],
+        "object": "chat.completion.chunk",
+        "created": completion["created"],
+        "model": completion["model"],
+    }
+    for choice in completion["choices"]:
+        index = choice["index"]
+        yield {**base, "choices": [{"index": index, "delta": {"role": "assistant", "content": ""},
+                                    "finish_reason": None}]}
+        content = choice["message"]["content"] or ""
+        for start in range(0, len(content), chunk_chars):
+            yield {**base, "choices": [{"index": index,
+                                        "delta": {"content": content[start:start + chunk_chars]},
+                                        "finish_reason": None}]}
+        yield {**base, "choices": [{"index": index, "delta": {},
+                                    "finish_reason": choice["finish_reason"]}]}
+    if include_usage:
+        yield {**base, "choices": [], "usage": completion.get("usage")}
+
+
+# ===== バックエンド =====
+class StubBackend:
+    """HTTP とは独立した応答ロジック（LocalBatchClient からも使える）"""
+
+    def __init__(self, latency="fixed:0", error_rate=0.0, retry_after=1.0, mode="stub",
+                 cassette=None, upstream=UPSTREAM_URL, api_key=None, embedding_dim=1536,
+                 seed=0, rpm=None, capacity=None):
+        self.latency = latency if isinstance(latency, LatencyModel) else LatencyModel(latency, seed)
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        # 1分あたりのリクエスト数の上限（本物の API のクォータの再現）。超えた分は 429 を返す
+        self.rpm = rpm
+        self.accepted = deque()
+        # 同時に処理できる数。超えた分は空くまで待たせる（混むほどレイテンシが伸びる）が、
+        # 待ちも capacity 件を超えたら 429 を返す（過負荷の再現）
+        self.capacity = capacity
+        self.slots = threading.BoundedSemaphore(capacity) if capacity else None
+        self.in_flight = 0
+        self.mode = mode
+        self.cassette = cassette
+        self.upstream = upstream.rstrip("/")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.embedding_dim = embedding_dim
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.occurrences = {}
+        self.entries = {}
+        self.stats = {"requests": 0, "rate_limited": 0, "replayed": 0, "recorded": 0, "missed": 0}
+        if cassette and mode == "replay":
+            with open(cassette, encoding="utf-8") as f:
+                self.entries = json.load(f)["entries"]
+        elif cassette and mode == "record" and os.path.exists(cassette):
+            with open(cassette, encoding="utf-8") as f:
+                self.entries = json.load(f)["entries"]
+
+    def _next_occurrence(self, key):
+        with self.lock:
+            count = self.occurrences.get(key, 0)
+            self.occurrences[key] = count + 1
+        return count
+
+    def _inject_429(self):
+        with self.lock:
+            self.stats["requests"] += 1
+            hit = self.error_rate > 0 and self.rng.random() < self.error_rate
+            if hit:
+                self.stats["rate_limited"] += 1
+        return hit
+
+    def _over_quota(self):
+        """直近60秒の受付数が rpm に達していれば、枠が空くまでの秒数を返す"""
+        if not self.rpm:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            while self.accepted and now - self.accepted[0] >= 60:
+                self.accepted.popleft()
+            if len(self.accepted) >= self.rpm:
+                self.stats["requests"] += 1
+                self.stats["rate_limited"] += 1
+                return 60 - (now - self.accepted[0])
+            self.accepted.append(now)
+        return None
+
+    def _process(self):
+        """遅延を入れて処理する。capacity の2倍を超えて受けていれば処理せず False を返す"""
+        if self.slots is None:
+            time.sleep(self.latency.sample())
+            return True
+        with self.lock:
+            if self.in_flight >= 2 * self.capacity:
+                self.stats["requests"] += 1
+                self.stats["rate_limited"] += 1
+                return False
+            self.in_flight += 1
+        try:
+            with self.slots:
+                time.sleep(self.latency.sample())
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        return True
+
+    def _save_cassette(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cassette)), exist_ok=True)
+        tmp_path = self.cassette + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cassette)
+
+    def _forward(self, path, body):
+        request = urllib.request.Request(
+            self.upstream + path,
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read() or b"{}")
+
+    def respond(self, path, body):
+        """(status, headers, body) を返す。stream 指定は呼び出し側で処理する"""
+        body = {k: v for k, v in body.items() if k not in ("stream", "stream_options")}
+        wait = self._over_quota()
+        if wait is not None:
+            return 429, {"retry-after-ms": str(int(wait * 1000))}, {
+                "error": {"message": "Rate limit reached for requests (stub quota)", "type": "requests",
+                          "code": "rate_limit_exceeded"}}
+        if not self._process():
+            return 429, {"retry-after": str(self.retry_after)}, {
+                "error": {"message": "Server overloaded (stub capacity)", "type": "requests",
+                          "code": "rate_limit_exceeded"}}
+        if self._inject_429():
+            return 429, {"retry-after": str(self.retry_after)}, {
+                "error": {"message": "Rate limit reached (stub)", "type": "requests",
+                          "code": "rate_limit_exceeded"}}
+
+        key = _request_key(path, body)
+        occurrence = self._next_occurrence(key)
+
+        if self.mode == "replay":
+            recorded = self.entries.get(key, [])
+            if not recorded:
+                with self.lock:
+                    self.stats["missed"] += 1
+                return 404, {}, {"error": {"message": "cassette にない要求です", "code": "cassette_miss"}}
+            with self.lock:
+                self.stats["replayed"] += 1
+            # 録画より多く呼ばれた場合は循環して再生する
+            return 200, {}, recorded[occurrence % len(recorded)]
+
+        if self.mode == "record":
+            with self.lock:
+                recorded = self.entries.get(key, [])
+                if occurrence < len(recorded):
+                    return 200, {}, recorded[occurrence]
+            status, payload = self._forward(path, body)
+            if status == 200:
+                with self.lock:
+                    self.entries.setdefault(key, []).append(payload)
+                    self.stats["recorded"] += 1
+                    self._save_cassette()
+            return status, {}, payload
+
+        seed = int(key[:12], 16) + occurrence
+        if path.endswith("/chat/completions"):
+            return 200, {}, fake_chat_completion(body, seed)
+        if path.endswith("/embeddings"):
+            return 200, {}, fake_embeddings(body, self.embedding_dim)
+        return 404, {}, {"error": {"message": f"未対応のエンドポイントです: {path}"}}
+
+    def batch_handler(self, url, body):
+        """batch_sweep.LocalBatchClient 用の handler"""
+        status, _, payload = self.respond(url, body)
+        if status != 200:
+            raise RuntimeError(payload.get("error"))
+        return payload
+
+
+# ===== HTTP サーバー =====
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, headers, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("x-request-id", uuid.uuid4().hex)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, completion, include_usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in stream_chunks(completion, include_usage=include_usage):
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if self.server.chunk_delay:
+                time.sleep(self.server.chunk_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {}, {"object": "list", "data": [
+                {"id": m, "object": "model", "owned_by": "stub"}
+                for m in ("gpt-4.1", "gpt-4.1-mini", "text-embedding-3-small")
+            ]})
+        elif self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, {}, self.server.backend.stats)
+        else:
+            self._send_json(404, {}, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?")[0]
+        if path.startswith("/v1/"):
+            path = path[len("/v1"):]
+        status, headers, payload = self.server.backend.respond("/v1" + path, body)
+        if status == 200 and body.get("stream") and path.endswith("/chat/completions"):
+            include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+            self._send_stream(payload, include_usage)
+        else:
+            self._send_json(status, headers, payload)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, backend, chunk_delay=0.0, verbose=False):
+        super().__init__(address, StubRequestHandler)
+        self.backend = backend
+        self.chunk_delay = chunk_delay
+        self.verbose = verbose
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def serve_in_thread(backend=None, host="127.0.0.1", port=0, chunk_delay=0.0):
+    """ベンチマーク用：別スレッドで起動して StubServer を返す（終了は server.shutdown()）"""
+    server = StubServer((host, port), backend or StubBackend(), chunk_delay=chunk_delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI 互換のローカルスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", default="fixed:0",
+                        help='遅延分布（秒）。例: "fixed:0.2", "uniform:0.1,0.5", "lognormal:-1.2,0.4"')
+    parser.add_argument("--chunk-delay", type=float, default=0.0,
+                        help="stream 時のチャンク間の遅延（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429 を返す確率")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--rpm", type=int, help="1分あたりのリクエスト数の上限（超えると 429）")
+    parser.add_argument("--capacity", type=int, help="同時に処理できる数（超えた分は待たせ、その2倍を超えると 429）")
+    parser.add_argument("--mode", choices=["stub", "record", "replay"], default="stub")
+    parser.add_argument("--cassette", help="record / replay で使う JSON ファイル")
+    parser.add_argument("--upstream", default=UPSTREAM_URL)
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.mode != "stub" and not args.cassette:
+        raise SystemExit("--mode record / replay には --cassette が必要です")
+    backend = StubBackend(
+        latency=args.latency, error_rate=args.error_rate, retry_after=args.retry_after,
+        mode=args.mode, cassette=args.cassette, upstream=args.upstream,
+        embedding_dim=args.embedding_dim, seed=args.seed, rpm=args.rpm, capacity=args.capacity,
+    )
+    server = StubServer((args.host, args.port), backend, args.chunk_delay, args.verbose)
+    print(f"stub server: {server.base_url}（mode={args.mode}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
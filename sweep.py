@@ -0,0 +1,301 @@
+"""温度 × 段落 × 生成数 のグリッドで問題生成と指標計算を一括実行する CLI
+
+例:
+    python sweep.py --csv Book1.csv --temperatures 0.0 0.4 0.8 --num-paragraphs 5 --variants 15
+    python sweep.py --csv Book1.csv --jobs   # アプリと共有するジョブキュー（jobs.py）のワーカーで実行
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+import quiz_pipeline as qp
+from cancellation import Cancelled
+from concurrency import AdaptiveConcurrency
+from gen_cache import GenerationCache
+from grid import METRIC_COLUMNS, add_grid_arguments, build_grid, load_grid_explanations, write_results
+from hedge import HedgedCalls
+from jobs import get_job_queue
+from metric_cache import get_metric_cache
+from metrics import METRICS, compute_metrics, get_process_pool, summarize
+from openai_client import STATS, get_async_openai_client, share_with_ragas
+from pipeline import pipelined_variants
+from rate_limit import get_rate_limiter
+from run_store import get_run_store
+from telemetry import Telemetry
+
+# ===== 1セル分の実行 =====
+def _controlled_evaluate(telemetry, control):
+    """ragas.evaluate の同時実行数を control で調整する（評価結果キャッシュのヒットは枠を使わない）"""
+    from ragas import evaluate
+
+    evaluate = telemetry.instrument_evaluate(share_with_ragas(evaluate))
+    return get_metric_cache().wrap_evaluate(control.wrap_function(evaluate))
+
+
+class _ProgressRun:
+    """生成できた問題を run に保存しながら、progress(段階, 件数, 全体) で知らせる（jobs.py の進み具合）"""
+
+    def __init__(self, run, progress, total):
+        self.run = run
+        self.run_id = run.run_id if run is not None else None
+        self.progress = progress
+        self.total = total
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, question, request):
+        if self.run is not None:
+            self.run.add(question, request)
+        with self.lock:
+            self.count += 1
+            count = self.count
+        self.progress("generation", count, self.total)
+
+
+async def _run_cell_async(cell, progress=None, cancel=None):
+    if cancel is not None:
+        # 取り消されたらセルの処理（このタスク）ごと止める
+        cancel.activate()
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        cancel.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel))
+    telemetry = Telemetry(session_id=f"sweep-{os.getpid()}")
+    telemetry.new_question()
+    # 接続プールはワーカープロセス（のイベントループ）で共有し、再利用率はこのセルの増分を記録する
+    aclient = get_async_openai_client()
+    connections = STATS.snapshot()
+    concurrency = cell["concurrency"]
+    generation_control = evaluate_fn = None
+    if cell.get("adaptive_concurrency"):
+        # 生成・埋め込み・評価の同時実行数を、レイテンシと 429 から自動で調整する（--concurrency は初期値）
+        generation_control = AdaptiveConcurrency("generation", initial=concurrency, telemetry=telemetry)
+        aclient = generation_control.wrap(aclient, "chat.completions.create")
+        aclient = AdaptiveConcurrency("embedding", initial=concurrency, telemetry=telemetry).wrap(
+            aclient, "embeddings.create")
+        if any(m in ("faithfulness", "answer_relevancy") for m in cell["metrics"]):
+            evaluate_fn = _controlled_evaluate(
+                telemetry, AdaptiveConcurrency("evaluation", initial=2, telemetry=telemetry))
+        concurrency = generation_control.max_limit
+    # レート制限はワーカープロセス間で共有（rate_limit.db）
+    aclient = get_rate_limiter().wrap(aclient, telemetry=telemetry)
+    hedger = None
+    if cell.get("hedge_percentile") is not None:
+        # 遅い生成呼び出しを複製する（複製もレート制限を通る）
+        hedger = HedgedCalls(cell["hedge_percentile"], cell["hedge_budget"], telemetry=telemetry)
+        aclient = hedger.wrap(aclient)
+    aclient = telemetry.instrument(aclient)
+    cache = None
+    if cell["cache"] != "off":
+        cache = GenerationCache(all_temperatures=cell["cache"] == "all")
+        aclient = cache.wrap(aclient, is_async=True)
+    # 評価結果キャッシュはプロセス内で共有（ヒット数はこのセルの増分を記録する）
+    metric_cache = get_metric_cache()
+    metric_cache.enabled = cell.get("metric_cache", "on") != "off"
+    metric_cache_hits = metric_cache.total_hits()
+    paragraph = cell["paragraph"]
+    row = {
+        "temperature": cell["temperature"],
+        "paragraph_index": cell["paragraph_index"],
+        "num_variants": cell["num_variants"],
+    }
+
+    # 生成した問題は保存しておき、replay.py で別の指標を計算し直せるようにする
+    run = get_run_store().start_run(cell.get("app", "sweep"), paragraph, cell["paragraph_index"],
+                                    num_variants=cell["num_variants"], per_call=cell["per_call"],
+                                    adaptive=bool(cell.get("adaptive")))
+    row["run_id"] = run.run_id if run is not None else None
+    if progress is not None:
+        run = _ProgressRun(run, progress, cell["num_variants"])
+
+    controller = None
+    precomputed = {}
+    if cell.get("adaptive"):
+        # num_variants を上限として、平均類似度の信頼区間が十分狭くなったら打ち切る
+        questions, controller = await qp.generate_variants_adaptive(
+            aclient, paragraph, cell["temperature"], model=cell["model"],
+            max_variants=cell["num_variants"], batch_size=cell["batch_size"],
+            min_variants=cell["min_variants"], ci_width=cell["ci_width"],
+            concurrency=concurrency, seed=cell["generation_seed"],
+            per_call=cell["per_call"], telemetry=telemetry, run=run,
+        )
+        row["calls_saved"] = controller.calls_saved()
+        precomputed["embeddings"] = controller.embeddings
+    elif cell.get("pipeline") and cell["dedupe_threshold"] is None:
+        # 生成できた問題から順に埋め込み・問題ごとの指標へ流す（全問そろうのを待たない）
+        result = await pipelined_variants(
+            aclient, paragraph, cell["num_variants"], cell["temperature"],
+            model=cell["model"], concurrency=concurrency, seed=cell["generation_seed"],
+            per_call=cell["per_call"], telemetry=telemetry, run=run,
+            metrics=[m for m in cell["metrics"] if METRICS[m].per_question], evaluate_fn=evaluate_fn,
+            embed="cosine" in cell["metrics"], executor=get_process_pool(1),
+        )
+        questions = result.questions
+        precomputed.update(result.scores)
+        if result.embeddings:
+            precomputed["embeddings"] = result.embeddings
+    else:
+        questions = await qp.generate_variants(
+            aclient, paragraph, cell["num_variants"], cell["temperature"],
+            model=cell["model"], concurrency=concurrency, seed=cell["generation_seed"],
+            per_call=cell["per_call"], telemetry=telemetry, run=run,
+        )
+    row["num_generated"] = len(questions)
+    if progress is not None:
+        progress("metrics", len(questions), len(questions))
+    answers = [qp.correct_answer(q) for q in questions]
+
+    # ほぼ同じ問題をまとめる場合は、先に埋め込みを取って代表だけを評価する
+    clusters = None
+    if cell["dedupe_threshold"] is not None:
+        if "embeddings" not in precomputed:
+            precomputed["embeddings"] = await qp.embed_texts(aclient, answers)
+        clusters = qp.near_duplicate_clusters(precomputed["embeddings"], cell["dedupe_threshold"])
+        row["num_evaluated"] = len(qp.cluster_representatives(clusters))
+
+    # 残りの指標はまとめて同時に計算する（CPU 指標はプロセスプール、API 待ちの指標はイベントループ上）
+    results = await compute_metrics(
+        cell["metrics"], questions, paragraph, client=aclient, telemetry=telemetry, evaluate_fn=evaluate_fn,
+        precomputed=precomputed, clusters=clusters, executor=get_process_pool(1),
+    )
+    for metric, value in summarize(results).items():
+        row[METRIC_COLUMNS.get(metric, f"avg_{metric}")] = value
+
+    totals = telemetry.totals()
+    row["prompt_tokens"] = totals["prompt_tokens"]
+    row["completion_tokens"] = totals["completion_tokens"]
+    row["cost_usd"] = round(totals["cost_usd"], 6)
+    row["cache_hits"] = cache.hits if cache is not None else 0
+    row["metric_cache_hits"] = metric_cache.total_hits() - metric_cache_hits
+    if generation_control is not None:
+        row["final_concurrency"] = generation_control.current
+    if hedger is not None:
+        row["hedges"] = hedger.stats["hedges"]
+    reuse = STATS.reuse_rate(connections)
+    row["connection_reuse"] = round(reuse, 3) if reuse is not None else None
+    if cell.get("return_questions"):
+        row["questions"] = questions
+    return row
+
+
+def run_cell(cell, progress=None, cancel=None):
+    """プロセスプール上で1セルを実行（例外は行の error 列に記録）
+
+    jobs.py のワーカーから呼ぶときは progress で進み具合を知らせ、cancel が取り消されたら Cancelled を投げる。
+    """
+    load_dotenv()
+    start = time.perf_counter()
+    try:
+        row = asyncio.run(_run_cell_async(cell, progress, cancel))
+    except asyncio.CancelledError:
+        raise Cancelled(cancel.reason if cancel is not None else "cancelled")
+    except Exception as e:
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled(cancel.reason)
+        row = {
+            "temperature": cell["temperature"],
+            "paragraph_index": cell["paragraph_index"],
+            "num_variants": cell["num_variants"],
+            "error": repr(e),
+        }
+    row["elapsed_sec"] = round(time.perf_counter() - start, 3)
+    return row
+
+
+def _run_local(cells, workers):
+    """このプロセスのプロセスプールでセルを実行し、終わった順に行を返す"""
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_cell, cell) for cell in cells]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _run_as_jobs(cells, workers):
+    """セルを jobs.py のキューに積み、アプリと共有するワーカープールで実行して終わった順に行を返す"""
+    queue = get_job_queue()
+    jobs = {}
+    for cell in cells:
+        label = f"sweep T={cell['temperature']} p={cell['paragraph_index']} n={cell['num_variants']}"
+        jobs[queue.submit("question_set", dict(cell, label=label))] = cell
+    queue.ensure_workers(workers)
+    try:
+        for job in queue.wait(jobs):
+            if job.result:
+                yield job.result
+                continue
+            cell = jobs[job.job_id]
+            yield {
+                "temperature": cell["temperature"],
+                "paragraph_index": cell["paragraph_index"],
+                "num_variants": cell["num_variants"],
+                "error": job.error or job.status,
+            }
+    except KeyboardInterrupt:
+        # 中断したスイープのセルはワーカーに残さない
+        for job_id in jobs:
+            queue.cancel(job_id)
+        raise
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="温度スイープを非対話で実行")
+    add_grid_arguments(parser)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="グリッドセルを並列実行するプロセス数")
+    parser.add_argument("--out", default="sweep_results.csv")
+    parser.add_argument("--jobs", action="store_true",
+                        help="セルを jobs.py のジョブキューに積み、アプリと共有するワーカープールで実行する"
+                             "（動いているワーカーが --workers 未満なら足りない分を起動）")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="--variants を上限に、平均類似度の信頼区間が --ci-width より狭くなったら生成を打ち切る")
+    parser.add_argument("--batch-size", type=int, default=3, help="適応モードで1回に追加生成する問題数")
+    parser.add_argument("--min-variants", type=int, default=5, help="適応モードで最低限生成する問題数")
+    parser.add_argument("--ci-width", type=float, default=0.1,
+                        help="平均コサイン類似度の 95%% 信頼区間の幅の目標")
+    parser.add_argument("--dedupe-threshold", type=float, nargs="?", const=qp.DUPLICATE_THRESHOLD,
+                        help="正解の埋め込みの類似度がこれ以上の問題をまとめ、代表だけを評価する"
+                             f"（値を省略すると {qp.DUPLICATE_THRESHOLD}）")
+    parser.add_argument("--no-pipeline", action="store_true",
+                        help="全問そろってから埋め込み・評価する（パイプラインを使わない）")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                        help="同時実行数をレイテンシと 429 から自動調整する（--concurrency は初期値）")
+    parser.add_argument("--hedge", type=float, nargs="?", const=95, metavar="PERCENTILE",
+                        help="生成が直近のレイテンシのこのパーセンタイルを超えたら複製を送る（省略時 95）")
+    parser.add_argument("--hedge-budget", type=float, default=0.1,
+                        help="複製の数の上限（元の呼び出しに対する割合）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    explanations = load_grid_explanations(args)
+    cells = build_grid(explanations, args)
+    if args.jobs:
+        print(f"{len(cells)} セルをジョブキュー（{get_job_queue().path}）に積みます")
+        results = _run_as_jobs(cells, args.workers)
+    else:
+        print(f"{len(cells)} セルを {args.workers} プロセスで実行します")
+        results = _run_local(cells, args.workers)
+
+    rows = []
+    for row in results:
+        rows.append(row)
+        status = row.get("error") or "ok"
+        print(f"[{len(rows)}/{len(cells)}] T={row['temperature']} "
+              f"p={row['paragraph_index']} n={row['num_variants']} {status}")
+
+    write_results(rows, args.out)
+    print(f"結果を {args.out} に保存しました")
+    metric_hits = sum(row.get("metric_cache_hits") or 0 for row in rows)
+    print(f"評価キャッシュ: {metric_hits} 件のスコアを再利用しました")
+    if args.adaptive:
+        saved = sum(row.get("calls_saved") or 0 for row in rows)
+        print(f"適応モード: 固定{qp.BASELINE_VARIANTS}問と比べて生成呼び出しを {saved} 回節約しました")
+
+
+if __name__ == "__main__":
+    main()
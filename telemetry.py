@@ -0,0 +1,483 @@
+"""生成・補正・埋め込み・評価の呼び出しごとの処理時間・トークン数・コスト計測
+
+アプリ側では次のように使う:
+
+    telemetry = get_session_telemetry(st.session_state)
+    telemetry.attach_sidebar()
+    client = telemetry.instrument(client)
+    evaluate = telemetry.instrument_evaluate(evaluate)
+
+記録は telemetry.jsonl（環境変数 TELEMETRY_LOG で変更可）に1行1件で追記される。
+"""
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+TELEMETRY_LOG = os.getenv("TELEMETRY_LOG", "telemetry.jsonl")
+
+# RAGAS が内部で使う既定の評価モデル
+JUDGE_MODEL = "gpt-4o-mini"
+
+# 料金表（USD / 100万トークン：入力, 出力）
+PRICES = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+# 計測対象の API 呼び出しと既定の段階名
+_TRACKED_CALLS = {
+    "chat.completions.create": "generation",
+    "embeddings.create": "embedding",
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """料金表から概算コスト（USD）を計算。日付つきのモデル名は最長一致で引く"""
+    if not model:
+        return 0.0
+    matches = [name for name in PRICES if model.startswith(name)]
+    if not matches:
+        return 0.0
+    input_price, output_price = PRICES[max(matches, key=len)]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def _usage_tokens(usage):
+    """OpenAI の usage / RAGAS の TokenUsage / dict から (入力, 出力) トークン数を取り出す"""
+    if usage is None:
+        return 0, 0
+    if isinstance(usage, dict):
+        get = usage.get
+    else:
+        def get(name):
+            return getattr(usage, name, None)
+    prompt = get("prompt_tokens") or get("input_tokens") or 0
+    completion = get("completion_tokens") or get("output_tokens") or 0
+    return int(prompt), int(completion)
+
+
+class _InstrumentedResource:
+    """OpenAI / AsyncOpenAI クライアントの代理。計測対象の create だけを差し替える"""
+
+    def __init__(self, target, telemetry, path=""):
+        self._target = target
+        self._telemetry = telemetry
+        self._path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = f"{self._path}.{name}" if self._path else name
+        if path in _TRACKED_CALLS:
+            return self._telemetry.wrap_call(attr, _TRACKED_CALLS[path])
+        if any(tracked.startswith(path + ".") for tracked in _TRACKED_CALLS):
+            return _InstrumentedResource(attr, self._telemetry, path)
+        return attr
+
+
+def _chunk_usage(chunk, usage, content_chunks):
+    """ストリームの断片1つを読んだあとの (usage, 本文を含む断片の数)"""
+    if getattr(chunk, "usage", None) is not None:
+        usage = chunk.usage
+    choices = getattr(chunk, "choices", None)
+    if choices and getattr(choices[0].delta, "content", None):
+        content_chunks += 1
+    return usage, content_chunks
+
+
+class _InstrumentedStream:
+    """stream=True の戻り値（Stream）の代理
+
+    最後の断片（stream_options の include_usage でつく usage）まで読んだとき、
+    または途中で閉じられた・読み込みに失敗したときに1件記録する。途中で終わったときは
+    usage が届かないので、本文を含む断片の数を出力トークン数の目安として記録する。
+    """
+
+    def __init__(self, stream, finish):
+        self._stream = stream
+        self._finish = finish
+        self._iterator = None
+        self._usage = None
+        self._content_chunks = 0
+        self._done = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def _end(self, error=None):
+        # 取り消し（別スレッドからの close）と読み終わりが重なっても1件だけ記録する
+        with self._lock:
+            if self._done:
+                return
+            self._done = True
+        usage = self._usage
+        if usage is None and self._content_chunks:
+            usage = {"completion_tokens": self._content_chunks}
+        self._finish(usage, error)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = iter(self._stream)
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._end()
+            raise
+        except Exception as e:
+            self._end(e)
+            raise
+        self._usage, self._content_chunks = _chunk_usage(chunk, self._usage, self._content_chunks)
+        return chunk
+
+    def close(self):
+        try:
+            if hasattr(self._stream, "close"):
+                self._stream.close()
+        finally:
+            self._end()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _InstrumentedAsyncStream(_InstrumentedStream):
+    """AsyncStream 用の _InstrumentedStream"""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = self._stream.__aiter__()
+        try:
+            chunk = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._end()
+            raise
+        except Exception as e:
+            self._end(e)
+            raise
+        self._usage, self._content_chunks = _chunk_usage(chunk, self._usage, self._content_chunks)
+        return chunk
+
+    async def close(self):
+        try:
+            if hasattr(self._stream, "close"):
+                await self._stream.close()
+        finally:
+            self._end()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class Telemetry:
+    def __init__(self, log_path=TELEMETRY_LOG, session_id=None):
+        self.log_path = log_path
+        self.session_id = session_id or uuid.uuid4().hex[:8]
+        self.question = 0
+        self._question_start = None
+        self._first_result_recorded = False
+        self.records = []
+        self.events = []
+        self.lock = threading.Lock()
+        self._stage = contextvars.ContextVar("telemetry_stage", default=None)
+        self._sidebar = None
+        self._sidebar_thread = None
+
+    # ===== 記録 =====
+    def new_question(self):
+        """新しい問題セットの生成開始（以後の記録はこの問題番号に集計）"""
+        with self.lock:
+            self.question += 1
+            self._question_start = time.perf_counter()
+            self._first_result_recorded = False
+        self._refresh_sidebar()
+
+    def first_result(self):
+        """問題セットの最初の1問が表示できた時点を time_to_first_question として記録（2回目以降は無視）"""
+        with self.lock:
+            if self._question_start is None or self._first_result_recorded:
+                return
+            self._first_result_recorded = True
+        self._finish("time_to_first_question", self._question_start, None, None, None)
+
+    @contextmanager
+    def stage(self, name):
+        """ブロック内の API 呼び出しを段階 name として記録する"""
+        token = self._stage.set(name)
+        try:
+            yield
+        finally:
+            self._stage.reset(token)
+
+    @contextmanager
+    def track(self, stage, model=None, temperature=None):
+        """任意の処理を1件として計測。yield された dict の "usage" にトークン数を入れられる"""
+        record = {"usage": None}
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            self._finish(stage, start, model, temperature, record["usage"], error=e)
+            raise
+        self._finish(stage, start, model, temperature, record["usage"])
+
+    def _finish(self, stage, start, model, temperature, usage, error=None):
+        prompt_tokens, completion_tokens = _usage_tokens(usage)
+        record = {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "session": self.session_id,
+            "question": self.question,
+            "stage": self._stage.get() or stage,
+            "model": model,
+            "temperature": temperature,
+            "latency_sec": round(time.perf_counter() - start, 4),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": estimate_cost(model, prompt_tokens, completion_tokens),
+            "error": None if error is None else repr(error),
+        }
+        with self.lock:
+            self.records.append(record)
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._refresh_sidebar()
+        return record
+
+    def record_event(self, event, **fields):
+        """API 呼び出し以外の出来事（JSON 修復の結果など）を1件記録"""
+        record = {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "session": self.session_id,
+            "question": self.question,
+            "event": event,
+            **fields,
+        }
+        with self.lock:
+            self.events.append(record)
+            if self.log_path:
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._refresh_sidebar()
+        return record
+
+    def event_counts(self, event, field):
+        """event の記録を field の値ごとに数える"""
+        counts = {}
+        with self.lock:
+            for r in self.events:
+                if r["event"] == event:
+                    counts[r.get(field)] = counts.get(r.get(field), 0) + 1
+        return counts
+
+    def repair_summary(self):
+        """JSON 読み込み結果の内訳と、壊れた出力をローカル修復で直せた割合"""
+        counts = self.event_counts("json_repair", "outcome")
+        broken = sum(counts.get(k, 0) for k in ("repaired", "rerequested", "failed"))
+        return {**counts, "repair_rate": counts.get("repaired", 0) / broken if broken else None}
+
+    def context_trim_summary(self):
+        """評価に渡したコンテキストの絞り込み前後のトークン数（合計）"""
+        with self.lock:
+            trims = [r for r in self.events if r["event"] == "context_trim"]
+        return {
+            "count": len(trims),
+            "before_tokens": sum(r["before_tokens"] for r in trims),
+            "after_tokens": sum(r["after_tokens"] for r in trims),
+        }
+
+    def concurrency_history(self, stage=None):
+        """concurrency.AdaptiveConcurrency が記録した同時実行数の上限の推移（段階ごと・記録順）"""
+        with self.lock:
+            changes = [r for r in self.events if r["event"] == "concurrency"]
+        history = {}
+        for r in changes:
+            if stage is None or r["stage"] == stage:
+                history.setdefault(r["stage"], []).append(
+                    {"ts": r["ts"], "limit": r["limit"], "reason": r["reason"]})
+        return history
+
+    # ===== 計測の差し込み =====
+    def instrument(self, client):
+        """chat.completions.create / embeddings.create を計測つきにしたクライアントを返す"""
+        return _InstrumentedResource(client, self)
+
+    def wrap_call(self, fn, stage):
+        """API 呼び出し関数を計測つきにする（同期・非同期どちらにも対応）
+
+        stream=True の呼び出しは、ストリームを最後まで読んだ（または閉じた）時点で記録する。
+        トークン数を取るには呼び出し側で stream_options={"include_usage": True} を渡す。
+        """
+        def wrapper(*args, **kwargs):
+            model = kwargs.get("model")
+            temperature = kwargs.get("temperature")
+            # ストリームの記録は読み終えたときなので、呼び出し時点の段階名を覚えておく
+            stage_name = self._stage.get() or stage
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self._finish(stage_name, start, model, temperature, None, error=e)
+                raise
+            if inspect.isawaitable(result):
+                return self._await_and_finish(result, stage_name, start, model, temperature,
+                                              kwargs.get("stream"))
+            if kwargs.get("stream"):
+                return _InstrumentedStream(result, self._stream_finisher(stage_name, start, model, temperature))
+            self._finish(stage_name, start, model, temperature, getattr(result, "usage", None))
+            return result
+
+        return wrapper
+
+    async def _await_and_finish(self, awaitable, stage, start, model, temperature, stream=False):
+        try:
+            result = await awaitable
+        except Exception as e:
+            self._finish(stage, start, model, temperature, None, error=e)
+            raise
+        if stream:
+            return _InstrumentedAsyncStream(result, self._stream_finisher(stage, start, model, temperature))
+        self._finish(stage, start, model, temperature, getattr(result, "usage", None))
+        return result
+
+    def _stream_finisher(self, stage, start, model, temperature):
+        def finish(usage, error=None):
+            self._finish(stage, start, model, temperature, usage, error=error)
+        return finish
+
+    def instrument_evaluate(self, evaluate_fn, judge_model=JUDGE_MODEL):
+        """ragas.evaluate を計測つきにする（評価モデルのトークン数も取れれば記録）"""
+        try:
+            from ragas.cost import get_token_usage_for_openai
+        except ImportError:
+            get_token_usage_for_openai = None
+
+        def wrapper(dataset, *args, metrics=None, **kwargs):
+            names = [getattr(m, "name", str(m)) for m in (metrics or [])]
+            if get_token_usage_for_openai is not None:
+                kwargs.setdefault("token_usage_parser", get_token_usage_for_openai)
+            with self.track("evaluation:" + "+".join(names), model=judge_model) as record:
+                result = evaluate_fn(dataset, *args, metrics=metrics, **kwargs)
+                try:
+                    record["usage"] = result.total_tokens()
+                except Exception:
+                    pass
+            return result
+
+        return wrapper
+
+    def instrument_function(self, fn, stage):
+        """bert_score.score などローカル計算の関数を計測つきにする"""
+        def wrapper(*args, **kwargs):
+            with self.track(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    # ===== 集計・表示 =====
+    def summary(self, question=None):
+        """段階ごとの {calls, latency_sec, prompt_tokens, completion_tokens, cost_usd}"""
+        with self.lock:
+            records = [r for r in self.records if question is None or r["question"] == question]
+        stages = {}
+        for r in records:
+            s = stages.setdefault(r["stage"], {"calls": 0, "latency_sec": 0.0, "prompt_tokens": 0,
+                                               "completion_tokens": 0, "cost_usd": 0.0})
+            s["calls"] += 1
+            s["latency_sec"] += r["latency_sec"]
+            s["prompt_tokens"] += r["prompt_tokens"]
+            s["completion_tokens"] += r["completion_tokens"]
+            s["cost_usd"] += r["cost_usd"]
+        return stages
+
+    def totals(self, question=None):
+        stages = self.summary(question)
+        return {
+            key: sum(s[key] for s in stages.values())
+            for key in ("calls", "latency_sec", "prompt_tokens", "completion_tokens", "cost_usd")
+        }
+
+    def attach_sidebar(self):
+        """Streamlit のサイドバーに表示枠を作り、記録が増えるたびに更新する"""
+        import streamlit as st
+
+        self._sidebar = st.sidebar.empty()
+        self._sidebar_thread = threading.get_ident()
+        self.render()
+
+    def _refresh_sidebar(self):
+        # Streamlit の描画はスクリプト実行スレッドからのみ行う
+        if self._sidebar is None or threading.get_ident() != self._sidebar_thread:
+            return
+        try:
+            self.render()
+        except Exception:
+            pass
+
+    def render(self):
+        import streamlit as st
+
+        if self._sidebar is None:
+            return
+        with self._sidebar.container():
+            st.subheader("⏱ 処理時間・コスト")
+            if self.question:
+                st.caption(f"問題セット #{self.question}")
+                rows = [
+                    {"段階": stage, "回数": s["calls"], "時間(秒)": round(s["latency_sec"], 2),
+                     "入力tok": s["prompt_tokens"], "出力tok": s["completion_tokens"],
+                     "コスト($)": round(s["cost_usd"], 4)}
+                    for stage, s in self.summary(self.question).items()
+                ]
+                if rows:
+                    st.table(rows)
+                current = self.totals(self.question)
+                st.write(f"この問題セット: {current['latency_sec']:.1f} 秒 / ${current['cost_usd']:.4f}")
+            session = self.totals()
+            st.write(f"セッション累計: {session['calls']} 回 / {session['latency_sec']:.1f} 秒 / "
+                     f"${session['cost_usd']:.4f}")
+            repair = self.repair_summary()
+            if repair["repair_rate"] is not None:
+                st.caption(f"JSON: そのまま {repair.get('ok', 0)} / 修復 {repair.get('repaired', 0)} / "
+                           f"再リクエスト {repair.get('rerequested', 0)} / 失敗 {repair.get('failed', 0)}"
+                           f"（修復成功率 {repair['repair_rate']:.0%}）")
+            trim = self.context_trim_summary()
+            if trim["count"]:
+                st.caption(f"評価コンテキスト: {trim['before_tokens']} → {trim['after_tokens']} トークン"
+                           f"（{1 - trim['after_tokens'] / max(trim['before_tokens'], 1):.0%} 削減・{trim['count']} 問）")
+            for stage, history in self.concurrency_history().items():
+                decreases = sum(h["reason"] != "increase" for h in history)
+                st.caption(f"同時実行数（{stage}）: {history[-1]['limit']}"
+                           f"（推移 {' → '.join(str(h['limit']) for h in history[-8:])}・削減 {decreases} 回）")
+            rejected = sum(self.event_counts("validation", "outcome").values())
+            if rejected:
+                st.caption(f"ローカル検証で除外した問題: {rejected} 件")
+
+
+def get_session_telemetry(session_state):
+    """Streamlit のセッションごとに1つの Telemetry を保持"""
+    if "telemetry" not in session_state:
+        session_state.telemetry = Telemetry()
+    return session_state.telemetry
@@ -1,18 +1,28 @@
 import json
-from json import loads
-import re
 import random
 import os
 from dotenv import load_dotenv
 import streamlit as st
 import openai
-from openai import OpenAI
+from openai_client import get_openai_client, connection_report
+from rate_limit import get_rate_limiter
+from telemetry import get_session_telemetry
+from quiz_pipeline import complete_questions
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 
 
-client = OpenAI(api_key=api_key)
+# HTTP 接続プールはプロセスで共有する（再実行のたびに接続を張り直さない）
+client = get_openai_client(api_key)
+
+# ===== 計測（処理時間・トークン数・コスト） =====
+telemetry = get_session_telemetry(st.session_state)
+telemetry.attach_sidebar()
+# 全セッション・全プロセスで共有する API のレート制限（429 はバックオフして再試行）
+client = get_rate_limiter().wrap(client, telemetry=telemetry)
+client = telemetry.instrument(client)
+
 explanations = ["神戸市には東灘区、灘区、中央区、兵庫区、長田区、須磨区、垂水区、北区、西区の9つの区がある。",
                 "兵庫県の中央には中国山地があり、中国山地の北側と南側で気候が異なります。北部は山々が連なり、南部は平野が広がっています。また、山崎断層帯、六甲・淡路島断層帯、有馬ー高槻断層帯、中央構造線といった断層が分布している。",
                 "五国の由来。 摂津：『古事記』 『日本書紀』 には、「津国」とある。津は港を意味する。国名は難波津、武庫水門などの良港があったことに由来する。 播磨：もとは針間国・針間鴨国・明石国の3か国に分かれていた 但馬：『古事記』 には 「多遅麻」 「多遅摩」 とある。 『日本書紀』 ではすべて但馬である。「谷間」に由来するといわれる。 丹波：赤米のが波のように見えたことから丹波と名付けられた.山岳が重なっている山国の底であるからされ、 それが丹波に変化した 淡路：阿波の国へ行く道 (路) に由来するといわれる。",
@@ -23,8 +33,12 @@ explanations = ["神戸市には東灘区、灘区、中央区、兵庫区、長
 if "question_data" not in st.session_state or st.session_state.get("next_question", False):
     QuestionNum = random.randint(0, len(explanations)-1)
     SelectedQuestion = explanations[QuestionNum]
+    telemetry.new_question()
 
-    response = client.chat.completions.create(
+    # 読めない JSON はローカルで修復し、それでも駄目なら1回だけ再リクエスト
+    questions = complete_questions(
+        client,
+        telemetry=telemetry,
         model="gpt-4.1",
         messages=[
             {
@@ -56,19 +70,13 @@ if "question_data" not in st.session_state or st.session_state.get("next_questio
         temperature=1.0
     )
 
-    output_text = response.choices[0].message.content
-    match = re.search(r"\{.*\}", output_text, re.DOTALL)
-
-    if match:
-        try:
-            json_str = match.group()
-            data = loads(json_str)
-            st.session_state.question_data = data
-            st.session_state.explanation = SelectedQuestion
-            st.session_state.next_question = False
-
-        except Exception as e:
-            st.error(f"JSON読み込み失敗: {e}")
+    if questions:
+        data = questions[0]
+        st.session_state.question_data = data
+        st.session_state.explanation = SelectedQuestion
+        st.session_state.next_question = False
+    else:
+        st.error("JSON読み込み失敗: 修復・再リクエストでも読み込めませんでした")
 
 
 st.title("兵庫学検定試験対策ツール1.0")
@@ -95,4 +103,5 @@ if st.button("解答"):
 if st.button("次の問題へ"):
     # 次の問題フラグをセットし、再実行で新しい問題へ
     st.session_state.next_question = True
-    st.rerun()
\ No newline at end of file
+    st.rerun()
+st.sidebar.caption(connection_report())
@@ -5,7 +5,9 @@ import re
 from json import loads
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai_client import get_openai_client, connection_report
+from rate_limit import get_rate_limiter
+from telemetry import get_session_telemetry
 
 
 
@@ -24,7 +26,15 @@ def load_explanations_from_csv(filename="Book1.csv"):
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key)
+# HTTP 接続プールはプロセスで共有する（再実行のたびに接続を張り直さない）
+client = get_openai_client(api_key)
+
+# ===== 計測（処理時間・トークン数・コスト） =====
+telemetry = get_session_telemetry(st.session_state)
+telemetry.attach_sidebar()
+# 全セッション・全プロセスで共有する API のレート制限（429 はバックオフして再試行）
+client = get_rate_limiter().wrap(client, telemetry=telemetry)
+client = telemetry.instrument(client)
 
 
 
@@ -38,6 +48,7 @@ explanations = st.session_state.explanations
 if "question_data" not in st.session_state or st.session_state.get("next_question", False):
     QuestionNum = random.randint(0, len(explanations) - 1)
     SelectedQuestion = explanations[QuestionNum]
+    telemetry.new_question()
 
     response = client.chat.completions.create(
         model="gpt-4.1",
@@ -117,3 +128,4 @@ if st.button("解答"):
 if st.button("次の問題へ"):
     st.session_state.next_question = True
     st.rerun()
+st.sidebar.caption(connection_report())
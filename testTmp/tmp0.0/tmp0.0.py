@@ -6,11 +6,16 @@ from dotenv import load_dotenv
 import streamlit as st
 from openai import OpenAI
 import pandas as pd
+import sys
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CSV_PATH = os.path.join(BASE_DIR, "Book1.csv")
 
+# リポジトリ直下の gen_cache.py を読み込む
+sys.path.append(os.path.abspath(os.path.join(BASE_DIR, "..", "..")))
+from gen_cache import get_generation_cache
+
 
 def load_csv(path):
     return pd.read_csv(path, encoding="utf-8", header=None)
@@ -20,6 +25,10 @@ load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 client = OpenAI(api_key=api_key)
 
+# temperature=0 かつ seed 固定の生成は永続キャッシュを使う
+generation_cache = get_generation_cache(os.path.join(BASE_DIR, "generation_cache.db"))
+client = generation_cache.wrap(client)
+
 st.title("兵庫学検定試験対策ツール Temperature=0.0")
 
 # ===== Book1.csv を読み込む =====
@@ -83,7 +92,8 @@ if st.session_state.next_question:
                 "strict": True,
             },
         },
-        temperature=0.0
+        temperature=0.0,
+        seed=42
     )
 
     data = json.loads(response.choices[0].message.content)
@@ -117,3 +127,5 @@ if st.button("解答"):
 if st.button("次の問題へ"):
     st.session_state.next_question = True
     st.rerun()
+
+st.sidebar.caption(generation_cache.report())